@@ -0,0 +1,137 @@
+"""エンドポイント種別ごとのアドミッション制御（同時実行数・待機キュー・429応答）"""
+import functools
+import threading
+import time
+from typing import Callable, Optional
+from flask import g, jsonify
+from config import Config
+from metrics import metrics
+
+
+class AdmissionRejected(Exception):
+    """同時実行枠・待機キューが埋まっており受け付けられない場合の例外"""
+
+    def __init__(self, endpoint_class: str, reason: str, retry_after: int):
+        super().__init__(f"{endpoint_class}: {reason}")
+        self.endpoint_class = endpoint_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """同時実行数の上限と、待機時間の上限付きの有界キューを管理するクラス"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int,
+                 queue_timeout_sec: float, retry_after_sec: int, downgrade: bool = False):
+        """アドミッション制御の初期化"""
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout_sec = queue_timeout_sec
+        self.retry_after_sec = retry_after_sec
+        # 過負荷時に429ではなくローカルのフォールバック描画へ切り替えるか
+        self.downgrade = downgrade
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+
+    def _publish(self) -> None:
+        """現在の実行数・待機数をゲージへ反映（ロック保持中に呼ぶ）"""
+        metrics.set_gauge(f"admission.{self.name}.active", self._active)
+        metrics.set_gauge(f"admission.{self.name}.queue_depth", self._waiting)
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        metrics.increment(f"admission.{self.name}.rejected.{reason}")
+        return AdmissionRejected(self.name, reason, self.retry_after_sec)
+
+    def acquire(self) -> None:
+        """実行枠を確保（空きが無ければ待機し、キュー満杯/期限切れならAdmissionRejected）"""
+        started = time.monotonic()
+        with self._cond:
+            if self._active < self.max_concurrency and self._waiting == 0:
+                self._active += 1
+                self._publish()
+                metrics.increment(f"admission.{self.name}.admitted")
+                return
+
+            if self._waiting >= self.max_queue:
+                raise self._reject("queue_full")
+
+            deadline = started + self.queue_timeout_sec
+            self._waiting += 1
+            self._publish()
+            try:
+                while self._active >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._reject("queue_timeout")
+                    self._cond.wait(remaining)
+                self._active += 1
+            finally:
+                self._waiting -= 1
+                self._publish()
+
+        metrics.increment(f"admission.{self.name}.admitted")
+        metrics.observe(f"admission.{self.name}.queue_wait_ms", (time.monotonic() - started) * 1000)
+
+    def release(self) -> None:
+        """実行枠を解放し、待機中のリクエストを1件起こす"""
+        with self._cond:
+            self._active = max(0, self._active - 1)
+            self._publish()
+            self._cond.notify()
+
+
+def admission(default_controller: AdmissionController,
+              select: Optional[Callable[[], Optional[AdmissionController]]] = None):
+    """Flaskビューをアドミッション制御下で実行するデコレータ
+
+    受け付けられない場合は429（Retry-After付き）を返す。controller.downgradeが有効なら
+    枠を確保せずに実行し、g.admission_downgradedでローカル描画への切替をビューへ伝える。
+    selectを指定するとリクエストごとに別のコントローラ（例: ローカル処理のみの編集）を選べる。
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.admission_downgraded = False
+            controller = (select() if select else None) or default_controller
+            try:
+                controller.acquire()
+            except AdmissionRejected as e:
+                if controller.downgrade:
+                    metrics.increment(f"admission.{controller.name}.downgraded")
+                    g.admission_downgraded = True
+                    return view(*args, **kwargs)
+                response = jsonify({
+                    "status": "error",
+                    "message": "server_busy",
+                    "reason": e.reason,
+                    "retry_after": e.retry_after
+                })
+                response.status_code = 429
+                response.headers["Retry-After"] = str(e.retry_after)
+                return response
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release()
+        return wrapper
+    return decorator
+
+
+# エンドポイント種別ごとのコントローラ
+ai_admission = AdmissionController(
+    "ai",
+    Config.AI_MAX_CONCURRENCY,
+    Config.AI_MAX_QUEUE,
+    Config.AI_QUEUE_TIMEOUT_SEC,
+    Config.AI_RETRY_AFTER_SEC,
+    downgrade=Config.AI_DOWNGRADE_ON_OVERLOAD,
+)
+standard_admission = AdmissionController(
+    "standard",
+    Config.STANDARD_MAX_CONCURRENCY,
+    Config.STANDARD_MAX_QUEUE,
+    Config.STANDARD_QUEUE_TIMEOUT_SEC,
+    Config.STANDARD_RETRY_AFTER_SEC,
+)
@@ -1,6 +1,7 @@
 """Vertex AI Imagen APIを使用した画像編集サービス"""
 import io
 import base64
+import hashlib
 from typing import List, Tuple, Optional, Dict
 from google.cloud import aiplatform
 from google.cloud import aiplatform_v1
@@ -8,13 +9,113 @@ from google.protobuf.json_format import MessageToDict, ParseDict
 from PIL import Image
 import json
 from config import Config
+from tracing import span, traced, wrap_context
 from google.protobuf import struct_pb2
 import time
 import traceback
 import vertexai
 from vertexai.preview.vision_models import ImageGenerationModel
-from PIL import ImageOps
 from google.cloud import aiplatform_v1beta1
+from single_flight import SingleFlight
+from image_processor import ImageProcessor
+from local_anonymizer import LocalAnonymizer
+from deadline import Deadline, DeadlineExceeded
+from metrics import metrics
+from model_router import model_router
+from quota_governor import quota_governor, is_quota_error
+from near_duplicate import near_duplicate_index
+from concurrent.futures import ThreadPoolExecutor
+
+class _Step:
+    """VariantAttemptsの1回分の試行"""
+
+    def __init__(self, index: int, backend: str, retry: int, quota_key: str):
+        self.index = index
+        self.backend = backend
+        self.retry = retry
+        self.quota_key = quota_key
+        self.started = 0.0
+
+
+class VariantAttempts:
+    """Imagen各バリアント・SDXLの試行計画と結果の記録（同期・asyncio版の編集で共有）
+
+    試行順はルーターが決め、Imagenは画像の無い応答の場合のみ同じプロンプトで再試行する。
+    呼び出し・クォータ待ち・待機のみを呼び出し側が行い、ルーターへの記録・エラーの集約はここで行う。
+    """
+
+    # Imagenの各バリアントは画像の無い応答の場合に最大この回数まで試行する
+    IMAGEN_ATTEMPTS = 2
+
+    def __init__(self, backends: List[str], deadline: Optional[Deadline], routing: Optional[List[Dict]]):
+        """試行順の決定（routingを渡すとルーターの判断を追記）"""
+        remaining_ms = deadline.remaining() * 1000 if deadline is not None else None
+        self.decision = model_router.plan(backends, remaining_ms)
+        self.decision["used"] = None
+        if routing is not None:
+            routing.append(self.decision)
+        self.errors: List[str] = []
+        self._called = False
+        self._done_backend: Optional[str] = None
+
+    @staticmethod
+    def quota_key(backend: str) -> str:
+        """バックエンド名（imagen_A, sdxl等）に対応するクォータのバケット"""
+        if backend.startswith("sdxl"):
+            return quota_governor.key("sdxl", Config.SDXL_MODEL, Config.SDXL_REGION)
+        return quota_governor.key("imagen", Config.IMAGEN_MODEL, Config.IMAGEN_REGION)
+
+    def steps(self):
+        """試行を順に返す（クォータ不足・例外のバックエンドは残りの再試行を省く）"""
+        for index, backend in enumerate(self.decision["order"]):
+            attempts = self.IMAGEN_ATTEMPTS if backend.startswith("imagen") else 1
+            for retry in range(attempts):
+                if self._done_backend == backend:
+                    break
+                yield _Step(index, backend, retry, self.quota_key(backend))
+
+    def quota_skipped(self, step: _Step) -> None:
+        """クォータのトークンを待ち時間内に取得できず呼び出さなかった"""
+        self.decision["skipped"].append({"backend": step.backend, "reason": "quota"})
+        self.errors.append(f"{step.backend}: quota")
+        self._done_backend = step.backend
+
+    def begin(self, step: _Step) -> bool:
+        """呼び出し直前に呼ぶ。2回目以降の呼び出しで、前にリトライ間隔の待機が必要ならTrue"""
+        backoff = self._called
+        self._called = True
+        step.started = time.monotonic()
+        return backoff
+
+    def _elapsed_ms(self, step: _Step) -> float:
+        return (time.monotonic() - step.started) * 1000
+
+    def deadline_aborted(self, step: _Step) -> None:
+        """期限による打ち切り・呼び出し前の拒否（バックエンドの失敗としては記録しない）"""
+        model_router.record_deadline(step.backend)
+
+    def failed(self, step: _Step, error: Exception) -> bool:
+        """呼び出しが例外で失敗した（次のバックエンドへ進む）。クォータ超過ならTrue"""
+        model_router.record(step.backend, False, self._elapsed_ms(step))
+        print(f"Edit failed on backend={step.backend}: {error}")
+        self.errors.append(f"{step.backend}: {error}")
+        self._done_backend = step.backend
+        return is_quota_error(error)
+
+    def finished(self, step: _Step, edited: Optional[Image.Image]) -> bool:
+        """呼び出しが応答を返した。画像があれば採用してTrue"""
+        model_router.record(step.backend, edited is not None, self._elapsed_ms(step))
+        if edited is None:
+            self.errors.append(f"{step.backend}: empty result")
+            return False
+        print(f"Edit succeeded with backend={step.backend}, attempt={step.retry + 1}")
+        self.decision["used"] = step.backend
+        return True
+
+    def exhausted(self) -> Exception:
+        """全バックエンドが失敗した場合に送出する例外"""
+        return Exception(f"All models failed | order={self.decision['order']} | errors={' | '.join(self.errors)}")
+
 
 class AIImageEditor:
     """Vertex AI Imagen APIを使用した画像編集クラス"""
@@ -27,20 +128,327 @@ class AIImageEditor:
         
         # Vertex AIを初期化
         aiplatform.init(project=self.project_id, location=self.location)
+
+        # 同一画像・同一編集の同時リクエストを1回のImagen呼び出しにまとめる
+        self._single_flight = SingleFlight("edit_image")
+        # ぼかし/モザイク/塗りつぶしはVertex AIを使わずローカルで処理
+        self.local_anonymizer = LocalAnonymizer()
+        # 集合写真の顔クラスタを並列に編集するワーカー
+        self._cluster_executor = ThreadPoolExecutor(
+            max_workers=max(1, Config.INPAINT_CLUSTER_CONCURRENCY), thread_name_prefix="inpaint-cluster"
+        )
     
-    def generate_piece_overlay(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]]) -> Tuple[Optional[Image.Image], Optional[str]]:
-        """Vertex AI Imagen APIのinpaintで、人物の手(ピース/花束)で顔を隠す編集を全体画像に適用"""
+    # Imagen/SDXLへ渡す入力画像の長辺上限
+    MODEL_MAX_SIDE = 1536
+
+    def _fit_for_model(self, image: Image.Image) -> Tuple[Image.Image, float]:
+        """入力画像を長辺<=MODEL_MAX_SIDEに収め、(画像, 縮小比率) を返す"""
+        original_width, original_height = image.size
+        resized = ImageProcessor.downscale_if_needed(image, self.MODEL_MAX_SIDE)
+        if resized.size == (original_width, original_height):
+            return resized, 1.0
+        return resized, resized.width / float(original_width)
+
+    @staticmethod
+    def _backoff(seconds: float, deadline: Optional[Deadline]) -> None:
+        """リトライ前の待機（期限がある場合は期限内に収まる場合のみ待機）"""
+        if deadline is None:
+            time.sleep(seconds)
+        else:
+            deadline.sleep(seconds)
+
+    @staticmethod
+    def _predict_imagen(model_name: str, prompt: str, deadline: Deadline) -> Optional[Image.Image]:
+        """Imagenの予測APIを残り時間をRPCのタイムアウトとして呼び出す（generate_imagesと同じリクエスト）
+
+        期限で打ち切った呼び出しはgRPC側で取り消されるため、バックグラウンドに処理を残さない。
+        """
+        from google.api_core import exceptions as api_exceptions
+
+        client_options = {"api_endpoint": f"{Config.IMAGEN_REGION}-aiplatform.googleapis.com"}
+        client = aiplatform_v1beta1.PredictionServiceClient(client_options=client_options)
+        endpoint = f"projects/{Config.PROJECT_ID}/locations/{Config.IMAGEN_REGION}/publishers/google/models/{model_name}"
         try:
-            # 入力画像を長辺<=1536に縮小（capability安定化）
-            resize_ratio = 1.0
+            response = client.predict(
+                endpoint=endpoint,
+                instances=[{"prompt": prompt}],
+                parameters={"sampleCount": 1},
+                timeout=deadline.timeout(120)
+            )
+        except api_exceptions.DeadlineExceeded:
+            deadline.hit = True
+            raise DeadlineExceeded("Vertex AI call timed out before deadline")
+        if response.predictions:
+            prediction = response.predictions[0]
+            if 'bytesBase64Encoded' in prediction:
+                return Image.open(io.BytesIO(base64.b64decode(prediction['bytesBase64Encoded'])))
+        return None
+
+    def _inpaint_with_variants(self, image: Image.Image, mask_b64: Optional[str], prompts: List[str],
+                               deadline: Optional[Deadline] = None, routing: Optional[List[Dict]] = None) -> Image.Image:
+        """Imagen各バリアント・SDXLをルーターが決めた順に試行し、最初に成功した結果を返す
+
+        routingを渡すとルーターの判断（試行順・省略・採用バックエンド）を追記する。
+        クォータのトークンを待ち時間内に取得できないバックエンドは呼び出さずに次へ進む。
+        """
+        attempts = {
+            "imagen_A": lambda: self._inpaint_full_image_with_imagen(image, mask_b64, prompts[0], deadline),
+            "imagen_B": lambda: self._inpaint_full_image_with_imagen(image, mask_b64, prompts[1], deadline),
+            "imagen_C": lambda: self._inpaint_full_image_with_imagen(image, mask_b64, prompts[2], deadline),
+        }
+        # SDXLはマスク必須
+        if mask_b64 is not None:
+            attempts["sdxl"] = lambda: self._inpaint_with_sdxl(image, mask_b64, prompts[0], deadline)
+        plan = VariantAttempts(list(attempts), deadline, routing)
+        for step in plan.steps():
+            if not quota_governor.acquire(step.quota_key, deadline):
+                plan.quota_skipped(step)
+                continue
+            if plan.begin(step):
+                self._backoff(0.8, deadline)
             try:
-                max_side = 1536
-                if max(image.width, image.height) > max_side:
-                    resize_ratio = max_side / float(max(image.width, image.height))
-                    new_size = (int(image.width * resize_ratio), int(image.height * resize_ratio))
-                    image = image.resize(new_size, Image.Resampling.LANCZOS)
-            except Exception:
-                resize_ratio = 1.0
+                with span("editor.attempt", backend=step.backend, attempt=step.index + 1, retry=step.retry) as attempt_span:
+                    edited = attempts[step.backend]()
+                    attempt_span.set("success", edited is not None)
+            except DeadlineExceeded:
+                # 残り時間では次のバックエンドを試せないため打ち切る
+                plan.deadline_aborted(step)
+                raise
+            except Exception as inner:
+                if plan.failed(step, inner):
+                    # 他のスレッド・プロセスも同じモデルへの送信を一時停止する
+                    quota_governor.penalize(step.quota_key)
+                continue
+            if plan.finished(step, edited):
+                return edited
+        raise plan.exhausted()
+
+    def _use_region_inpaint(self, face_regions: List[Tuple[int, int, int, int]]) -> bool:
+        """顔周辺のみを切り出して編集するモードか"""
+        return bool(face_regions) and Config.INPAINT_REGION_MODE in ('cluster', 'union')
+
+    @staticmethod
+    def _upper_body_box(region: Tuple[int, int, int, int], image_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+        """顔矩形から上半身（顔〜肩周り）の矩形 (x0, y0, x1, y1) を求める"""
+        width, height = image_size
+        x, y, w, h = region
+        pad = int(min(w, h) * 0.60)  # 余白をやや拡大
+        # 下側は胸〜肩が確実に含まれるように更に拡張
+        return (max(0, x - pad), max(0, y - pad), min(width, x + w + pad), min(height, y + int(h * 2.6)))
+
+    def _region_clusters(self, image_size: Tuple[int, int], face_regions: List[Tuple[int, int, int, int]]) -> List[Tuple[Tuple[int, int, int, int], List[Tuple[int, int, int, int]]]]:
+        """上半身矩形が重なる顔をまとめ、(切り出し矩形, 顔領域) のリストを返す"""
+        width, height = image_size
+        clusters = [(self._upper_body_box(r, image_size), [r]) for r in face_regions]
+        if Config.INPAINT_REGION_MODE == 'union':
+            boxes = [b for b, _ in clusters]
+            clusters = [((min(b[0] for b in boxes), min(b[1] for b in boxes),
+                          max(b[2] for b in boxes), max(b[3] for b in boxes)), list(face_regions))]
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(clusters)):
+                for j in range(i + 1, len(clusters)):
+                    (a, ra), (b, rb) = clusters[i], clusters[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        box = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                        clusters[i] = (box, ra + rb)
+                        del clusters[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        # モデルが周囲の文脈を参照できるよう、切り出し矩形を最小辺まで広げる
+        min_side = Config.INPAINT_REGION_MIN_SIDE
+        result = []
+        for (x0, y0, x1, y1), regions in clusters:
+            x0, x1 = self._grow_span(x0, x1, width, min_side)
+            y0, y1 = self._grow_span(y0, y1, height, min_side)
+            result.append(((x0, y0, x1, y1), regions))
+        return result
+
+    @staticmethod
+    def _grow_span(lo: int, hi: int, limit: int, min_len: int) -> Tuple[int, int]:
+        """区間[lo, hi)を中心を保ったままmin_len（最大limit）まで広げる"""
+        target = min(limit, min_len)
+        if hi - lo >= target:
+            return lo, hi
+        lo = max(0, min(lo - (target - (hi - lo)) // 2, limit - target))
+        return lo, lo + target
+
+    @traced("editor.inpaint_regions")
+    def _inpaint_face_regions(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]],
+                              prompts: List[str], deadline: Optional[Deadline] = None,
+                              routing: Optional[List[Dict]] = None) -> Image.Image:
+        """顔クラスタごとに切り出した領域だけを編集し、元解像度の画像へぼかしマスクで合成
+
+        複数クラスタ（集合写真）はINPAINT_CLUSTER_CONCURRENCY件まで並列に編集するため、
+        所要時間は人数ではなく最も遅いクラスタ1件分に近くなる。
+        """
+        base = image.convert('RGB')
+        clusters = self._region_clusters(base.size, face_regions)
+        if len(clusters) == 1:
+            edited = [self._inpaint_cluster(base, clusters[0], prompts, deadline, routing)]
+        else:
+            futures = [
+                self._cluster_executor.submit(wrap_context(self._inpaint_cluster), base, cluster, prompts, deadline, routing)
+                for cluster in clusters
+            ]
+            try:
+                edited = [future.result() for future in futures]
+            except BaseException:
+                # 1クラスタでも失敗すれば全体をフォールバックするため、未開始のクラスタは送信しない
+                for future in futures:
+                    future.cancel()
+                raise
+
+        return self._composite_clusters(base, clusters, edited)
+
+    def _composite_clusters(self, base: Image.Image, clusters: List[Tuple[Tuple[int, int, int, int], List[Tuple[int, int, int, int]]]],
+                            edited: List[Tuple[Image.Image, Image.Image, int]]) -> Image.Image:
+        """クラスタごとの編集結果を順に合成（重なった切り出し領域では先に合成したクラスタの結果を下地にする）"""
+        sent_pixels = 0
+        for ((x0, y0, x1, y1), regions), (result, blend_mask, fit_pixels) in zip(clusters, edited):
+            current = base.crop((x0, y0, x1, y1))
+            base.paste(Image.composite(result, current, blend_mask), (x0, y0))
+            sent_pixels += fit_pixels
+
+        metrics.increment("ai_edit.region_inpaint.clusters", len(clusters))
+        metrics.observe("ai_edit.region_inpaint.pixel_ratio", sent_pixels / float(base.width * base.height))
+        return base
+
+    def _prepare_cluster(self, base: Image.Image, cluster: Tuple[Tuple[int, int, int, int], List[Tuple[int, int, int, int]]]) -> Tuple[Image.Image, Image.Image, Optional[str], List[Tuple[int, int, int, int]]]:
+        """クラスタを切り出し、(切り出し画像, モデル入力画像, マスク, 切り出し内の顔領域) を返す"""
+        (x0, y0, x1, y1), regions = cluster
+        model_name = getattr(Config, 'IMAGEN_MODEL', 'imagen-3.0-generate-002')
+        crop = base.crop((x0, y0, x1, y1))
+        local_regions = [(x - x0, y - y0, w, h) for (x, y, w, h) in regions]
+        crop_fit, ratio = self._fit_for_model(crop)
+        mask_b64 = None if 'capability' in model_name else self._create_upper_body_mask(crop_fit.size, local_regions, ratio)
+        return crop, crop_fit, mask_b64, local_regions
+
+    def _finish_cluster(self, crop: Image.Image, crop_fit: Image.Image, edited: Image.Image,
+                        local_regions: List[Tuple[int, int, int, int]]) -> Tuple[Image.Image, Image.Image, int]:
+        """編集結果を切り出しサイズへ戻し、(編集結果, 合成用ぼかしマスク, 送信画素数) を返す"""
+        from PIL import ImageFilter
+
+        edited = edited.convert('RGB')
+        if edited.size != crop.size:
+            edited = edited.resize(crop.size, Image.Resampling.LANCZOS)
+
+        # マスク外（背景）は元画素のまま残し、境界のみなじませる
+        blend_mask = self._upper_body_mask_image(crop.size, local_regions)
+        feather = max(1, int(min(crop.size) * Config.INPAINT_REGION_FEATHER))
+        blend_mask = blend_mask.filter(ImageFilter.GaussianBlur(feather))
+        return edited, blend_mask, crop_fit.width * crop_fit.height
+
+    @traced("editor.inpaint_cluster")
+    def _inpaint_cluster(self, base: Image.Image, cluster: Tuple[Tuple[int, int, int, int], List[Tuple[int, int, int, int]]],
+                         prompts: List[str], deadline: Optional[Deadline] = None,
+                         routing: Optional[List[Dict]] = None) -> Tuple[Image.Image, Image.Image, int]:
+        """1クラスタを切り出して編集し、(編集結果, 合成用ぼかしマスク, 送信画素数) を返す"""
+        crop, crop_fit, mask_b64, local_regions = self._prepare_cluster(base, cluster)
+        edited = self._inpaint_with_variants(crop_fit, mask_b64, prompts, deadline, routing)
+        return self._finish_cluster(crop, crop_fit, edited, local_regions)
+
+    @staticmethod
+    def _piece_prompts() -> List[str]:
+        """花束で顔を隠す編集のプロンプト（バリアントA/B/C）"""
+        # プロンプト（Imagen 3用に最適化: 花束で顔を隠す、約6割被覆・背景/服は維持）
+        base_prompt = (
+            "A person holding a beautiful bouquet of white baby's breath flowers (Gypsophila) in front of their face, "
+            "covering approximately 60% of their facial features including eyes and nose. "
+            "The person is wearing the same clothing and standing in the same background as the original image. "
+            "The bouquet is held naturally with both hands, fresh and delicate, abundant white flowers. "
+            "Maintain the exact same hair color, clothing style, background setting, lighting conditions, and color palette. "
+            "Photorealistic image with natural hand positioning and correct anatomy. "
+            "The scene should look exactly like the original photo but with the bouquet addition."
+        )
+
+        negative_prompt = (
+            "mutated hands, fused fingers, broken anatomy, deformed face, distorted arms, "
+            "extra limbs, floating hands, blurry, text, watermark, stickers, emojis, drawn graphics"
+        )
+
+        prompt_A = f"{base_prompt} Negative prompt: {negative_prompt}"
+        prompt_B = (
+            f"{base_prompt} Ensure the bouquet hides roughly sixty percent of the face, covering the eyes and nose while keeping hair, clothing and background unchanged. "
+            f"Negative prompt: {negative_prompt}"
+        )
+        prompt_C = (
+            f"{base_prompt} Center the bouquet over the facial area so about 60% of the face is obscured; do not alter hair, clothing or background. "
+            f"Negative prompt: {negative_prompt}"
+        )
+        return [prompt_A, prompt_B, prompt_C]
+
+    @staticmethod
+    def _postcard_prompts() -> List[str]:
+        """季節の風景画入りポストカードで顔を隠す編集のプロンプト（バリアントA/B/C）"""
+        from datetime import datetime
+        import pytz
+
+        # 現在の日付を取得（日本時間）
+        jst = pytz.timezone('Asia/Tokyo')
+        now = datetime.now(jst)
+        current_date = now.strftime("%Y/%m/%d")
+        
+        # 季節判定（月に基づく）
+        month = now.month
+        if month in [12, 1, 2]:
+            season = "winter"
+            landscape_desc = "snow-covered mountains and clear blue sky"
+        elif month in [3, 4, 5]:
+            season = "spring"
+            landscape_desc = "cherry blossoms and green mountains"
+        elif month in [6, 7, 8]:
+            season = "summer"
+            landscape_desc = "green mountains and bright blue sky"
+        else:  # 9, 10, 11
+            season = "autumn"
+            landscape_desc = "colorful autumn leaves and mountains"
+        
+        # プロンプト（ポストカード用: 季節の風景画入りポストカードで顔を隠す、約6割被覆・背景/服は維持）
+        base_prompt = (
+            f"A person holding a cream beige postcard with a beautiful {season} landscape painting. "
+            f"The painting shows {landscape_desc} in soft, artistic style. "
+            f"The postcard is held naturally in front of their face, covering approximately 60% of their facial features including eyes and nose. "
+            f"The landscape artwork is centered on the postcard with elegant composition. "
+            f"The person is wearing the same clothing and standing in the same background as the original image. "
+            f"Maintain the exact same hair color, clothing style, background setting, lighting conditions, and color palette. "
+            f"Photorealistic image with natural hand positioning and correct anatomy. "
+            f"The scene should look exactly like the original photo but with the postcard addition."
+        )
+
+        negative_prompt = (
+            "mutated hands, fused fingers, broken anatomy, deformed face, distorted arms, "
+            "extra limbs, floating hands, blurry, text, watermark, stickers, emojis, drawn graphics, "
+            "abstract art, modern art, cartoon style, anime style"
+        )
+
+        prompt_A = f"{base_prompt} Negative prompt: {negative_prompt}"
+        prompt_B = (
+            f"{base_prompt} Ensure the postcard hides roughly sixty percent of the face, covering the eyes and nose while keeping hair, clothing and background unchanged. "
+            f"The {season} landscape painting should be clearly visible and beautifully rendered. "
+            f"Negative prompt: {negative_prompt}"
+        )
+        prompt_C = (
+            f"{base_prompt} Center the postcard over the facial area so about 60% of the face is obscured; do not alter hair, clothing or background. "
+            f"The landscape artwork should show {landscape_desc} in artistic style. "
+            f"Negative prompt: {negative_prompt}"
+        )
+        return [prompt_A, prompt_B, prompt_C]
+
+    def generate_piece_overlay(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], deadline: Optional[Deadline] = None, routing: Optional[List[Dict]] = None) -> Tuple[Optional[Image.Image], Optional[str]]:
+        """Vertex AI Imagen APIのinpaintで、人物の手(ピース/花束)で顔を隠す編集を全体画像に適用"""
+        try:
+            prompts = self._piece_prompts()
+            if self._use_region_inpaint(face_regions):
+                # 顔周辺のクラスタのみをモデルへ送り、元解像度の画像へ合成（背景は無変更、全体用の縮小・マスクは不要）
+                return self._inpaint_face_regions(image, face_regions, prompts, deadline, routing), None
+
+            # 入力画像を長辺<=1536に縮小（capability安定化、収まっていれば無変換）
+            image, resize_ratio = self._fit_for_model(image)
 
             # モデルに応じてマスク生成をスキップ（capability系はマスク非対応）
             model_name = getattr(Config, 'IMAGEN_MODEL', 'imagen-3.0-generate-002')
@@ -50,116 +458,25 @@ class AIImageEditor:
                 # リサイズ後の画像サイズでマスクを生成（リサイズ比率を渡す）
                 mask_b64 = self._create_upper_body_mask(image.size, face_regions, resize_ratio)
 
-            # 顔寄りの追加context画像を準備（顔があればその周辺、無ければ中央トリミング）
-            face_context_b64 = None
-            try:
-                if face_regions:
-                    x, y, w, h = face_regions[0]
-                    pad = int(min(w, h) * 0.6)
-                    x0 = max(0, x - pad)
-                    y0 = max(0, y - pad)
-                    x1 = min(image.width, x + w + pad)
-                    y1 = min(image.height, y + h + pad * 2)
-                    face_crop = image.crop((x0, y0, x1, y1))
-                else:
-                    # 顔検出が無い場合は画像中央を正方形で切り出し
-                    side = min(image.width, image.height)
-                    face_crop = ImageOps.fit(image, (side, side), centering=(0.5, 0.45))
-                buf_fc = io.BytesIO()
-                face_crop.convert('RGB').save(buf_fc, format='JPEG', quality=95)
-                face_context_b64 = base64.b64encode(buf_fc.getvalue()).decode('utf-8')
-            except Exception:
-                face_context_b64 = None
-
-            # プロンプト（Imagen 3用に最適化: 花束で顔を隠す、約6割被覆・背景/服は維持）
-            base_prompt = (
-                "A person holding a beautiful bouquet of white baby's breath flowers (Gypsophila) in front of their face, "
-                "covering approximately 60% of their facial features including eyes and nose. "
-                "The person is wearing the same clothing and standing in the same background as the original image. "
-                "The bouquet is held naturally with both hands, fresh and delicate, abundant white flowers. "
-                "Maintain the exact same hair color, clothing style, background setting, lighting conditions, and color palette. "
-                "Photorealistic image with natural hand positioning and correct anatomy. "
-                "The scene should look exactly like the original photo but with the bouquet addition."
-            )
-
-            negative_prompt = (
-                "mutated hands, fused fingers, broken anatomy, deformed face, distorted arms, "
-                "extra limbs, floating hands, blurry, text, watermark, stickers, emojis, drawn graphics"
-            )
-
-            prompt_A = f"{base_prompt} Negative prompt: {negative_prompt}"
-            prompt_B = (
-                f"{base_prompt} Ensure the bouquet hides roughly sixty percent of the face, covering the eyes and nose while keeping hair, clothing and background unchanged. "
-                f"Negative prompt: {negative_prompt}"
-            )
-            prompt_C = (
-                f"{base_prompt} Center the bouquet over the facial area so about 60% of the face is obscured; do not alter hair, clothing or background. "
-                f"Negative prompt: {negative_prompt}"
-            )
-
-            # 入力画像を長辺<=1536に縮小（capability安定化）
-            try:
-                max_side = 1536
-                if max(image.width, image.height) > max_side:
-                    ratio = max_side / float(max(image.width, image.height))
-                    new_size = (int(image.width * ratio), int(image.height * ratio))
-                    image = image.resize(new_size, Image.Resampling.LANCZOS)
-            except Exception:
-                pass
-
-            # 2段→3段トライ: A → B → C。各プロンプトで最大2回リトライ
-            last_error_detail = None
-            for variant, pr in [("A", prompt_A), ("B", prompt_B), ("C", prompt_C)]:
-                try:
-                    attempts = 0
-                    while attempts < 2:
-                        edited = self._inpaint_full_image_with_imagen(
-                            image, mask_b64, pr if pr else prompt_A
-                        )
-                        if edited is not None:
-                            print(f"Imagen edit succeeded with variant={variant}, attempt={attempts+1}")
-                            return edited, None
-                        attempts += 1
-                        time.sleep(0.8)
-                except Exception as inner:
-                    print(f"Imagen edit failed on variant={variant}: {inner}")
-                    last_error_detail = str(inner)
-                    continue
-
-            # Imagen失敗時はSDXL Inpaintingを試行
-            print("Imagen failed, trying SDXL Inpainting...")
-            if mask_b64 is not None:
-                try:
-                    edited = self._inpaint_with_sdxl(image, mask_b64, prompt_A)
-                    if edited is not None:
-                        print("SDXL Inpainting succeeded")
-                        return edited, None
-                except Exception as sdxl_error:
-                    print(f"SDXL Inpainting failed: {sdxl_error}")
-                    last_error_detail = f"Imagen: {last_error_detail} | SDXL: {str(sdxl_error)}"
-
-            raise Exception(f"All models failed | last_error={last_error_detail}")
+            return self._inpaint_with_variants(image, mask_b64, prompts, deadline, routing), None
 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             error_msg = f"Failed during image generation setup: {e}"
             print(f"ERROR: {error_msg}")
             return None, error_msg
     
-    def generate_postcard_overlay(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]]) -> Tuple[Optional[Image.Image], Optional[str]]:
+    def generate_postcard_overlay(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], deadline: Optional[Deadline] = None, routing: Optional[List[Dict]] = None) -> Tuple[Optional[Image.Image], Optional[str]]:
         """Vertex AI Imagen APIのinpaintで、人物のポストカードで顔を隠す編集を全体画像に適用"""
         try:
-            from datetime import datetime
-            
-            # 入力画像を長辺<=1536に縮小（capability安定化）
-            resize_ratio = 1.0
-            try:
-                max_side = 1536
-                if max(image.width, image.height) > max_side:
-                    resize_ratio = max_side / float(max(image.width, image.height))
-                    new_size = (int(image.width * resize_ratio), int(image.height * resize_ratio))
-                    image = image.resize(new_size, Image.Resampling.LANCZOS)
-            except Exception:
-                resize_ratio = 1.0
+            prompts = self._postcard_prompts()
+            if self._use_region_inpaint(face_regions):
+                # 顔周辺のクラスタのみをモデルへ送り、元解像度の画像へ合成（背景は無変更、全体用の縮小・マスクは不要）
+                return self._inpaint_face_regions(image, face_regions, prompts, deadline, routing), None
+
+            # 入力画像を長辺<=1536に縮小（capability安定化、収まっていれば無変換）
+            image, resize_ratio = self._fit_for_model(image)
 
             # モデルに応じてマスク生成をスキップ（capability系はマスク非対応）
             model_name = getattr(Config, 'IMAGEN_MODEL', 'imagen-3.0-generate-002')
@@ -169,90 +486,10 @@ class AIImageEditor:
                 # リサイズ後の画像サイズでマスクを生成（リサイズ比率を渡す）
                 mask_b64 = self._create_upper_body_mask(image.size, face_regions, resize_ratio)
 
-            # 現在の日付を取得（日本時間）
-            import pytz
-            jst = pytz.timezone('Asia/Tokyo')
-            now = datetime.now(jst)
-            current_date = now.strftime("%Y/%m/%d")
-            
-            # 季節判定（月に基づく）
-            month = now.month
-            if month in [12, 1, 2]:
-                season = "winter"
-                landscape_desc = "snow-covered mountains and clear blue sky"
-            elif month in [3, 4, 5]:
-                season = "spring"
-                landscape_desc = "cherry blossoms and green mountains"
-            elif month in [6, 7, 8]:
-                season = "summer"
-                landscape_desc = "green mountains and bright blue sky"
-            else:  # 9, 10, 11
-                season = "autumn"
-                landscape_desc = "colorful autumn leaves and mountains"
-            
-            # プロンプト（ポストカード用: 季節の風景画入りポストカードで顔を隠す、約6割被覆・背景/服は維持）
-            base_prompt = (
-                f"A person holding a cream beige postcard with a beautiful {season} landscape painting. "
-                f"The painting shows {landscape_desc} in soft, artistic style. "
-                f"The postcard is held naturally in front of their face, covering approximately 60% of their facial features including eyes and nose. "
-                f"The landscape artwork is centered on the postcard with elegant composition. "
-                f"The person is wearing the same clothing and standing in the same background as the original image. "
-                f"Maintain the exact same hair color, clothing style, background setting, lighting conditions, and color palette. "
-                f"Photorealistic image with natural hand positioning and correct anatomy. "
-                f"The scene should look exactly like the original photo but with the postcard addition."
-            )
-
-            negative_prompt = (
-                "mutated hands, fused fingers, broken anatomy, deformed face, distorted arms, "
-                "extra limbs, floating hands, blurry, text, watermark, stickers, emojis, drawn graphics, "
-                "abstract art, modern art, cartoon style, anime style"
-            )
-
-            prompt_A = f"{base_prompt} Negative prompt: {negative_prompt}"
-            prompt_B = (
-                f"{base_prompt} Ensure the postcard hides roughly sixty percent of the face, covering the eyes and nose while keeping hair, clothing and background unchanged. "
-                f"The {season} landscape painting should be clearly visible and beautifully rendered. "
-                f"Negative prompt: {negative_prompt}"
-            )
-            prompt_C = (
-                f"{base_prompt} Center the postcard over the facial area so about 60% of the face is obscured; do not alter hair, clothing or background. "
-                f"The landscape artwork should show {landscape_desc} in artistic style. "
-                f"Negative prompt: {negative_prompt}"
-            )
-
-            # 2段→3段トライ: A → B → C。各プロンプトで最大2回リトライ
-            last_error_detail = None
-            for variant, pr in [("A", prompt_A), ("B", prompt_B), ("C", prompt_C)]:
-                try:
-                    attempts = 0
-                    while attempts < 2:
-                        edited = self._inpaint_full_image_with_imagen(
-                            image, mask_b64, pr if pr else prompt_A
-                        )
-                        if edited is not None:
-                            print(f"Imagen edit succeeded with variant={variant}, attempt={attempts+1}")
-                            return edited, None
-                        attempts += 1
-                        time.sleep(0.8)
-                except Exception as inner:
-                    print(f"Imagen edit failed on variant={variant}: {inner}")
-                    last_error_detail = str(inner)
-                    continue
-
-            # Imagen失敗時はSDXL Inpaintingを試行
-            print("Imagen failed, trying SDXL Inpainting...")
-            if mask_b64 is not None:
-                try:
-                    edited = self._inpaint_with_sdxl(image, mask_b64, prompt_A)
-                    if edited is not None:
-                        print("SDXL Inpainting succeeded")
-                        return edited, None
-                except Exception as sdxl_error:
-                    print(f"SDXL Inpainting failed: {sdxl_error}")
-                    last_error_detail = f"Imagen: {last_error_detail} | SDXL: {str(sdxl_error)}"
-
-            raise Exception(f"All models failed | last_error={last_error_detail}")
+            return self._inpaint_with_variants(image, mask_b64, prompts, deadline, routing), None
 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             error_msg = f"Failed during postcard image generation setup: {e}"
             print(f"ERROR: {error_msg}")
@@ -375,40 +612,36 @@ class AIImageEditor:
         mask.save(buf, format='PNG')
         return base64.b64encode(buf.getvalue()).decode('utf-8')
 
-    def _create_upper_body_mask(self, image_size: Tuple[int, int], face_regions: List[Tuple[int, int, int, int]], resize_ratio: float = 1.0) -> str:
-        """上半身（顔〜肩周り）を覆うマスクを生成"""
+    def _upper_body_mask_image(self, image_size: Tuple[int, int], face_regions: List[Tuple[int, int, int, int]], resize_ratio: float = 1.0) -> Image.Image:
+        """上半身（顔〜肩周り）を覆うマスク画像を生成"""
         from PIL import ImageDraw
-        width, height = image_size
-        mask = Image.new('L', (width, height), 0)
+        mask = Image.new('L', image_size, 0)
         draw = ImageDraw.Draw(mask)
         for (x, y, w, h) in face_regions:
             # リサイズ比率に応じて座標を調整
-            x = int(x * resize_ratio)
-            y = int(y * resize_ratio)
-            w = int(w * resize_ratio)
-            h = int(h * resize_ratio)
-            
-            pad = int(min(w, h) * 0.60)  # 余白をやや拡大
-            x0 = max(0, x - pad)
-            y0 = max(0, y - pad)
-            x1 = min(width, x + w + pad)
-            # 下側は胸〜肩が確実に含まれるように更に拡張
-            y1 = min(height, y + int(h * 2.6))
-            draw.rectangle([x0, y0, x1, y1], fill=255)
+            region = (int(x * resize_ratio), int(y * resize_ratio), int(w * resize_ratio), int(h * resize_ratio))
+            draw.rectangle(list(self._upper_body_box(region, image_size)), fill=255)
+        return mask
+
+    def _create_upper_body_mask(self, image_size: Tuple[int, int], face_regions: List[Tuple[int, int, int, int]], resize_ratio: float = 1.0) -> str:
+        """上半身（顔〜肩周り）を覆うマスクを生成"""
+        mask = self._upper_body_mask_image(image_size, face_regions, resize_ratio)
         buf = io.BytesIO()
         mask.save(buf, format='PNG')
         return base64.b64encode(buf.getvalue()).decode('utf-8')
 
+    @staticmethod
+    def _imagen_prompt(prompt: str) -> str:
+        """Imagen 3へ送るプロンプト（元画像の構図・人物・背景の維持を指示）"""
+        return f"{prompt} The image should maintain the exact same composition, lighting, and visual style as the original photograph. Keep the same person's appearance, clothing, and background setting unchanged."
+
     def _inpaint_full_image_with_imagen(
-        self, image: Image.Image, mask_b64: Optional[str], prompt: str
+        self, image: Image.Image, mask_b64: Optional[str], prompt: str, deadline: Optional[Deadline] = None
     ) -> Optional[Image.Image]:
         try:
             client_options = {"api_endpoint": f"{Config.IMAGEN_REGION}-aiplatform.googleapis.com"}
             model_name = getattr(Config, 'IMAGEN_MODEL', 'imagen-3.0-generate-001')
 
-            # Generative AI Images API (Imagen 3) 経由で実行
-            vertexai.init(project=Config.PROJECT_ID, location=Config.IMAGEN_REGION)
-            gen_model = ImageGenerationModel.from_pretrained(model_name)
             # ベース画像（PIL.Imageをそのまま渡す）
             base_pil = image.convert('RGB')
 
@@ -421,14 +654,23 @@ class AIImageEditor:
             image_b64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
             
             # プロンプトに元画像の詳細な情報を追加（Imagen 3用）
-            enhanced_prompt = f"{prompt} The image should maintain the exact same composition, lighting, and visual style as the original photograph. Keep the same person's appearance, clothing, and background setting unchanged."
+            enhanced_prompt = self._imagen_prompt(prompt)
             
+            if deadline is not None:
+                # 期限がある場合はSDKを介さず予測APIへ残り時間のタイムアウトを渡す
+                return self._predict_imagen(model_name, enhanced_prompt, deadline)
+
+            # Generative AI Images API (Imagen 3) 経由で実行
+            vertexai.init(project=Config.PROJECT_ID, location=Config.IMAGEN_REGION)
+            gen_model = ImageGenerationModel.from_pretrained(model_name)
             try:
                 # テキスト生成で画像編集を試行
                 images = gen_model.generate_images(
                     prompt=enhanced_prompt,
                     number_of_images=1,
                 )
+            except DeadlineExceeded:
+                raise
             except Exception as e_generate:
                 raise Exception(f"generate_images failed: {e_generate}")
 
@@ -442,14 +684,52 @@ class AIImageEditor:
                     return gen_img.image
             raise Exception("Empty predictions from Generative Images API")
 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             # 失敗時はスタックトレースと可能ならレスポンス/エラー本体を含める
             tb = traceback.format_exc(limit=5)
             detail = getattr(e, 'message', str(e))
             raise Exception(f"Imagen API prediction failed: {detail} | traceback={tb}")
     
+    @staticmethod
+    def _sdxl_request(image: Image.Image, mask_b64: str, prompt: str) -> Tuple[str, List[Dict], Dict]:
+        """SDXL Inpaintingの予測リクエスト (エンドポイント名, instances, parameters)"""
+        # 画像をBase64エンコード
+        img_byte_arr = io.BytesIO()
+        image.convert('RGB').save(img_byte_arr, format='JPEG', quality=Config.JPEG_QUALITY)
+        image_b64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+        
+        # リクエスト用のインスタンスを作成
+        instances = [
+            {
+                "prompt": prompt,
+                "image": {
+                    "bytesBase64Encoded": image_b64
+                },
+                "mask": {
+                    "image": {
+                        "bytesBase64Encoded": mask_b64
+                    }
+                }
+            }
+        ]
+        
+        # パラメータ設定
+        parameters = {
+            "sampleCount": 1,
+            "aspectRatio": "1:1",
+            "safetyFilterLevel": "block_some",
+            "personGeneration": "allow_adult",
+            "action": "inpaint"
+        }
+        
+        # エンドポイント名
+        endpoint_name = f"projects/{Config.PROJECT_ID}/locations/{Config.SDXL_REGION}/publishers/google/models/{Config.SDXL_MODEL}"
+        return endpoint_name, instances, parameters
+
     def _inpaint_with_sdxl(
-        self, image: Image.Image, mask_b64: str, prompt: str
+        self, image: Image.Image, mask_b64: str, prompt: str, deadline: Optional[Deadline] = None
     ) -> Optional[Image.Image]:
         """Vertex Model Garden SDXL Inpaintingを使用した画像編集"""
         try:
@@ -457,46 +737,26 @@ class AIImageEditor:
             client_options = {"api_endpoint": f"{Config.SDXL_REGION}-aiplatform.googleapis.com"}
             client = aiplatform_v1beta1.PredictionServiceClient(client_options=client_options)
             
-            # 画像をBase64エンコード
-            img_byte_arr = io.BytesIO()
-            image.convert('RGB').save(img_byte_arr, format='JPEG', quality=Config.JPEG_QUALITY)
-            image_b64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-            
-            # リクエスト用のインスタンスを作成
-            instances = [
-                {
-                    "prompt": prompt,
-                    "image": {
-                        "bytesBase64Encoded": image_b64
-                    },
-                    "mask": {
-                        "image": {
-                            "bytesBase64Encoded": mask_b64
-                        }
-                    }
-                }
-            ]
-            
-            # パラメータ設定
-            parameters = {
-                "sampleCount": 1,
-                "aspectRatio": "1:1",
-                "safetyFilterLevel": "block_some",
-                "personGeneration": "allow_adult",
-                "action": "inpaint"
-            }
-            
-            # エンドポイント名
-            endpoint_name = f"projects/{Config.PROJECT_ID}/locations/{Config.SDXL_REGION}/publishers/google/models/{Config.SDXL_MODEL}"
-            
-            # 予測リクエストを送信（タイムアウト設定を延長）
-            from google.api_core import timeout
-            response = client.predict(
-                endpoint=endpoint_name,
-                instances=instances,
-                parameters=parameters,
-                timeout=timeout.ExponentialTimeout(initial=60, maximum=120, multiplier=1.0)
-            )
+            endpoint_name, instances, parameters = self._sdxl_request(image, mask_b64, prompt)
+
+            # 予測リクエストを送信（タイムアウト設定を延長、期限がある場合は残り時間まで）
+            from google.api_core import timeout, exceptions as api_exceptions
+            if deadline is not None:
+                call_timeout = deadline.timeout(120)
+            else:
+                call_timeout = timeout.ExponentialTimeout(initial=60, maximum=120, multiplier=1.0)
+            try:
+                response = client.predict(
+                    endpoint=endpoint_name,
+                    instances=instances,
+                    parameters=parameters,
+                    timeout=call_timeout
+                )
+            except api_exceptions.DeadlineExceeded:
+                if deadline is None:
+                    raise
+                deadline.hit = True
+                raise DeadlineExceeded("Vertex AI call timed out before deadline")
             
             # レスポンスから画像を取得
             if response.predictions:
@@ -507,6 +767,8 @@ class AIImageEditor:
             
             raise Exception("Empty predictions from SDXL API")
             
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             tb = traceback.format_exc(limit=5)
             detail = getattr(e, 'message', str(e))
@@ -677,25 +939,159 @@ class AIImageEditor:
         return postcard_img
     
     
-    def edit_image_with_ai(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str = "bouquet") -> Dict:
-        """AIを使用して画像を編集"""
+    @staticmethod
+    def _edit_request_key(image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str, local_only: bool,
+                          album_id: Optional[str] = None) -> str:
+        """画像内容ハッシュ・顔領域・編集タイプ・アルバムから同一リクエスト判定用のキーを生成
+
+        近似重複の再利用はアルバム単位のため、アルバムが異なるリクエストは集約しない。
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{image.mode}:{image.size}".encode('utf-8'))
+        digest.update(image.tobytes())
+        digest.update(repr([tuple(int(v) for v in r) for r in face_regions]).encode('utf-8'))
+        digest.update(f"{edit_type}:{local_only}:{album_id}".encode('utf-8'))
+        return digest.hexdigest()
+
+    @traced("editor.edit")
+    def edit_image_with_ai(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str = "bouquet", local_only: bool = False, deadline: Optional[Deadline] = None,
+                          album_id: Optional[str] = None) -> Dict:
+        """AIを使用して画像を編集（同一内容の同時リクエストは先行呼び出しの結果を共有）
+
+        deadlineを指定すると、期限内に完了できないVertex AI呼び出しは打ち切りフォールバック描画で応答する。
+        album_idを指定すると、同じアルバムの近似重複の編集結果を再利用する（未指定なら再利用しない）。
+        """
+        if edit_type in LocalAnonymizer.MODES:
+            # ローカル匿名化はミリ秒で終わるため集約・Vertex AI呼び出しを行わない
+            return {
+                "image": self.local_anonymizer.anonymize(image, face_regions, edit_type),
+                "fallback_used": False,
+                "error_message": None,
+                "coalesced": False
+            }
+        key = self._edit_request_key(image, face_regions, edit_type, local_only, album_id)
+        try:
+            result, coalesced = self._single_flight.do(
+                key,
+                lambda: self._edit_image_with_ai(image, face_regions, edit_type, local_only, deadline, album_id),
+                wait_timeout=deadline.remaining() if deadline is not None else None
+            )
+        except TimeoutError:
+            # 先行呼び出しが自分の期限内に終わらない場合は待たずにフォールバック描画
+            deadline.hit = True
+            result, coalesced = self._edit_image_locally(image, face_regions, edit_type, "DEADLINE_EXCEEDED"), True
+        result = dict(result)
+        result["coalesced"] = coalesced
+        if deadline is not None:
+            result["deadline"] = deadline.describe(result["fallback_used"])
+        return result
+
+    def _edit_image_with_ai(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str, local_only: bool,
+                            deadline: Optional[Deadline] = None, album_id: Optional[str] = None) -> Dict:
+        """AIを使用して画像を編集（local_only=TrueならVertex AIを呼ばずフォールバック描画のみ）"""
+        if local_only:
+            return self._edit_image_locally(image, face_regions, edit_type, "LOCAL_ONLY")
+        reused = self._reuse_near_duplicate(image, face_regions, edit_type, album_id)
+        if reused is not None:
+            return reused
+        # ルーターの判断（バックエンドの試行順・省略・採用）をレスポンスへ含める
+        routing: List[Dict] = []
+        try:
+            result = self._edit_image_with_vertex(image, face_regions, edit_type, deadline, routing)
+        except DeadlineExceeded as e:
+            print(f"Deadline exceeded, using fallback: {e}")
+            result = self._edit_image_locally(image, face_regions, edit_type, "DEADLINE_EXCEEDED")
+        else:
+            if not result["fallback_used"]:
+                self._remember_near_duplicate(image, face_regions, edit_type, result["image"], album_id)
+        result["routing"] = routing
+        return result
+
+    @staticmethod
+    def _near_duplicate_target(edit_type: str, album_id: Optional[str]) -> bool:
+        """近似重複の再利用対象か（顔パッチの移植で再現できる編集のみ。他人の顔パッチを移植しないようアルバム指定時に限る）"""
+        return near_duplicate_index is not None and bool(album_id) and edit_type in ("bouquet", "postcard")
+
+    @traced("editor.near_duplicate")
+    def _reuse_near_duplicate(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str,
+                              album_id: Optional[str]) -> Optional[Dict]:
+        """同じアルバムに近似重複の編集結果があれば、顔ごとのパッチを新しい画像の顔位置へ移植した結果を返す"""
+        if not self._near_duplicate_target(edit_type, album_id):
+            return None
+        match = near_duplicate_index.lookup(album_id, image, face_regions, edit_type)
+        if match is None:
+            return None
+        entry, pairs, distance = match
+        return {
+            "image": self._warp_patches(image, face_regions, entry.face_regions, entry.patches, pairs),
+            "fallback_used": False,
+            "error_message": None,
+            "routing": [],
+            "near_duplicate": {"distance": distance, "source": entry.id}
+        }
+
+    def _remember_near_duplicate(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str,
+                                 result_image: Image.Image, album_id: Optional[str]) -> None:
+        """Vertex AIの編集結果から顔ごとの上半身パッチを切り出してアルバムの索引へ登録"""
+        if not self._near_duplicate_target(edit_type, album_id) or not face_regions:
+            return
+        result_image = result_image.convert('RGB')
+        if result_image.size != image.size:
+            # 全体編集ではモデル入力サイズで返るため元画像の座標へ戻す
+            result_image = result_image.resize(image.size, Image.Resampling.LANCZOS)
+        patches = []
+        for region in face_regions:
+            box = self._upper_body_box(region, image.size)
+            patches.append((box, result_image.crop(box)))
+        near_duplicate_index.add(album_id, image, face_regions, edit_type, patches)
+
+    def _warp_patches(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]],
+                      source_regions: List[Tuple[int, int, int, int]],
+                      patches: List[Tuple[Tuple[int, int, int, int], Image.Image]], pairs: List[int]) -> Image.Image:
+        """対応する顔の位置・大きさに合わせてパッチを拡縮・平行移動し、ぼかしマスクで合成"""
+        from PIL import ImageFilter
+
+        base = image.convert('RGB')
+        for (x, y, w, h), index in zip(face_regions, pairs):
+            sx0, sy0, sw, sh = source_regions[index]
+            (bx0, by0, bx1, by1), patch = patches[index]
+            scale_x, scale_y = w / float(sw), h / float(sh)
+            left = int(round(x + (bx0 - sx0) * scale_x))
+            top = int(round(y + (by0 - sy0) * scale_y))
+            size = (max(1, int(round((bx1 - bx0) * scale_x))), max(1, int(round((by1 - by0) * scale_y))))
+            warped = patch.resize(size, Image.Resampling.LANCZOS)
+            blend_mask = self._upper_body_mask_image(size, [(x - left, y - top, w, h)])
+            feather = max(1, int(min(size) * Config.INPAINT_REGION_FEATHER))
+            base.paste(warped, (left, top), blend_mask.filter(ImageFilter.GaussianBlur(feather)))
+        return base
+
+    @traced("editor.local_fallback")
+    def _local_fallback(self, render, image: Image.Image, face_regions: List[Tuple[int, int, int, int]]) -> Image.Image:
+        """フォールバック描画を実行し、ルーターにローカル描画の所要時間を記録"""
+        started = time.monotonic()
+        result_image = render(image, face_regions)
+        model_router.record("local", True, (time.monotonic() - started) * 1000)
+        return result_image
+
+    def _edit_image_with_vertex(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str, deadline: Optional[Deadline], routing: Optional[List[Dict]] = None) -> Dict:
+        """Vertex AIで編集し、失敗時はフォールバック描画（期限超過はDeadlineExceededで呼び出し元へ）"""
         if edit_type == "bouquet":
-            result_image, error_message = self.generate_piece_overlay(image, face_regions)
+            result_image, error_message = self.generate_piece_overlay(image, face_regions, deadline, routing)
             fallback_used = error_message is not None
             if fallback_used:
                 # フォールバック描画を実行
-                result_image = self._fallback_piece_generation(image, face_regions)
+                result_image = self._local_fallback(self._fallback_piece_generation, image, face_regions)
             return {
                 "image": result_image,
                 "fallback_used": fallback_used,
                 "error_message": error_message
             }
         elif edit_type == "postcard":
-            result_image, error_message = self.generate_postcard_overlay(image, face_regions)
+            result_image, error_message = self.generate_postcard_overlay(image, face_regions, deadline, routing)
             fallback_used = error_message is not None
             if fallback_used:
                 # フォールバック描画を実行
-                result_image = self._fallback_postcard_generation(image, face_regions)
+                result_image = self._local_fallback(self._fallback_postcard_generation, image, face_regions)
             return {
                 "image": result_image,
                 "fallback_used": fallback_used,
@@ -714,3 +1110,15 @@ class AIImageEditor:
             }
         else:
             raise Exception(f"サポートされていない編集タイプ: {edit_type}")
+
+    def _edit_image_locally(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str, reason: str) -> Dict:
+        """Vertex AIを呼ばずにフォールバック描画のみで編集"""
+        if edit_type == "postcard":
+            result_image = self._local_fallback(self._fallback_postcard_generation, image, face_regions)
+        else:
+            result_image = self._local_fallback(self._fallback_piece_generation, image, face_regions)
+        return {
+            "image": result_image,
+            "fallback_used": True,
+            "error_message": reason
+        }
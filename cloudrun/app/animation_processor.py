@@ -0,0 +1,158 @@
+"""アニメーションGIF等の複数フレーム画像の匿名化サービス"""
+import io
+from typing import Dict, List, Optional, Tuple
+from PIL import Image, GifImagePlugin
+from config import Config
+from tracing import traced
+from image_processor import ImageProcessor
+from local_anonymizer import LocalAnonymizer
+
+Region = Tuple[int, int, int, int]
+
+
+class _GifStreamWriter:
+    """フレームを1枚ずつGIFへ書き出すライター（全フレームをメモリに保持しない）"""
+
+    def __init__(self, loop: Optional[int]):
+        self._buf = io.BytesIO()
+        self._loop = loop
+        self._started = False
+        self.frames = 0
+
+    def add(self, frame: Image.Image, duration: int) -> None:
+        """RGBフレームを減色して追記（各フレームにローカルカラーテーブルを付与）"""
+        frame_p = frame.convert('RGB').quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        if not self._started:
+            info = {"duration": duration}
+            if self._loop is not None:
+                info["loop"] = self._loop
+            header, _ = GifImagePlugin.getheader(frame_p, info=info)
+            for chunk in header:
+                self._buf.write(chunk)
+            self._started = True
+        for chunk in GifImagePlugin.getdata(frame_p, (0, 0), duration=duration, include_color_table=True):
+            self._buf.write(chunk)
+        self.frames += 1
+
+    def finish(self) -> bytes:
+        """トレーラーを書き込みGIFバイト列を返す"""
+        self._buf.write(b";")
+        return self._buf.getvalue()
+
+
+class AnimationProcessor:
+    """キーフレームのみ顔検出し、間のフレームは矩形を補間してローカル描画で匿名化するクラス"""
+
+    def __init__(self, face_detector, ai_image_editor=None):
+        """複数フレーム処理サービスの初期化（ai_image_editor未指定時はぼかし/モザイク/塗りつぶしのみ）"""
+        self.face_detector = face_detector
+        self.ai_image_editor = ai_image_editor
+        self.local_anonymizer = LocalAnonymizer()
+
+    @staticmethod
+    def is_animated(image: Image.Image) -> bool:
+        """複数フレームを持つ画像か判定"""
+        return bool(getattr(image, 'is_animated', False)) and getattr(image, 'n_frames', 1) > 1
+
+    @staticmethod
+    def _pad(region: Region, size: Tuple[int, int]) -> Region:
+        """補間誤差・動きを吸収するため矩形を拡張"""
+        x, y, w, h = region
+        pad_w = int(w * Config.ANIMATION_TRACK_PAD)
+        pad_h = int(h * Config.ANIMATION_TRACK_PAD)
+        x0 = max(0, x - pad_w)
+        y0 = max(0, y - pad_h)
+        x1 = min(size[0], x + w + pad_w)
+        y1 = min(size[1], y + h + pad_h)
+        return (x0, y0, max(1, x1 - x0), max(1, y1 - y0))
+
+    @staticmethod
+    def _match(start: List[Region], end: List[Region]) -> Tuple[List[Tuple[Region, Region]], List[Region]]:
+        """前後キーフレームの矩形を中心距離で貪欲に対応付け (対応ペア, 未対応矩形) を返す"""
+        def center(r: Region) -> Tuple[float, float]:
+            return (r[0] + r[2] / 2.0, r[1] + r[3] / 2.0)
+
+        candidates = []
+        for i, a in enumerate(start):
+            for j, b in enumerate(end):
+                (ax, ay), (bx, by) = center(a), center(b)
+                dist = ((ax - bx) ** 2 + (ay - by) ** 2) ** 0.5
+                # 顔サイズ以上離れたものは別人とみなす
+                if dist <= max(a[2], a[3], b[2], b[3]):
+                    candidates.append((dist, i, j))
+        candidates.sort()
+        used_start, used_end = set(), set()
+        pairs = []
+        for _, i, j in candidates:
+            if i in used_start or j in used_end:
+                continue
+            used_start.add(i)
+            used_end.add(j)
+            pairs.append((start[i], end[j]))
+        unmatched = [r for i, r in enumerate(start) if i not in used_start]
+        unmatched += [r for j, r in enumerate(end) if j not in used_end]
+        return pairs, unmatched
+
+    def _interpolate(self, start: List[Region], end: List[Region], t: float) -> List[Region]:
+        """キーフレーム間の位置tにおける矩形を線形補間（未対応の矩形は安全側で残す）"""
+        pairs, unmatched = self._match(start, end)
+        regions = []
+        for a, b in pairs:
+            regions.append(tuple(int(round(av + (bv - av) * t)) for av, bv in zip(a, b)))
+        return regions + unmatched
+
+    @traced("animation.anonymize")
+    def anonymize(self, image: Image.Image, edit_type: str) -> Dict:
+        """全フレームを逐次デコード→匿名化→GIF再エンコードする
+
+        保持するのは直近キーフレーム間のフレーム（最大ANIMATION_KEYFRAME_INTERVAL枚）のみ。
+        """
+        n_frames = getattr(image, 'n_frames', 1)
+        interval = max(1, Config.ANIMATION_KEYFRAME_INTERVAL)
+        writer = _GifStreamWriter(image.info.get('loop'))
+        pending: List[Tuple[Image.Image, int]] = []
+        prev_regions: Optional[List[Region]] = None
+        first_frame: Optional[Image.Image] = None
+        max_faces = 0
+        keyframes = 0
+
+        def emit(frame: Image.Image, duration: int, regions: List[Region]) -> None:
+            nonlocal first_frame
+            padded = [self._pad(r, frame.size) for r in regions]
+            if padded and edit_type in LocalAnonymizer.MODES:
+                frame = self.local_anonymizer.anonymize(frame, padded, edit_type)
+            elif padded:
+                frame = self.ai_image_editor.edit_image_with_ai(frame, padded, edit_type, local_only=True)["image"]
+            if first_frame is None:
+                first_frame = frame
+            writer.add(frame, duration)
+
+        for index in range(n_frames):
+            image.seek(index)
+            duration = int(image.info.get('duration', 100))
+            # convertで現フレームを独立したRGB画像として取り出し、長辺を設定値まで縮小
+            frame = ImageProcessor.downscale_if_needed(image.convert('RGB'))
+
+            if index % interval != 0 and index != n_frames - 1:
+                pending.append((frame, duration))
+                continue
+
+            regions = self.face_detector.get_face_regions_from_image(frame)
+            keyframes += 1
+            max_faces = max(max_faces, len(regions))
+            start = prev_regions if prev_regions is not None else regions
+            for offset, (buffered, buffered_duration) in enumerate(pending, start=1):
+                t = offset / float(len(pending) + 1)
+                emit(buffered, buffered_duration, self._interpolate(start, regions, t))
+            pending = []
+            emit(frame, duration, regions)
+            prev_regions = regions
+
+        return {
+            "data": writer.finish(),
+            "format": "GIF",
+            "first_frame": first_frame,
+            "frames": writer.frames,
+            "keyframes": keyframes,
+            "faces_detected": max_faces,
+        }
@@ -1,10 +1,37 @@
 """メインアプリケーションファイル"""
+import threading
+import time
 from flask import Flask, render_template
 from config import Config
-from routes import api
+
+# routes（GCS・Vertex AI・キャッシュ等のサービスを生成する）はcreate_app()内でimportする。
+# 顔検出のワーカープロセス（spawn）はメインモジュールを再importするため、ここで生成するとワーカーごとに
+# クライアント生成・キャッシュの初期化が行われてしまう。
+
+def _reconcile_image_index(initial: bool):
+    """画像索引をバケットと突き合わせ、以降IMAGE_INDEX_RECONCILE_INTERVAL_SEC秒ごとに繰り返す
+
+    索引はインスタンスごとのSQLiteのため、他インスタンスのアップロード・削除は次回の突き合わせで反映される。
+    """
+    from routes import storage_service
+
+    interval = Config.IMAGE_INDEX_RECONCILE_INTERVAL_SEC
+    while True:
+        if initial:
+            try:
+                storage_service.reconcile_index()
+            except Exception as e:
+                print(f"Image index reconcile failed: {e}")
+        if interval <= 0:
+            return
+        initial = True
+        time.sleep(interval)
 
 def create_app():
     """Flaskアプリケーションのファクトリー関数"""
+    from routes import api
+    from image_index import image_index
+
     app = Flask(__name__, static_folder='static', template_folder='templates')
     
     # 設定の検証
@@ -13,6 +40,11 @@ def create_app():
     # ブループリントを登録（/api配下にマウント）
     app.register_blueprint(api, url_prefix='/api')
 
+    # 画像索引が空（新しいインスタンス）ならバケットから非同期に再構築し、以降は定期的に突き合わせる
+    initial = Config.IMAGE_INDEX_RECONCILE_ON_START and image_index.is_empty()
+    if initial or Config.IMAGE_INDEX_RECONCILE_INTERVAL_SEC > 0:
+        threading.Thread(target=_reconcile_image_index, args=(initial,), daemon=True).start()
+
     # グローバル例外ハンドラ（未捕捉例外でも200でJSONを返す）
     @app.errorhandler(Exception)
     def handle_unhandled_error(e):
@@ -34,5 +66,10 @@ def create_app():
     return app
 
 if __name__ == '__main__':
-    app = create_app()
-    app.run(host='0.0.0.0', port=Config.PORT, debug=Config.DEBUG)
+    if Config.SERVER_MODE == 'asgi':
+        # AI編集の待ち時間をasyncioで保持するASGIサーバー（asgi.py）
+        import uvicorn
+        uvicorn.run("asgi:app", host='0.0.0.0', port=Config.PORT)
+    else:
+        app = create_app()
+        app.run(host='0.0.0.0', port=Config.PORT, debug=Config.DEBUG)
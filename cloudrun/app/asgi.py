@@ -0,0 +1,285 @@
+"""ASGIアプリケーション（AI編集はasyncioで処理し、その他のリクエストはFlaskアプリへ委譲）
+
+使い方:
+    SERVER_MODE=asgi python app.py
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+/api/mask-faces と /api/ai-edit の花束・ポストカード編集（静止画）は、Vertex AIの応答待ち・
+リトライ間隔・クォータ待ちをawaitで処理し、デコード・顔検出・合成はスレッドプールで実行する。
+それ以外（ローカル匿名化・アニメーション・その他のエンドポイント）はFlaskアプリをスレッドで実行する。
+"""
+import asyncio
+import functools
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from config import Config
+from app import create_app
+import routes
+from async_editor import AsyncAIEditor
+from deadline import Deadline
+from metrics import metrics
+import tracing
+
+# asyncioで処理するエンドポイント
+ASYNC_EDIT_PATHS = ("/api/mask-faces", "/api/ai-edit")
+
+Response = Tuple[int, List[Tuple[bytes, bytes]], bytes]
+
+
+def _json_response(status: int, payload: Dict, extra_headers: Optional[Dict[str, str]] = None) -> Response:
+    headers = [(b"content-type", b"application/json")]
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    return status, headers, json.dumps(payload).encode('utf-8')
+
+
+class AsgiApp:
+    """ASGIのエントリポイント"""
+
+    def __init__(self, wsgi_app):
+        """ASGIアプリの初期化（Flaskアプリと同じサービスインスタンスを共有）"""
+        self.wsgi_app = wsgi_app
+        self.editor = AsyncAIEditor(routes.ai_image_editor)
+        self._wsgi_executor = ThreadPoolExecutor(max_workers=Config.ASGI_WSGI_WORKERS, thread_name_prefix="asgi-wsgi")
+        # GCSのクライアントにasyncio版が無いため、アップロードは専用スレッドで実行
+        self._io_executor = ThreadPoolExecutor(max_workers=Config.ASGI_IO_WORKERS, thread_name_prefix="asgi-io")
+        self._inflight_edits = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        body = await self._read_body(receive)
+        response = None
+        if scope["method"] == "POST" and scope["path"] in ASYNC_EDIT_PATHS:
+            response = await self._async_edit(scope, body)
+        if response is None:
+            response = await self._call_wsgi(scope, body)
+        status, headers, content = response
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
+
+    @staticmethod
+    async def _lifespan(receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def _run_io(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, tracing.wrap_context(functools.partial(fn, *args)))
+
+    @staticmethod
+    def _header(scope, name: bytes) -> Optional[str]:
+        for key, value in scope["headers"]:
+            if key == name:
+                return value.decode('latin-1')
+        return None
+
+    @staticmethod
+    def _resolve_edit_type(path: str, data: Dict) -> str:
+        if path == "/api/mask-faces":
+            return routes._resolve_mask_edit_type(data.get('edit_type', 1))
+        return data.get('edit_type', 'peace_sign')
+
+    @staticmethod
+    def _load_image(image_b64: str):
+        """Base64画像をデコードして検証"""
+        image = routes.image_processor.decode_base64_image(image_b64)
+        routes.image_processor.validate_image(image)
+        return image
+
+    async def _async_edit(self, scope, body: bytes) -> Optional[Response]:
+        """花束・ポストカードのAI編集をasyncioで処理（対象外ならNoneを返しFlaskへ委譲）"""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or 'image' not in data:
+            return None
+        path = scope["path"]
+        edit_type = self._resolve_edit_type(path, data)
+        if edit_type not in ("bouquet", "postcard"):
+            return None
+
+        if self._inflight_edits >= Config.ASGI_MAX_INFLIGHT_EDITS:
+            metrics.increment("asgi.rejected")
+            return _json_response(429, {
+                "status": "error",
+                "message": "server_busy",
+                "reason": "inflight_limit",
+                "retry_after": Config.AI_RETRY_AFTER_SEC
+            }, {"Retry-After": str(Config.AI_RETRY_AFTER_SEC)})
+
+        started = time.monotonic()
+        trace_id = self._header(scope, b"x-trace-id") or tracing.new_trace_id()
+        self._inflight_edits += 1
+        metrics.set_gauge("asgi.inflight_edits", self._inflight_edits)
+        try:
+            with tracing.start_trace(f"POST {path}", trace_id, server="asgi"):
+                response = await self._edit(path, data, edit_type, started, self._header(scope, b"accept") or "")
+        finally:
+            self._inflight_edits -= 1
+            metrics.set_gauge("asgi.inflight_edits", self._inflight_edits)
+        if response is not None:
+            response[1].append((b"x-trace-id", trace_id.encode('latin-1')))
+        return response
+
+    async def _edit(self, path: str, data: Dict, edit_type: str, started: float, accept: str) -> Optional[Response]:
+        """デコード→検出→編集→公開（レスポンスはFlaskの同名エンドポイントと同じ形式）"""
+        run_cpu = self.editor.run_cpu
+        is_mask_faces = path == "/api/mask-faces"
+        try:
+            image = await run_cpu(self._load_image, data['image'])
+            if routes.animation_processor.is_animated(image):
+                return None
+            image = await run_cpu(routes.image_processor.process_image, image)
+            face_regions = await run_cpu(
+                routes.face_detector.get_face_regions_from_image, image, None, data.get('detector_backend')
+            )
+            if not face_regions:
+                image_info = routes.image_processor.get_image_info(image)
+                if is_mask_faces:
+                    return _json_response(200, {
+                        "status": "error",
+                        "message": "顔が検出されませんでした",
+                        "faces_detected": 0,
+                        "image_info": image_info,
+                        "fallback_used": True,
+                        "debug_error": "NO_FACES"
+                    })
+                return _json_response(400, {
+                    "status": "error",
+                    "message": "顔が検出されませんでした",
+                    "faces_detected": 0,
+                    "image_info": image_info
+                })
+
+            edit_result = await self.editor.edit_image_with_ai(
+                image, face_regions, edit_type, Deadline.from_request(data.get('deadline_ms'), started),
+                routes._album_id(data)
+            )
+            edited_image = edit_result["image"]
+            image_info = routes.image_processor.get_image_info(edited_image)
+            image_info["faces_detected"] = len(face_regions)
+            image_info["face_regions"] = face_regions
+            if not is_mask_faces:
+                image_info["edit_type"] = edit_type
+
+            filename = data.get('filename', 'masked_image' if is_mask_faces else 'ai_edited_image')
+            upload_result = await self._run_io(routes._publish_result, edited_image, filename, data, {
+                "edit_type": edit_type,
+                "faces_detected": len(face_regions),
+                "fallback_used": edit_result["fallback_used"]
+            }, accept)
+            return _json_response(200, {
+                "status": "success",
+                "image_info": image_info,
+                "signed_url": upload_result.get("signed_url"),
+                "blob_name": upload_result["blob_name"],
+                "data_url": upload_result.get("data_url"),
+                "download_url": upload_result.get("download_url"),
+                "message": (f"{len(face_regions)}個の顔を花束で隠しました" if is_mask_faces
+                            else f"{len(face_regions)}個の顔を{edit_type}で編集しました"),
+                "faces_detected": len(face_regions),
+                "fallback_used": edit_result["fallback_used"],
+                "debug_error": edit_result["error_message"],
+                "coalesced": edit_result["coalesced"],
+                "deadline": edit_result.get("deadline"),
+                "routing": edit_result.get("routing"),
+                "near_duplicate": edit_result.get("near_duplicate")
+            })
+        except Exception as e:
+            if is_mask_faces:
+                # 500を返さず、UIが扱えるJSONで返す
+                return _json_response(200, {
+                    "status": "error",
+                    "message": "processing_failed",
+                    "fallback_used": True,
+                    "debug_error": str(e)
+                })
+            return _json_response(500, {"status": "error", "message": str(e)})
+
+    @staticmethod
+    def _environ(scope, body: bytes) -> Dict:
+        """ASGIのscopeからWSGIのenviron を組み立てる"""
+        server = scope.get("server") or ("localhost", Config.PORT)
+        client = scope.get("client")
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode('utf-8').decode('latin-1'),
+            "PATH_INFO": scope["path"].encode('utf-8').decode('latin-1'),
+            "QUERY_STRING": scope.get("query_string", b"").decode('latin-1'),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0] if client else "",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == "content-length":
+                continue
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+                continue
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _run_wsgi(self, environ: Dict) -> Response:
+        started: Dict = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return chunks.append
+
+        chunks: List[bytes] = []
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                chunks.append(chunk)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return started["status"], started["headers"], b"".join(chunks)
+
+    async def _call_wsgi(self, scope, body: bytes) -> Response:
+        """Flaskアプリをスレッドで実行（アドミッション制御等は従来どおりFlask側で適用）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._wsgi_executor, self._run_wsgi, self._environ(scope, body))
+
+
+def create_asgi_app() -> AsgiApp:
+    """ASGIアプリケーションのファクトリー関数"""
+    return AsgiApp(create_app())
+
+
+app = create_asgi_app()
@@ -0,0 +1,215 @@
+"""Vertex AI呼び出し・待機をawaitするAI編集（ASGI経路用）"""
+import asyncio
+import base64
+import functools
+import io
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+from config import Config
+from ai_image_editor import AIImageEditor, VariantAttempts
+from deadline import Deadline, DeadlineExceeded
+from quota_governor import quota_governor
+from tracing import span, wrap_context
+
+
+class AsyncAIEditor:
+    """AIImageEditorのマスク生成・合成・フォールバック描画を再利用し、外部呼び出しと待機のみをawaitするクラス
+
+    Vertex AIの応答待ち・リトライ間隔・クォータ待ちの間はスレッドを占有しないため、1インスタンスで
+    多数の低速なAI編集を同時に保持できる。CPU処理（マスク生成・リサイズ・合成・エンコード）は
+    ASGI_CPU_WORKERSのスレッドプールで実行する。
+    """
+
+    def __init__(self, editor: AIImageEditor):
+        """非同期編集の初期化（クライアントはイベントループ上で初回利用時に生成）"""
+        self.editor = editor
+        self._cpu_executor = ThreadPoolExecutor(max_workers=Config.ASGI_CPU_WORKERS, thread_name_prefix="asgi-cpu")
+        self._clients: Dict[str, object] = {}
+        # 同一画像・同一編集の同時リクエストは先行タスクの結果を共有
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def run_cpu(self, fn, *args):
+        """CPU処理をスレッドプールで実行（トレース文脈を引き継ぐ）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._cpu_executor, wrap_context(functools.partial(fn, *args)))
+
+    def _client(self, region: str):
+        if region not in self._clients:
+            from google.cloud import aiplatform_v1beta1
+
+            self._clients[region] = aiplatform_v1beta1.PredictionServiceAsyncClient(
+                client_options={"api_endpoint": f"{region}-aiplatform.googleapis.com"}
+            )
+        return self._clients[region]
+
+    @staticmethod
+    def _decode_prediction(response) -> Image.Image:
+        if response.predictions:
+            prediction = response.predictions[0]
+            if 'bytesBase64Encoded' in prediction:
+                image = Image.open(io.BytesIO(base64.b64decode(prediction['bytesBase64Encoded'])))
+                image.load()
+                return image
+        raise Exception("Empty predictions from Vertex AI")
+
+    async def _predict(self, region: str, endpoint: str, instances: List[Dict], parameters: Dict,
+                       deadline: Optional[Deadline]) -> Image.Image:
+        """予測APIをawaitし、1枚目の画像を返す（期限がある場合は残り時間で打ち切り）"""
+        timeout = deadline.timeout(120) if deadline is not None else 120
+        call = self._client(region).predict(
+            endpoint=endpoint, instances=instances, parameters=parameters, timeout=timeout
+        )
+        try:
+            response = await asyncio.wait_for(call, timeout)
+        except asyncio.TimeoutError:
+            if deadline is not None:
+                deadline.hit = True
+            raise DeadlineExceeded("Vertex AI call timed out before deadline")
+        return await self.run_cpu(self._decode_prediction, response)
+
+    async def _imagen(self, prompt: str, deadline: Optional[Deadline]) -> Image.Image:
+        """Imagen 3（generate_imagesと同じくプロンプトのみで生成）"""
+        endpoint = (f"projects/{Config.PROJECT_ID}/locations/{Config.IMAGEN_REGION}"
+                    f"/publishers/google/models/{Config.IMAGEN_MODEL}")
+        instances = [{"prompt": self.editor._imagen_prompt(prompt)}]
+        return await self._predict(Config.IMAGEN_REGION, endpoint, instances, {"sampleCount": 1}, deadline)
+
+    async def _sdxl(self, image: Image.Image, mask_b64: str, prompt: str, deadline: Optional[Deadline]) -> Image.Image:
+        endpoint, instances, parameters = await self.run_cpu(self.editor._sdxl_request, image, mask_b64, prompt)
+        return await self._predict(Config.SDXL_REGION, endpoint, instances, parameters, deadline)
+
+    async def _inpaint_with_variants(self, image: Image.Image, mask_b64: Optional[str], prompts: List[str],
+                                     deadline: Optional[Deadline], routing: List[Dict]) -> Image.Image:
+        """AIImageEditor._inpaint_with_variantsのasyncio版（試行順・再試行・ルーター記録はVariantAttemptsで共有）"""
+        attempts = {
+            "imagen_A": lambda: self._imagen(prompts[0], deadline),
+            "imagen_B": lambda: self._imagen(prompts[1], deadline),
+            "imagen_C": lambda: self._imagen(prompts[2], deadline),
+        }
+        # SDXLはマスク必須
+        if mask_b64 is not None:
+            attempts["sdxl"] = lambda: self._sdxl(image, mask_b64, prompts[0], deadline)
+        plan = VariantAttempts(list(attempts), deadline, routing)
+        for step in plan.steps():
+            if not await quota_governor.acquire_async(step.quota_key, deadline):
+                plan.quota_skipped(step)
+                continue
+            if plan.begin(step):
+                await self._backoff(0.8, deadline)
+            try:
+                with span("editor.attempt", backend=step.backend, attempt=step.index + 1, retry=step.retry) as attempt_span:
+                    edited = await attempts[step.backend]()
+                    attempt_span.set("success", edited is not None)
+            except DeadlineExceeded:
+                plan.deadline_aborted(step)
+                raise
+            except Exception as inner:
+                if plan.failed(step, inner):
+                    await quota_governor.penalize_async(step.quota_key)
+                continue
+            if plan.finished(step, edited):
+                return edited
+        raise plan.exhausted()
+
+    @staticmethod
+    async def _backoff(seconds: float, deadline: Optional[Deadline]) -> None:
+        """リトライ前の待機（期限がある場合は期限内に収まる場合のみ待機）"""
+        if deadline is None:
+            await asyncio.sleep(seconds)
+        else:
+            await deadline.sleep_async(seconds)
+
+    async def _inpaint_face_regions(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]],
+                                    prompts: List[str], deadline: Optional[Deadline],
+                                    routing: List[Dict]) -> Image.Image:
+        """顔クラスタを最大INPAINT_CLUSTER_CONCURRENCY件ずつ並行に編集して合成"""
+        base = await self.run_cpu(image.convert, 'RGB')
+        clusters = self.editor._region_clusters(base.size, face_regions)
+        semaphore = asyncio.Semaphore(max(1, Config.INPAINT_CLUSTER_CONCURRENCY))
+
+        async def edit_cluster(cluster):
+            async with semaphore:
+                crop, crop_fit, mask_b64, local_regions = await self.run_cpu(self.editor._prepare_cluster, base, cluster)
+                edited = await self._inpaint_with_variants(crop_fit, mask_b64, prompts, deadline, routing)
+                return await self.run_cpu(self.editor._finish_cluster, crop, crop_fit, edited, local_regions)
+
+        tasks = [asyncio.ensure_future(edit_cluster(cluster)) for cluster in clusters]
+        try:
+            edited = await asyncio.gather(*tasks)
+        except BaseException:
+            # 1クラスタでも失敗すれば全体をフォールバックするため、残りのクラスタは送信しない
+            for task in tasks:
+                task.cancel()
+            raise
+        return await self.run_cpu(self.editor._composite_clusters, base, clusters, edited)
+
+    async def _generate(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str,
+                        deadline: Optional[Deadline], routing: List[Dict]) -> Tuple[Optional[Image.Image], Optional[str]]:
+        """generate_piece_overlay / generate_postcard_overlay のasyncio版"""
+        try:
+            prompts = self.editor._piece_prompts() if edit_type == "bouquet" else self.editor._postcard_prompts()
+            if self.editor._use_region_inpaint(face_regions):
+                return await self._inpaint_face_regions(image, face_regions, prompts, deadline, routing), None
+            fitted, resize_ratio = await self.run_cpu(self.editor._fit_for_model, image)
+            mask_b64 = None
+            if 'capability' not in Config.IMAGEN_MODEL:
+                mask_b64 = await self.run_cpu(self.editor._create_upper_body_mask, fitted.size, face_regions, resize_ratio)
+            return await self._inpaint_with_variants(fitted, mask_b64, prompts, deadline, routing), None
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            error_msg = f"Failed during image generation setup: {e}"
+            print(f"ERROR: {error_msg}")
+            return None, error_msg
+
+    async def _edit(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str,
+                    deadline: Optional[Deadline], album_id: Optional[str]) -> Dict:
+        reused = await self.run_cpu(self.editor._reuse_near_duplicate, image, face_regions, edit_type, album_id)
+        if reused is not None:
+            return reused
+        routing: List[Dict] = []
+        try:
+            result_image, error_message = await self._generate(image, face_regions, edit_type, deadline, routing)
+        except DeadlineExceeded as e:
+            print(f"Deadline exceeded, using fallback: {e}")
+            result = await self.run_cpu(self.editor._edit_image_locally, image, face_regions, edit_type, "DEADLINE_EXCEEDED")
+        else:
+            if error_message is not None:
+                render = (self.editor._fallback_postcard_generation if edit_type == "postcard"
+                          else self.editor._fallback_piece_generation)
+                result_image = await self.run_cpu(self.editor._local_fallback, render, image, face_regions)
+            else:
+                await self.run_cpu(self.editor._remember_near_duplicate, image, face_regions, edit_type, result_image, album_id)
+            result = {
+                "image": result_image,
+                "fallback_used": error_message is not None,
+                "error_message": error_message
+            }
+        result["routing"] = routing
+        return result
+
+    async def edit_image_with_ai(self, image: Image.Image, face_regions: List[Tuple[int, int, int, int]],
+                                 edit_type: str, deadline: Optional[Deadline] = None, album_id: Optional[str] = None) -> Dict:
+        """AIImageEditor.edit_image_with_aiのasyncio版（bouquet/postcardのみ）"""
+        if edit_type not in ("bouquet", "postcard"):
+            raise Exception(f"サポートされていない編集タイプ: {edit_type}")
+        key = await self.run_cpu(self.editor._edit_request_key, image, face_regions, edit_type, False, album_id)
+        task = self._inflight.get(key)
+        coalesced = task is not None
+        if task is None:
+            task = asyncio.ensure_future(self._edit(image, face_regions, edit_type, deadline, album_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        try:
+            timeout = deadline.remaining() if coalesced and deadline is not None else None
+            result = await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            # 先行タスクが自分の期限内に終わらない場合は待たずにフォールバック描画
+            deadline.hit = True
+            result = await self.run_cpu(self.editor._edit_image_locally, image, face_regions, edit_type, "DEADLINE_EXCEEDED")
+        result = dict(result)
+        result["coalesced"] = coalesced
+        if deadline is not None:
+            result["deadline"] = deadline.describe(result["fallback_used"])
+        return result
@@ -0,0 +1,205 @@
+"""ローカルの画像ディレクトリを一括匿名化するコマンドラインツール（HTTP層を経由しない）
+
+使い方:
+    python batch_anonymize.py <入力ディレクトリ> <出力ディレクトリ> [--edit-type blur] [--workers 8]
+        [--output-format jpeg] [--manifest <出力ディレクトリ>/.manifest.jsonl] [--local-only]
+
+入力ディレクトリ配下を再帰的に処理し、同じ相対パスで出力する。処理結果はマニフェスト（JSON Lines）に
+1画像1行で追記し、再実行時は同じ相対パス・同じ内容（SHA-256）・同じ編集タイプで成功済みの画像を省略する。
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import statistics
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from config import Config
+from image_processor import ImageProcessor
+from face_detector import FaceDetector
+from local_anonymizer import LocalAnonymizer
+from animation_processor import AnimationProcessor
+
+EDIT_TYPES = ('blur', 'pixelate', 'solid', 'bouquet', 'postcard')
+
+# ワーカープロセスごとのサービス（初期化時に1回だけ生成）
+_worker: Dict = {}
+
+
+def _init_worker(edit_type: str, local_only: bool, output_format: Optional[str]) -> None:
+    """ワーカープロセスの初期化（顔検出器はプロセスごとに1つ）"""
+    detector = FaceDetector()
+    editor = None
+    if edit_type not in LocalAnonymizer.MODES:
+        # Imagen/SDXLを使う編集タイプのみVertex AIを初期化
+        from ai_image_editor import AIImageEditor
+        editor = AIImageEditor()
+    _worker.update({
+        "detector": detector,
+        "editor": editor,
+        "local_anonymizer": LocalAnonymizer(),
+        "animation": AnimationProcessor(detector, editor),
+        "edit_type": edit_type,
+        "local_only": local_only,
+        "output_format": output_format,
+    })
+
+
+def _output_path(output_dir: str, relative: str, fmt: str) -> str:
+    base, _ = os.path.splitext(relative)
+    extension = 'jpg' if fmt.lower() == 'jpeg' else fmt.lower()
+    return os.path.join(output_dir, f"{base}.{extension}")
+
+
+def _process_one(task: Tuple[str, str, str, Set[str]]) -> Dict:
+    """1画像を検出→匿名化→エンコードして書き出し、マニフェスト用の結果を返す"""
+    input_dir, output_dir, relative, done_digests = task
+    edit_type = _worker["edit_type"]
+    record = {"path": relative, "edit_type": edit_type}
+    try:
+        with open(os.path.join(input_dir, relative), 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        record["sha256"] = digest
+        if digest in done_digests:
+            record["status"] = "skipped"
+            return record
+
+        started = time.perf_counter()
+        image = ImageProcessor.open_image_bytes(data)
+        if AnimationProcessor.is_animated(image):
+            result = _worker["animation"].anonymize(image, edit_type)
+            encoded, fmt = result["data"], "gif"
+            faces = result["faces_detected"]
+            fallback_used = True
+        else:
+            image = ImageProcessor.process_image(image)
+            regions = _worker["detector"].get_face_regions_from_image(image)
+            faces = len(regions)
+            fallback_used = False
+            if regions and edit_type in LocalAnonymizer.MODES:
+                image = _worker["local_anonymizer"].anonymize(image, regions, edit_type)
+            elif regions:
+                # 1回のバッチは同一所有者の写真のため、入力ディレクトリ単位で近似重複を再利用する
+                edit_result = _worker["editor"].edit_image_with_ai(
+                    image, regions, edit_type, local_only=_worker["local_only"], album_id=input_dir
+                )
+                image = edit_result["image"]
+                fallback_used = edit_result["fallback_used"]
+            encoded, fmt = ImageProcessor.encode_image(image, _worker["output_format"])
+
+        output_path = _output_path(output_dir, relative, fmt)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, 'wb') as f:
+            f.write(encoded)
+        record.update({
+            "status": "ok",
+            "output": os.path.relpath(output_path, output_dir),
+            "faces_detected": faces,
+            "fallback_used": fallback_used,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        })
+    except Exception as e:
+        record.update({"status": "error", "error": str(e)})
+    return record
+
+
+def _list_images(input_dir: str) -> List[str]:
+    """入力ディレクトリ配下の画像の相対パス"""
+    files = []
+    for root, _, names in os.walk(input_dir):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in Config.ALLOWED_IMAGE_FORMATS:
+                files.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(files)
+
+
+def _load_manifest(path: str, edit_type: str, output_dir: str) -> Dict[str, Set[str]]:
+    """成功済みの {相対パス: SHA-256の集合} を読み込む（出力が残っているもののみ）"""
+    done: Dict[str, Set[str]] = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中断時に書きかけになった行は無視
+                continue
+            if record.get("status") != "ok" or record.get("edit_type") != edit_type:
+                continue
+            if not os.path.exists(os.path.join(output_dir, record.get("output", ""))):
+                continue
+            done.setdefault(record["path"], set()).add(record["sha256"])
+    return done
+
+
+def run_batch(input_dir: str, output_dir: str, edit_type: str, workers: int,
+              output_format: Optional[str], manifest_path: str, local_only: bool) -> Dict:
+    """ディレクトリを並列に一括処理し、スループット・レイテンシの集計を返す"""
+    files = _list_images(input_dir)
+    done = _load_manifest(manifest_path, edit_type, output_dir)
+    tasks = [(input_dir, output_dir, relative, done.get(relative, set())) for relative in files]
+
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {"ok": 0, "skipped": 0, "error": 0}
+    latencies: List[float] = []
+    faces = 0
+    started = time.perf_counter()
+    # MediaPipe/gRPCのスレッドをfork先へ持ち込まないようspawnで起動
+    context = multiprocessing.get_context('spawn')
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, context.Pool(
+        processes=workers, initializer=_init_worker, initargs=(edit_type, local_only, output_format)
+    ) as pool:
+        for record in pool.imap_unordered(_process_one, tasks, chunksize=4):
+            counts[record["status"]] += 1
+            if record["status"] == "skipped":
+                continue
+            # 1件ごとに追記して中断しても再開できるようにする
+            manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            manifest.flush()
+            if record["status"] == "ok":
+                latencies.append(record["latency_ms"])
+                faces += record["faces_detected"]
+            else:
+                print(f"ERROR {record['path']}: {record['error']}")
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "images": len(files),
+        "processed": counts["ok"],
+        "skipped": counts["skipped"],
+        "failed": counts["error"],
+        "faces_detected": faces,
+        "workers": workers,
+        "elapsed_sec": round(elapsed, 2),
+        "throughput_images_per_sec": round(counts["ok"] / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms_p50": statistics.median(latencies) if latencies else 0.0,
+        "latency_ms_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+        "latency_ms_max": latencies[-1] if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像ディレクトリの一括匿名化")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--edit-type", default="blur", choices=EDIT_TYPES)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output-format", default=None, choices=Config.OUTPUT_IMAGE_FORMATS)
+    parser.add_argument("--manifest", default=None)
+    parser.add_argument("--local-only", action="store_true",
+                        help="bouquet/postcardでもVertex AIを呼ばずフォールバック描画のみ")
+    args = parser.parse_args()
+
+    manifest_path = args.manifest or os.path.join(args.output_dir, ".manifest.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    summary = run_batch(args.input_dir, args.output_dir, args.edit_type, max(1, args.workers),
+                        args.output_format, manifest_path, args.local_only)
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
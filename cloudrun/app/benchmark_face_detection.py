@@ -0,0 +1,101 @@
+"""顔検出の速度・再現率ベンチマーク（検出バックエンド × 単一パス/タイル検出）
+
+使い方:
+    python benchmark_face_detection.py <画像ディレクトリ> [--ground-truth gt.json] [--repeat 3]
+        [--backends mediapipe_short,mediapipe_long,opencv_haar] [--modes single,tiled]
+
+gt.json は {"ファイル名": [[x, y, width, height], ...]} 形式。指定時はIoU>=0.5で再現率を算出する。
+レイテンシは経過時間とCPU時間（タイル検出のワーカースレッド分を含むプロセス全体）の両方を出力する。
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Dict, List, Tuple
+from face_detector import FaceDetector
+
+
+def _iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    ax0, ay0, aw, ah = a
+    bx0, by0, bw, bh = b
+    iw = min(ax0 + aw, bx0 + bw) - max(ax0, bx0)
+    ih = min(ay0 + ah, by0 + bh) - max(ay0, by0)
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    inter = iw * ih
+    return inter / float(aw * ah + bw * bh - inter)
+
+
+def _matched(truth: List[Tuple[int, int, int, int]], predicted: List[Tuple[int, int, int, int]]) -> int:
+    """正解矩形のうちIoU>=0.5の予測がある数"""
+    return sum(1 for t in truth if any(_iou(t, p) >= 0.5 for p in predicted))
+
+
+def run_benchmark(image_dir: str, ground_truth: Dict[str, List], modes: List[str], repeat: int,
+                  backends: List[str]) -> Dict:
+    """バックエンド・モードの組み合わせごとにディレクトリ内の画像を検出し、レイテンシと再現率を集計"""
+    detector = FaceDetector()
+    files = sorted(
+        f for f in os.listdir(image_dir)
+        if os.path.splitext(f)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp')
+    )
+    summary = {}
+    for backend, mode in [(b, m) for b in backends for m in modes]:
+        FaceDetector.resolve_backend(backend)
+        if files:
+            # モデルの読み込みを計測から除外
+            with open(os.path.join(image_dir, files[0]), 'rb') as f:
+                detector.get_face_regions(f.read(), mode, backend)
+        latencies: List[float] = []
+        cpu_times: List[float] = []
+        detected = 0
+        truth_total = 0
+        truth_matched = 0
+        for name in files:
+            with open(os.path.join(image_dir, name), 'rb') as f:
+                image_bytes = f.read()
+            regions = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                cpu_started = time.process_time()
+                regions = detector.get_face_regions(image_bytes, mode, backend)
+                latencies.append((time.perf_counter() - started) * 1000)
+                cpu_times.append((time.process_time() - cpu_started) * 1000)
+            detected += len(regions)
+            if name in ground_truth:
+                truth = [tuple(box) for box in ground_truth[name]]
+                truth_total += len(truth)
+                truth_matched += _matched(truth, regions)
+        latencies.sort()
+        summary[f"{backend}/{mode}"] = {
+            "images": len(files),
+            "faces_detected": detected,
+            "latency_ms_p50": statistics.median(latencies) if latencies else 0.0,
+            "latency_ms_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+            "cpu_ms_p50": statistics.median(cpu_times) if cpu_times else 0.0,
+            "recall": truth_matched / float(truth_total) if truth_total else None,
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="顔検出ベンチマーク")
+    parser.add_argument("image_dir")
+    parser.add_argument("--ground-truth", default=None)
+    parser.add_argument("--modes", default="single,tiled")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backends", default="mediapipe_short,mediapipe_long,opencv_haar")
+    args = parser.parse_args()
+
+    ground_truth = {}
+    if args.ground_truth:
+        with open(args.ground_truth) as f:
+            ground_truth = json.load(f)
+    summary = run_benchmark(args.image_dir, ground_truth, args.modes.split(','), args.repeat,
+                            args.backends.split(','))
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
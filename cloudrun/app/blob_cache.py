@@ -0,0 +1,174 @@
+"""Cloud Storageダウンロードのリードスルーキャッシュ（RAM層＋ローカルディスク層）"""
+import atexit
+import hashlib
+import itertools
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from config import Config
+from metrics import metrics
+
+
+class BlobCache:
+    """Blob名をキーに、世代番号（generation）付きでバイト列を保持するクラス
+
+    RAM層・ディスク層ともにバイト上限付きLRU。RAM層から溢れたエントリはディスク層にのみ残る。
+    ディスク層は同じディレクトリを指定した他のワーカープロセスと衝突しないよう、プロセスごとのサブディレクトリを使う。
+    """
+
+    def __init__(self, max_ram_bytes: int, disk_dir: Optional[str], max_disk_bytes: int):
+        """キャッシュの初期化（このプロセス用のディスク層ディレクトリに残るファイルは索引が無いため破棄する）"""
+        self.max_ram_bytes = max_ram_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = os.path.join(disk_dir, str(os.getpid())) if disk_dir and max_disk_bytes > 0 else None
+        # 同じblobの書き込みが重なっても別ファイルになるよう連番を付ける
+        self._file_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # blob名 -> (データ, 世代番号, 最終検証時刻)
+        self._ram: "OrderedDict[str, Tuple[bytes, int, float]]" = OrderedDict()
+        self._ram_bytes = 0
+        # blob名 -> (ファイルパス, 世代番号, 最終検証時刻, バイト数)
+        self._disk: "OrderedDict[str, Tuple[str, int, float, int]]" = OrderedDict()
+        self._disk_bytes = 0
+        self._hits = 0
+        self._lookups = 0
+        if self.disk_dir:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+            os.makedirs(self.disk_dir, exist_ok=True)
+            atexit.register(shutil.rmtree, self.disk_dir, True)
+
+    def _path(self, name: str) -> str:
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.{next(self._file_ids)}")
+
+    @staticmethod
+    def _remove(path: Optional[str]) -> None:
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _publish(self) -> None:
+        """使用量・ヒット率をゲージへ反映（ロック保持中に呼ぶ）"""
+        metrics.set_gauge("blob_cache.ram_bytes", self._ram_bytes)
+        metrics.set_gauge("blob_cache.disk_bytes", self._disk_bytes)
+        if self._lookups:
+            metrics.set_gauge("blob_cache.hit_ratio", round(self._hits / float(self._lookups), 4))
+
+    def _evict(self) -> None:
+        """バイト上限を超えた分を古い順に削除（ロック保持中に呼ぶ）"""
+        while self._ram and self._ram_bytes > self.max_ram_bytes:
+            _, (data, _, _) = self._ram.popitem(last=False)
+            self._ram_bytes -= len(data)
+            metrics.increment("blob_cache.evicted.ram")
+        while self._disk and self._disk_bytes > self.max_disk_bytes:
+            _, (path, _, _, size) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._remove(path)
+            metrics.increment("blob_cache.evicted.disk")
+
+    def get(self, name: str) -> Optional[Tuple[bytes, int, float]]:
+        """(データ, 世代番号, 最終検証時刻) を返す（未保持ならNone）"""
+        with self._lock:
+            self._lookups += 1
+            entry = self._ram.get(name)
+            if entry is not None:
+                self._ram.move_to_end(name)
+                self._hits += 1
+                metrics.increment("blob_cache.hit.ram")
+                self._publish()
+                return entry
+            disk_entry = self._disk.get(name)
+            if disk_entry is None:
+                metrics.increment("blob_cache.miss")
+                self._publish()
+                return None
+            self._disk.move_to_end(name)
+        path, generation, validated_at, _ = disk_entry
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            # 読み込み中に置き換え・追い出しされた場合は新しいエントリを消さない
+            with self._lock:
+                if self._disk.get(name) is disk_entry:
+                    self._disk.pop(name)
+                    self._disk_bytes -= disk_entry[3]
+                metrics.increment("blob_cache.miss")
+                self._publish()
+            return None
+        with self._lock:
+            self._hits += 1
+            metrics.increment("blob_cache.hit.disk")
+            # ディスク層のヒットはRAM層へ昇格（読み込み中に置き換えられていない場合のみ）
+            if self._disk.get(name) is disk_entry and name not in self._ram and len(data) <= self.max_ram_bytes:
+                self._ram[name] = (data, generation, validated_at)
+                self._ram_bytes += len(data)
+                self._evict()
+            self._publish()
+        return data, generation, validated_at
+
+    def put(self, name: str, data: bytes, generation: int) -> None:
+        """データを両層に保持（既存エントリは置き換える）
+
+        ファイルは書き込みごとに別名で作成し、置き換えと使用量の更新はロック内でまとめて行う。
+        """
+        path = None
+        if self.disk_dir and len(data) <= self.max_disk_bytes:
+            path = self._path(name)
+            try:
+                with open(path, 'wb') as f:
+                    f.write(data)
+            except OSError:
+                self._remove(path)
+                path = None
+        now = time.monotonic()
+        with self._lock:
+            old = self._ram.pop(name, None)
+            if old is not None:
+                self._ram_bytes -= len(old[0])
+            old_disk = self._disk.pop(name, None)
+            if old_disk is not None:
+                self._disk_bytes -= old_disk[3]
+            if len(data) <= self.max_ram_bytes:
+                self._ram[name] = (data, generation, now)
+                self._ram_bytes += len(data)
+            if path:
+                self._disk[name] = (path, generation, now, len(data))
+                self._disk_bytes += len(data)
+            self._evict()
+            self._publish()
+        if old_disk is not None:
+            self._remove(old_disk[0])
+
+    def mark_validated(self, name: str) -> None:
+        """世代番号の一致を確認した時刻を更新"""
+        now = time.monotonic()
+        with self._lock:
+            if name in self._ram:
+                data, generation, _ = self._ram[name]
+                self._ram[name] = (data, generation, now)
+            if name in self._disk:
+                path, generation, _, size = self._disk[name]
+                self._disk[name] = (path, generation, now, size)
+
+    def invalidate(self, name: str) -> None:
+        """エントリを削除"""
+        with self._lock:
+            entry = self._ram.pop(name, None)
+            if entry is not None:
+                self._ram_bytes -= len(entry[0])
+            disk_entry = self._disk.pop(name, None)
+            if disk_entry is not None:
+                self._disk_bytes -= disk_entry[3]
+            self._publish()
+        if disk_entry is not None:
+            self._remove(disk_entry[0])
+
+
+# プロセス共通のダウンロードキャッシュ
+blob_cache = BlobCache(Config.BLOB_CACHE_RAM_BYTES, Config.BLOB_CACHE_DISK_DIR, Config.BLOB_CACHE_DISK_BYTES)
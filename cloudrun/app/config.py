@@ -27,10 +27,186 @@ class Config:
     ALLOWED_IMAGE_FORMATS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp']
     RESIZE_LONG_SIDE = int(os.environ.get('RESIZE_LONG_SIDE', 1536))
     JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', 92))
+    # デコード前に判定するピクセル数上限（1リクエストあたりのメモリ上限）
+    MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 25_000_000))
+    MAX_IMAGE_FRAMES = int(os.environ.get('MAX_IMAGE_FRAMES', 300))
+    # ピクセル数上限超過時の動作: reject=拒否, downscale=JPEGはデコード時縮小で受け付け
+    PIXEL_BUDGET_ACTION = os.environ.get('PIXEL_BUDGET_ACTION', 'downscale').lower()
+    # 出力エンコード設定（Acceptヘッダ/リクエスト指定が無い場合の既定形式: jpeg/webp/avif/png/original）
+    OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'jpeg').lower()
+    OUTPUT_IMAGE_FORMATS = ['jpeg', 'webp', 'avif', 'png']
+    # target_bytes指定時に品質探索で下げてよい下限
+    TARGET_MIN_QUALITY = int(os.environ.get('TARGET_MIN_QUALITY', 30))
+    # レスポンスにはプレビューのみ埋め込み、フル解像度は /result/<handle> で遅延取得する
+    LAZY_FULL_RESOLUTION = os.environ.get('LAZY_FULL_RESOLUTION', 'True').lower() == 'true'
+    PREVIEW_LONG_SIDE = int(os.environ.get('PREVIEW_LONG_SIDE', 512))
+    PREVIEW_FORMAT = os.environ.get('PREVIEW_FORMAT', 'webp').lower()
+    RESULT_TTL_SEC = float(os.environ.get('RESULT_TTL_SEC', 600))
+    RESULT_STORE_MAX_BYTES = int(os.environ.get('RESULT_STORE_MAX_BYTES', 256 * 1024 * 1024))
+    # 結果ストアはインスタンスごとのため、別インスタンスでも取得できるようフル解像度をバックグラウンドでGCSへも保存
+    # （既定は無効。有効時はRESULT_TTL_SECを過ぎた結果は返さず、RESULTS_PREFIX配下はライフサイクルルールで1日後に削除）
+    RESULT_SHARED_STORAGE = os.environ.get('RESULT_SHARED_STORAGE', 'False').lower() == 'true'
+    RESULT_SHARE_WORKERS = int(os.environ.get('RESULT_SHARE_WORKERS', 4))
+    RESULTS_PREFIX = "results/"
+    
+    # 顔検出設定（single=全体1パス, tiled=重なり付きタイルを並列検出, auto=長辺で自動選択）
+    # 既定はsingle（タイル検出は1リクエストで全体1パス＋タイル数分の検出を行うため、ベンチマークで確認してから有効化する）
+    FACE_DETECTION_MODE = os.environ.get('FACE_DETECTION_MODE', 'single').lower()
+    FACE_TILE_AUTO_LONG_SIDE = int(os.environ.get('FACE_TILE_AUTO_LONG_SIDE', 1280))
+    FACE_TILE_SIZE = int(os.environ.get('FACE_TILE_SIZE', 640))
+    FACE_TILE_OVERLAP = float(os.environ.get('FACE_TILE_OVERLAP', 0.25))
+    FACE_TILE_WORKERS = int(os.environ.get('FACE_TILE_WORKERS', 4))
+    FACE_TILE_NMS_IOU = float(os.environ.get('FACE_TILE_NMS_IOU', 0.3))
+    # 検出バックエンド（mediapipe_short/mediapipe_long/opencv_dnn/opencv_haar、リクエストでも指定可）
+    FACE_DETECTOR_BACKEND = os.environ.get('FACE_DETECTOR_BACKEND', 'mediapipe_long').lower()
+    # MediaPipe使用時のタイル用バックエンド（タイル内の顔は相対的に大きく写るため近距離モデルを既定とする）
+    FACE_TILE_BACKEND = os.environ.get('FACE_TILE_BACKEND', 'mediapipe_short').lower()
+    # バックエンドごとに生成する検出器の上限（全て使用中なら空くまで待つ。Flaskの接続スレッド数に比例して増やさない）
+    FACE_DETECTOR_POOL_SIZE = int(os.environ.get('FACE_DETECTOR_POOL_SIZE', FACE_TILE_WORKERS))
+    FACE_MIN_CONFIDENCE = float(os.environ.get('FACE_MIN_CONFIDENCE', 0.5))
+    # opencv_dnn用のYuNet ONNXモデル（face_detection_yunet_*.onnx）のパス
+    FACE_OPENCV_DNN_MODEL = os.environ.get('FACE_OPENCV_DNN_MODEL', '')
+    # 顔検出を行うワーカープロセス数（0=リクエストスレッド上で検出。画素は共有メモリで受け渡す）
+    FACE_DETECTION_PROCESSES = int(os.environ.get('FACE_DETECTION_PROCESSES', 0))
+    FACE_DETECTION_POOL_TIMEOUT_SEC = float(os.environ.get('FACE_DETECTION_POOL_TIMEOUT_SEC', 30))
+    
+    # 複数フレーム画像（アニメーションGIF）設定: 顔検出はキーフレームのみ、間は矩形を補間
+    ANIMATION_KEYFRAME_INTERVAL = int(os.environ.get('ANIMATION_KEYFRAME_INTERVAL', 5))
+    ANIMATION_TRACK_PAD = float(os.environ.get('ANIMATION_TRACK_PAD', 0.15))
+    
+    # ローカル匿名化（edit_type: blur/pixelate/solid）設定
+    LOCAL_MASK_PAD = float(os.environ.get('LOCAL_MASK_PAD', 0.15))
+    LOCAL_FEATHER_RATIO = float(os.environ.get('LOCAL_FEATHER_RATIO', 0.08))
+    LOCAL_BLUR_STRENGTH = float(os.environ.get('LOCAL_BLUR_STRENGTH', 0.25))
+    LOCAL_PIXELATE_BLOCKS = int(os.environ.get('LOCAL_PIXELATE_BLOCKS', 10))
+    LOCAL_SOLID_COLOR = tuple(int(v) for v in os.environ.get('LOCAL_SOLID_COLOR', '0,0,0').split(','))
+    
+    # AI編集で顔周辺のみをモデルへ送るか（full=画像全体, cluster=重なる顔ごと, union=全顔を含む1領域）
+    INPAINT_REGION_MODE = os.environ.get('INPAINT_REGION_MODE', 'cluster').lower()
+    # 切り出し領域の最小辺（周囲の文脈をモデルに渡すため）
+    INPAINT_REGION_MIN_SIDE = int(os.environ.get('INPAINT_REGION_MIN_SIDE', 512))
+    # 合成時の境界ぼかし幅（切り出し領域の短辺に対する比率）
+    INPAINT_REGION_FEATHER = float(os.environ.get('INPAINT_REGION_FEATHER', 0.02))
+    # 顔クラスタを並列に編集する最大数（Vertex AIのクォータと合わせて調整）
+    INPAINT_CLUSTER_CONCURRENCY = int(os.environ.get('INPAINT_CLUSTER_CONCURRENCY', 4))
+    # 近似重複（連写等）の編集結果の再利用（知覚ハッシュのハミング距離・顔配置の差が許容内なら顔パッチを移植）
+    NEAR_DUPLICATE_ENABLED = os.environ.get('NEAR_DUPLICATE_ENABLED', 'False').lower() == 'true'
+    NEAR_DUPLICATE_MAX_ENTRIES = int(os.environ.get('NEAR_DUPLICATE_MAX_ENTRIES', 512))
+    NEAR_DUPLICATE_MAX_BYTES = int(os.environ.get('NEAR_DUPLICATE_MAX_BYTES', 128 * 1024 * 1024))
+    # 64bit中の許容ビット差
+    NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_MAX_DISTANCE', 6))
+    # 顔の中心・大きさの許容差（画像の幅・高さに対する比率）
+    NEAR_DUPLICATE_LAYOUT_TOLERANCE = float(os.environ.get('NEAR_DUPLICATE_LAYOUT_TOLERANCE', 0.03))
     
     # ストレージ設定
     PROCESSED_IMAGES_PREFIX = "processed_images/"
-    
+    # コンテンツアドレス方式（SHA-256名で保存し同一内容のアップロードを省略）
+    CONTENT_ADDRESSED_STORAGE = os.environ.get('CONTENT_ADDRESSED_STORAGE', 'False').lower() == 'true'
+    CONTENT_OBJECTS_PREFIX = f"{PROCESSED_IMAGES_PREFIX}objects/"
+    CONTENT_INDEX_PREFIX = "content_index/"
+    # 存在確認済みオブジェクト・論理名の対応をメモリに保持する件数（それぞれLRU）
+    CONTENT_INDEX_CACHE_ENTRIES = int(os.environ.get('CONTENT_INDEX_CACHE_ENTRIES', 10000))
+    # ダウンロードのリードスルーキャッシュ（RAM層・ディスク層のバイト上限、世代番号の再検証間隔）
+    BLOB_CACHE_ENABLED = os.environ.get('BLOB_CACHE_ENABLED', 'True').lower() == 'true'
+    BLOB_CACHE_RAM_BYTES = int(os.environ.get('BLOB_CACHE_RAM_BYTES', 128 * 1024 * 1024))
+    BLOB_CACHE_DISK_DIR = os.environ.get('BLOB_CACHE_DISK_DIR', '/tmp/blob_cache')
+    # ディスク層の上限（既定0で無効。Cloud Runの/tmpはメモリ上にあり、コンテナのメモリ上限に含まれるため明示的に指定する）
+    BLOB_CACHE_DISK_BYTES = int(os.environ.get('BLOB_CACHE_DISK_BYTES', 0))
+    BLOB_CACHE_VALIDATE_SEC = float(os.environ.get('BLOB_CACHE_VALIDATE_SEC', 30))
+    # 処理済み画像のメタデータ索引（SQLite）と一覧のページサイズ
+    IMAGE_INDEX_PATH = os.environ.get('IMAGE_INDEX_PATH', '/tmp/image_index.sqlite3')
+    IMAGE_INDEX_RECONCILE_ON_START = os.environ.get('IMAGE_INDEX_RECONCILE_ON_START', 'True').lower() == 'true'
+    # 索引はインスタンスごとのため、他インスタンスのアップロード・削除をこの間隔でバケットから取り込む（0=起動時のみ）
+    IMAGE_INDEX_RECONCILE_INTERVAL_SEC = float(os.environ.get('IMAGE_INDEX_RECONCILE_INTERVAL_SEC', 300))
+    # POST /images/reconcile に必要なトークン（X-Reconcile-Token。未設定なら常に拒否）
+    IMAGE_INDEX_RECONCILE_TOKEN = os.environ.get('IMAGE_INDEX_RECONCILE_TOKEN', '')
+    IMAGE_LIST_PAGE_SIZE = int(os.environ.get('IMAGE_LIST_PAGE_SIZE', 50))
+    IMAGE_LIST_MAX_PAGE_SIZE = int(os.environ.get('IMAGE_LIST_MAX_PAGE_SIZE', 500))
+    # 取り込み時の顔検出結果（Blobメタデータ）をストレージ系エンドポイントで利用し、未保存なら検出後に書き戻す
+    FACE_METADATA_ENABLED = os.environ.get('FACE_METADATA_ENABLED', 'True').lower() == 'true'
+    FACE_METADATA_WRITE_BACK = os.environ.get('FACE_METADATA_WRITE_BACK', 'True').lower() == 'true'
+    # Cloud StorageのPub/Sub通知（push）の検証用トークン（?token= と照合、空なら検証しない）
+    INGEST_PUSH_TOKEN = os.environ.get('INGEST_PUSH_TOKEN', '')
+
+    # アドミッション制御（AI編集系: Imagen/SDXLを呼ぶ重いエンドポイント）
+    AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', 4))
+    AI_MAX_QUEUE = int(os.environ.get('AI_MAX_QUEUE', 8))
+    AI_QUEUE_TIMEOUT_SEC = float(os.environ.get('AI_QUEUE_TIMEOUT_SEC', 10))
+    AI_RETRY_AFTER_SEC = int(os.environ.get('AI_RETRY_AFTER_SEC', 30))
+    # 過負荷時に429ではなくローカルのフォールバック描画で応答する
+    AI_DOWNGRADE_ON_OVERLOAD = os.environ.get('AI_DOWNGRADE_ON_OVERLOAD', 'False').lower() == 'true'
+    # アドミッション制御（通常系: 画像処理・一覧・ダウンロード）
+    STANDARD_MAX_CONCURRENCY = int(os.environ.get('STANDARD_MAX_CONCURRENCY', 16))
+    STANDARD_MAX_QUEUE = int(os.environ.get('STANDARD_MAX_QUEUE', 32))
+    STANDARD_QUEUE_TIMEOUT_SEC = float(os.environ.get('STANDARD_QUEUE_TIMEOUT_SEC', 2))
+    STANDARD_RETRY_AFTER_SEC = int(os.environ.get('STANDARD_RETRY_AFTER_SEC', 1))
+
+    # 編集バックエンドの適応的ルーティング（直近の成功率・レイテンシで試行順を決定）
+    ROUTER_WINDOW = int(os.environ.get('ROUTER_WINDOW', 50))
+    ROUTER_MIN_SAMPLES = int(os.environ.get('ROUTER_MIN_SAMPLES', 5))
+    # 成功率がこれ未満のバックエンドは省略（ROUTER_PROBE_INTERVAL回に1回は回復確認のため試行）
+    ROUTER_SKIP_SUCCESS_RATE = float(os.environ.get('ROUTER_SKIP_SUCCESS_RATE', 0.1))
+    ROUTER_PROBE_INTERVAL = int(os.environ.get('ROUTER_PROBE_INTERVAL', 20))
+    # 未計測のバックエンドの想定レイテンシ
+    ROUTER_DEFAULT_LATENCY_MS = float(os.environ.get('ROUTER_DEFAULT_LATENCY_MS', 8000))
+    # 呼び出し単価1あたりを何ミリ秒相当とみなすか（0ならレイテンシのみで順序決定）
+    ROUTER_COST_WEIGHT_MS = float(os.environ.get('ROUTER_COST_WEIGHT_MS', 0))
+    ROUTER_BACKEND_COSTS = {
+        k: float(v) for k, v in (
+            item.split('=') for item in os.environ.get('ROUTER_BACKEND_COSTS', 'imagen=1.0,sdxl=0.6').split(',') if item
+        )
+    }
+
+    # Vertex AI呼び出しのクォータ制御（モデル・リージョンごとのトークンバケットを同一ホストのプロセス間で共有）
+    # 既定は無効。有効にする場合はプロジェクトに割り当てられたクォータをVERTEX_QUOTA_PER_MINUTEで指定する
+    VERTEX_QUOTA_ENABLED = os.environ.get('VERTEX_QUOTA_ENABLED', 'False').lower() == 'true'
+    VERTEX_QUOTA_DB = os.environ.get('VERTEX_QUOTA_DB', '/tmp/vertex_quota.sqlite3')
+    # 1分あたりの呼び出し数（モデル系統ごと、例: imagen=60,sdxl=30。記載の無い系統は制限しない）
+    VERTEX_QUOTA_PER_MINUTE = {
+        k: float(v) for k, v in (
+            item.split('=') for item in os.environ.get('VERTEX_QUOTA_PER_MINUTE', '').split(',') if item
+        )
+    }
+    VERTEX_QUOTA_BURST = float(os.environ.get('VERTEX_QUOTA_BURST', 3))
+    # トークン待ちの上限（超える場合は待たずに次のバックエンド・フォールバックへ）
+    VERTEX_QUOTA_MAX_WAIT_MS = float(os.environ.get('VERTEX_QUOTA_MAX_WAIT_MS', 2000))
+    # 429（クォータ超過）を受けたモデルへの送信を止める秒数
+    VERTEX_QUOTA_COOLDOWN_SEC = float(os.environ.get('VERTEX_QUOTA_COOLDOWN_SEC', 10))
+    # ASGI経路でSQLiteのトークン操作を行うスレッド数（イベントループをロック待ちで止めない）
+    VERTEX_QUOTA_ASYNC_WORKERS = int(os.environ.get('VERTEX_QUOTA_ASYNC_WORKERS', 4))
+
+    # トレーシング（無効時はスパン計測を行わない）
+    TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'False').lower() == 'true'
+    # エクスポーター: jsonl=ローカルのJSON Linesファイル, stdout=標準出力
+    TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'jsonl').lower()
+    TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/traces/traces.jsonl')
+
+    # オンデマンドプロファイリング（X-Profile-Tokenヘッダの一致またはサンプリングで対象を選ぶ）
+    PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False').lower() == 'true'
+    PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+    PROFILE_MAX_COUNT = int(os.environ.get('PROFILE_MAX_COUNT', 50))
+    PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', 1))
+
+    # サーバー（wsgi=Flask開発サーバー, asgi=uvicornでasgi.pyを起動）
+    SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi').lower()
+    # ASGI経路で同時に保持するAI編集の上限（超過時は429）
+    ASGI_MAX_INFLIGHT_EDITS = int(os.environ.get('ASGI_MAX_INFLIGHT_EDITS', 256))
+    # デコード・顔検出・合成用のスレッド数
+    ASGI_CPU_WORKERS = int(os.environ.get('ASGI_CPU_WORKERS', os.cpu_count() or 2))
+    # Flaskへ委譲するリクエスト・GCS入出力用のスレッド数
+    ASGI_WSGI_WORKERS = int(os.environ.get('ASGI_WSGI_WORKERS', 16))
+    ASGI_IO_WORKERS = int(os.environ.get('ASGI_IO_WORKERS', 16))
+
+    # リクエスト単位の処理期限（deadline_ms未指定時の既定値・上限）
+    DEFAULT_DEADLINE_MS = float(os.environ.get('DEFAULT_DEADLINE_MS', 60000))
+    MAX_DEADLINE_MS = float(os.environ.get('MAX_DEADLINE_MS', 300000))
+    # フォールバック描画・エンコードのために残しておく時間
+    DEADLINE_RESERVE_MS = float(os.environ.get('DEADLINE_RESERVE_MS', 1500))
+    # 残りがこれ未満ならVertex AI呼び出しを開始しない
+    MIN_VERTEX_CALL_SEC = float(os.environ.get('MIN_VERTEX_CALL_SEC', 3))
+
     @classmethod
     def validate_config(cls):
         """設定の検証"""
@@ -0,0 +1,79 @@
+"""リクエスト単位の処理期限（deadline_ms）管理"""
+import asyncio
+import time
+from typing import Dict, Optional
+from config import Config
+
+
+class DeadlineExceeded(Exception):
+    """期限内に外部呼び出しを開始・完了できない場合の例外"""
+
+
+class Deadline:
+    """リクエストの処理期限を保持し、外部呼び出しへ渡すタイムアウトを算出するクラス"""
+
+    def __init__(self, budget_ms: float, started: Optional[float] = None):
+        """処理期限の初期化（startedはtime.monotonic()基準の開始時刻）"""
+        self.budget_ms = budget_ms
+        self.started = started if started is not None else time.monotonic()
+        self.expires_at = self.started + budget_ms / 1000.0
+        # 期限を理由に処理を打ち切ったか
+        self.hit = False
+
+    @classmethod
+    def from_request(cls, deadline_ms, started: Optional[float] = None) -> 'Deadline':
+        """リクエストのdeadline_ms（未指定ならサーバ既定値）から期限を生成"""
+        try:
+            budget = float(deadline_ms) if deadline_ms is not None else Config.DEFAULT_DEADLINE_MS
+        except (TypeError, ValueError):
+            budget = Config.DEFAULT_DEADLINE_MS
+        budget = min(max(budget, 0.0), Config.MAX_DEADLINE_MS)
+        return cls(budget, started)
+
+    def remaining(self) -> float:
+        """残り秒数"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed_ms(self) -> float:
+        """開始からの経過ミリ秒"""
+        return (time.monotonic() - self.started) * 1000
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """外部呼び出しに渡すタイムアウト秒（フォールバック描画分の余裕を差し引く）
+
+        残りが最小呼び出し時間に満たない場合は呼び出し自体を行わずDeadlineExceeded。
+        """
+        available = self.remaining() - Config.DEADLINE_RESERVE_MS / 1000.0
+        if available < Config.MIN_VERTEX_CALL_SEC:
+            self.hit = True
+            raise DeadlineExceeded(f"deadline exceeded: remaining={self.remaining():.2f}s")
+        return min(available, cap) if cap else available
+
+    def _check_sleep(self, seconds: float) -> None:
+        if self.remaining() - Config.DEADLINE_RESERVE_MS / 1000.0 < seconds + Config.MIN_VERTEX_CALL_SEC:
+            self.hit = True
+            raise DeadlineExceeded(f"deadline exceeded: remaining={self.remaining():.2f}s")
+
+    def sleep(self, seconds: float) -> None:
+        """期限を超えない範囲で待機（超える場合はDeadlineExceeded）"""
+        self._check_sleep(seconds)
+        time.sleep(seconds)
+
+    async def sleep_async(self, seconds: float) -> None:
+        """sleepのasyncio版（待機中もイベントループを止めない）"""
+        self._check_sleep(seconds)
+        await asyncio.sleep(seconds)
+
+    def describe(self, fallback_used: bool) -> Dict:
+        """レスポンスに含める期限の結果"""
+        if self.hit:
+            outcome = "deadline_fallback"
+        elif fallback_used:
+            outcome = "fallback"
+        else:
+            outcome = "met"
+        return {
+            "budget_ms": self.budget_ms,
+            "elapsed_ms": round(self.elapsed_ms(), 1),
+            "outcome": outcome
+        }
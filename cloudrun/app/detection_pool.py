@@ -0,0 +1,111 @@
+"""顔検出のプロセスプール（画素は共有メモリで受け渡し、検出をGILから切り離す）"""
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context, shared_memory
+from typing import Dict, List, Optional
+from config import Config
+from metrics import metrics
+
+# ワーカープロセス内の顔検出器（初期化時に1回だけ生成）
+_worker_detector = None
+
+
+def _init_worker(backends: List[str]) -> None:
+    """ワーカープロセスの初期化（検出器を生成し、モデルを事前に読み込む）"""
+    global _worker_detector
+    from face_detector import FaceDetector
+
+    _worker_detector = FaceDetector()
+    for backend in backends:
+        try:
+            _worker_detector.preload(backend)
+        except Exception as e:
+            print(f"Detector preload failed ({backend}): {e}")
+
+
+def _detect_shared(shm_name: str, shape: tuple, mode: Optional[str], backend: str) -> List[Dict]:
+    """共有メモリ上のRGB画素をコピーせずに参照して検出"""
+    import numpy as np
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    np_img = None
+    try:
+        np_img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        return _worker_detector.detect_faces_in_array(np_img, mode, backend)
+    finally:
+        # 共有メモリを閉じる前にバッファへの参照を解放する
+        del np_img
+        shm.close()
+
+
+class DetectionPool:
+    """検出器を事前初期化したワーカープロセスへ顔検出を委譲するクラス"""
+
+    def __init__(self, workers: int):
+        """プールの初期化（プロセスは初回の検出時に起動）"""
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                backends = sorted({Config.FACE_DETECTOR_BACKEND, Config.FACE_TILE_BACKEND})
+                # MediaPipe/gRPCのスレッドをfork先へ持ち込まないようspawnで起動
+                # （spawnのワーカーはメインモジュールを再importするため、app.pyはサービスをimport時に生成しない）
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(backends,)
+                )
+            return self._executor
+
+    def _reset(self, executor: ProcessPoolExecutor) -> None:
+        """異常終了したプールを破棄し、次回の検出で作り直す"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def detect(self, image, mode: Optional[str], backend: str) -> List[Dict]:
+        """RGBのPIL画像を共有メモリへ書き込み、ワーカープロセスで検出した結果を返す"""
+        width, height = image.size
+        shape = (height, width, 3)
+        started = time.monotonic()
+        shm = shared_memory.SharedMemory(create=True, size=max(1, width * height * 3))
+        try:
+            shm.buf[:width * height * 3] = image.tobytes()
+            executor = self._get_executor()
+            future = executor.submit(_detect_shared, shm.name, shape, mode, backend)
+            try:
+                faces = future.result(timeout=Config.FACE_DETECTION_POOL_TIMEOUT_SEC)
+            except FutureTimeoutError:
+                # 呼び出し元はプロセス内で検出し直すため、待機中のジョブは取り消してワーカーを空ける
+                # （実行中のジョブは取り消せないため件数を分けて記録）
+                if future.cancel():
+                    metrics.increment("face_detection.pool.timeout.cancelled")
+                else:
+                    metrics.increment("face_detection.pool.timeout.running")
+                raise
+            except BrokenProcessPool:
+                metrics.increment("face_detection.pool.broken")
+                self._reset(executor)
+                raise
+        finally:
+            shm.close()
+            shm.unlink()
+        metrics.observe("face_detection.pool.ms", (time.monotonic() - started) * 1000)
+        return faces
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+# プロセス共通の検出プール（FACE_DETECTION_PROCESSES=0なら無効でリクエストスレッド上で検出）
+detection_pool = DetectionPool(Config.FACE_DETECTION_PROCESSES) if Config.FACE_DETECTION_PROCESSES > 0 else None
@@ -1,57 +1,356 @@
-"""MediaPipeを使用した顔検出サービス（Vertex AI Imagenと併用）"""
+"""顔検出サービス（MediaPipe / OpenCVのバックエンドを選択可能）"""
+import abc
 import io
-from typing import List, Dict, Tuple
-import mediapipe as mp
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Tuple, Optional
 from config import Config
+from detection_pool import detection_pool
+from metrics import metrics
+from tracing import traced
+
+
+class DetectorUnavailable(Exception):
+    """検出バックエンドを初期化できない（モデル未配置・依存ライブラリ不足等の設定不備）"""
+
+
+class DetectorBackend(abc.ABC):
+    """顔検出バックエンドの共通インターフェース（インスタンスは同時に1スレッドからのみ使用する）"""
+
+    name = ""
+
+    @abc.abstractmethod
+    def detect(self, np_img) -> List[Dict]:
+        """RGB ndarrayから顔を検出し、画素座標の矩形（x/y/width/height/confidence）を返す"""
+
+
+class MediaPipeBackend(DetectorBackend):
+    """MediaPipe Face Detection（model_selection: 0=近距離, 1=遠距離）"""
+
+    def __init__(self, model_selection: int):
+        import mediapipe as mp
+
+        self.name = "mediapipe_short" if model_selection == 0 else "mediapipe_long"
+        self._detector = mp.solutions.face_detection.FaceDetection(
+            model_selection=model_selection, min_detection_confidence=Config.FACE_MIN_CONFIDENCE
+        )
+
+    def detect(self, np_img) -> List[Dict]:
+        height, width = np_img.shape[:2]
+        return FaceDetector._faces_from_result(self._detector.process(np_img), width, height)
+
+
+class OpenCVDnnBackend(DetectorBackend):
+    """OpenCV DNN（YuNet ONNXモデル、FACE_OPENCV_DNN_MODELで指定）"""
+
+    name = "opencv_dnn"
+
+    def __init__(self):
+        import cv2
+
+        if not Config.FACE_OPENCV_DNN_MODEL:
+            raise Exception("opencv_dnnにはFACE_OPENCV_DNN_MODEL（YuNetのONNXファイル）の指定が必要です")
+        self._cv2 = cv2
+        self._detector = cv2.FaceDetectorYN.create(
+            Config.FACE_OPENCV_DNN_MODEL, "", (320, 320), Config.FACE_MIN_CONFIDENCE, 0.3, 5000
+        )
+
+    def detect(self, np_img) -> List[Dict]:
+        height, width = np_img.shape[:2]
+        self._detector.setInputSize((width, height))
+        _, rows = self._detector.detect(self._cv2.cvtColor(np_img, self._cv2.COLOR_RGB2BGR))
+        faces: List[Dict] = []
+        for row in (rows if rows is not None else []):
+            x, y = max(0, int(row[0])), max(0, int(row[1]))
+            faces.append({
+                'x': x,
+                'y': y,
+                'width': max(1, min(int(row[2]), width - x)),
+                'height': max(1, min(int(row[3]), height - y)),
+                'confidence': float(row[-1]),
+            })
+        return faces
+
+
+class OpenCVHaarBackend(DetectorBackend):
+    """OpenCV Haarカスケード（opencv-python-headless同梱のモデル、追加ファイル不要）"""
+
+    name = "opencv_haar"
+
+    def __init__(self):
+        import cv2
+
+        self._cv2 = cv2
+        self._detector = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+    def detect(self, np_img) -> List[Dict]:
+        gray = self._cv2.cvtColor(np_img, self._cv2.COLOR_RGB2GRAY)
+        rects, _, weights = self._detector.detectMultiScale3(
+            gray, scaleFactor=1.1, minNeighbors=5, minSize=(24, 24), outputRejectLevels=True
+        )
+        faces: List[Dict] = []
+        for (x, y, w, h), weight in zip(rects, weights):
+            faces.append({
+                'x': int(x),
+                'y': int(y),
+                'width': int(w),
+                'height': int(h),
+                'confidence': float(weight),
+            })
+        return faces
+
+
+# 設定値・リクエストで指定できるバックエンド
+BACKENDS = {
+    "mediapipe_short": lambda: MediaPipeBackend(0),
+    "mediapipe_long": lambda: MediaPipeBackend(1),
+    "opencv_dnn": OpenCVDnnBackend,
+    "opencv_haar": OpenCVHaarBackend,
+}
+
+
+class _BackendPool:
+    """1バックエンドの検出器プール（生成数をsize個までに抑え、貸し出し中の検出器は他スレッドへ渡さない）"""
+
+    def __init__(self, name: str, factory, size: int):
+        self._name = name
+        self._factory = factory
+        self._size = max(1, size)
+        self._idle: List[DetectorBackend] = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def checkout(self):
+        """空いている検出器を借りる（上限まで生成済みで全て使用中なら返却を待つ）"""
+        with self._cond:
+            while not self._idle and self._created >= self._size:
+                self._cond.wait()
+            detector = self._idle.pop() if self._idle else None
+            if detector is None:
+                self._created += 1
+        if detector is None:
+            try:
+                detector = self._factory()
+            except Exception as e:
+                with self._cond:
+                    self._created -= 1
+                    self._cond.notify()
+                raise DetectorUnavailable(f"顔検出バックエンド {self._name} を初期化できません: {e}")
+        try:
+            yield detector
+        finally:
+            with self._cond:
+                self._idle.append(detector)
+                self._cond.notify()
+
 
 class FaceDetector:
-    """MediaPipeベースの顔検出クラス"""
+    """バックエンドを切り替え可能な顔検出クラス"""
     
     def __init__(self):
         """顔検出サービスの初期化"""
-        # MediaPipe Face Detection初期化
-        # model_selection: 0=近距離, 1=遠距離
-        self.mp_face = mp.solutions.face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5)
-    
+        # 検出器はスレッド間で同時に使えないため、バックエンドごとの上限付きプールから貸し出す
+        self._pools: Dict[str, _BackendPool] = {}
+        self._pools_lock = threading.Lock()
+        self._tile_executor = None
+        self._tile_executor_lock = threading.Lock()
+
+    @staticmethod
+    def resolve_backend(backend: Optional[str] = None) -> str:
+        """バックエンド名を検証して返す（未指定なら設定値）"""
+        name = (backend or Config.FACE_DETECTOR_BACKEND).lower()
+        if name not in BACKENDS:
+            raise Exception(f"サポートされていない顔検出バックエンド: {name}")
+        return name
+
+    def _backend(self, name: str):
+        """バックエンドの検出器を借りるコンテキストマネージャを返す"""
+        with self._pools_lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = self._pools[name] = _BackendPool(name, BACKENDS[name], Config.FACE_DETECTOR_POOL_SIZE)
+        return pool.checkout()
+
+    def preload(self, name: str) -> None:
+        """検出器を1つ生成してプールに置く（モデルの読み込みを初回の検出前に済ませる）"""
+        with self._backend(self.resolve_backend(name)):
+            pass
+
+    @staticmethod
+    def _faces_from_result(result, width: int, height: int, offset_x: int = 0, offset_y: int = 0) -> List[Dict]:
+        """MediaPipeの検出結果（相対座標）を画素座標の矩形に変換"""
+        faces: List[Dict] = []
+        if result.detections:
+            for det in result.detections:
+                # MediaPipeは相対座標のbbox
+                bbox = det.location_data.relative_bounding_box
+                x = max(0, int(bbox.xmin * width))
+                y = max(0, int(bbox.ymin * height))
+                w = int(bbox.width * width)
+                h = int(bbox.height * height)
+                # 画像範囲にクリップ
+                w = max(1, min(w, width - x))
+                h = max(1, min(h, height - y))
+                faces.append({
+                    'x': x + offset_x,
+                    'y': y + offset_y,
+                    'width': w,
+                    'height': h,
+                    'confidence': float(det.score[0]) if det.score else 0.0,
+                })
+        return faces
+
     def detect_faces_with_mediapipe(self, image_bytes: bytes) -> List[Dict]:
-        """MediaPipeで顔を検出し、画素座標の矩形を返す"""
+        """MediaPipe（遠距離モデル）で顔を検出し、画素座標の矩形を返す"""
+        return self.detect_faces(image_bytes, 'single', 'mediapipe_long')
+    
+    @staticmethod
+    def _tile_origins(length: int, tile: int, overlap: float) -> List[int]:
+        """1軸方向のタイル開始位置（末尾は画像端に揃える）"""
+        if length <= tile:
+            return [0]
+        step = max(1, int(tile * (1.0 - overlap)))
+        origins = list(range(0, length - tile + 1, step))
+        if origins[-1] + tile < length:
+            origins.append(length - tile)
+        return origins
+
+    @staticmethod
+    def _non_max_suppression(faces: List[Dict], iou_threshold: float) -> List[Dict]:
+        """信頼度順に重複矩形を除去（タイル境界で分割された部分矩形も包含率で除去）"""
+        kept: List[Dict] = []
+        for face in sorted(faces, key=lambda f: f['confidence'], reverse=True):
+            fx0, fy0 = face['x'], face['y']
+            fx1, fy1 = fx0 + face['width'], fy0 + face['height']
+            f_area = face['width'] * face['height']
+            duplicate = False
+            for other in kept:
+                ox0, oy0 = other['x'], other['y']
+                ox1, oy1 = ox0 + other['width'], oy0 + other['height']
+                iw = min(fx1, ox1) - max(fx0, ox0)
+                ih = min(fy1, oy1) - max(fy0, oy0)
+                if iw <= 0 or ih <= 0:
+                    continue
+                inter = iw * ih
+                o_area = other['width'] * other['height']
+                iou = inter / float(f_area + o_area - inter)
+                if iou > iou_threshold or inter / float(min(f_area, o_area)) > 0.7:
+                    duplicate = True
+                    break
+            if not duplicate:
+                kept.append(face)
+        return kept
+
+    def _get_tile_executor(self) -> ThreadPoolExecutor:
+        with self._tile_executor_lock:
+            if self._tile_executor is None:
+                self._tile_executor = ThreadPoolExecutor(
+                    max_workers=Config.FACE_TILE_WORKERS, thread_name_prefix="face-tile"
+                )
+            return self._tile_executor
+
+    def _detect_tile(self, np_img, box: Tuple[int, int, int, int], backend: str, tile_backend: str) -> List[Dict]:
+        """ワーカースレッド上で1タイルを検出し、全体座標の矩形を返す"""
+        import numpy as np
+
+        x0, y0, x1, y1 = box
+        full_frame = (x1 - x0, y1 - y0) == (np_img.shape[1], np_img.shape[0])
+        # 全体パスは指定のバックエンド、タイルはタイル用のバックエンドで検出
+        tile = np_img if full_frame else np.ascontiguousarray(np_img[y0:y1, x0:x1])
+        with self._backend(backend if full_frame else tile_backend) as detector:
+            faces = detector.detect(tile)
+        for face in faces:
+            face['x'] += x0
+            face['y'] += y0
+        return faces
+
+    def detect_faces_tiled(self, image_bytes: bytes, backend: Optional[str] = None) -> List[Dict]:
+        """重なりを持つタイルに分割して並列に検出し、全体座標へ戻してNMSで統合"""
+        return self.detect_faces(image_bytes, 'tiled', backend)
+
+    def _detect_tiled(self, np_img, backend: str) -> List[Dict]:
+        """RGB ndarrayをタイル分割して検出
+
+        大きな顔がタイルで分割されないよう、全体画像1パスの結果も統合対象に含める。
+        """
+        height, width = np_img.shape[:2]
+        tile = Config.FACE_TILE_SIZE
+        overlap = Config.FACE_TILE_OVERLAP
+        boxes = [(0, 0, width, height)]
+        for ty in self._tile_origins(height, tile, overlap):
+            for tx in self._tile_origins(width, tile, overlap):
+                box = (tx, ty, min(width, tx + tile), min(height, ty + tile))
+                if box not in boxes:
+                    boxes.append(box)
+
+        # MediaPipeはタイル（近接した顔）向けに近距離モデルを使い、その他は同じバックエンドで検出
+        tile_backend = Config.FACE_TILE_BACKEND if backend.startswith('mediapipe') else backend
+        executor = self._get_tile_executor()
+        faces: List[Dict] = []
+        for tile_faces in executor.map(lambda b: self._detect_tile(np_img, b, backend, tile_backend), boxes):
+            faces.extend(tile_faces)
+        return self._non_max_suppression(faces, Config.FACE_TILE_NMS_IOU)
+
+    @traced("face_detector.detect")
+    def detect_faces_in_image(self, image, mode: Optional[str] = None, backend: Optional[str] = None) -> List[Dict]:
+        """PIL画像に対し、設定（single/tiled/auto）に応じて単一パスまたはタイル検出を実行
+
+        backendで検出バックエンド（mediapipe_short/mediapipe_long/opencv_dnn/opencv_haar）を指定できる。
+        """
+        backend = self.resolve_backend(backend)
+        try:
+            image = image.convert('RGB') if image.mode != 'RGB' else image
+        except Exception:
+            return []
+        if detection_pool is not None:
+            # 画素は共有メモリ経由でワーカープロセスへ渡し、検出をリクエストスレッドのGILから切り離す
+            try:
+                return detection_pool.detect(image, mode, backend)
+            except DetectorUnavailable:
+                # 設定不備はプロセス内で検出しても同じため、呼び出し元へ返す
+                raise
+            except FutureTimeoutError:
+                metrics.increment("face_detection.pool.timeout_fallback")
+                print("Detection pool timed out, detecting in-process")
+            except Exception as e:
+                metrics.increment("face_detection.pool.fallback")
+                print(f"Detection pool failed, detecting in-process: {e}")
+        import numpy as np
+
+        return self.detect_faces_in_array(np.asarray(image), mode, backend)
+
+    def detect_faces_in_array(self, np_img, mode: Optional[str] = None, backend: Optional[str] = None) -> List[Dict]:
+        """RGB ndarray（高さ×幅×3, uint8）に対して現在のプロセス内で顔検出を実行"""
+        backend = self.resolve_backend(backend)
+        mode = (mode or Config.FACE_DETECTION_MODE).lower()
+        if mode == 'auto':
+            mode = 'tiled' if max(np_img.shape[:2]) > Config.FACE_TILE_AUTO_LONG_SIDE else 'single'
+        try:
+            if mode == 'tiled':
+                return self._detect_tiled(np_img, backend)
+            with self._backend(backend) as detector:
+                return detector.detect(np_img)
+        except DetectorUnavailable:
+            # 設定不備を「顔なし」として返すと、取り込み時の検出結果として保存されてしまう
+            raise
+        except Exception:
+            return []
+
+    def detect_faces(self, image_bytes: bytes, mode: Optional[str] = None, backend: Optional[str] = None) -> List[Dict]:
+        """画像バイト列に対して設定に応じた顔検出を実行"""
         try:
             from PIL import Image
-            import numpy as np
-
-            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-            width, height = image.size
-            # MediaPipeの入力はRGB ndarray
-            np_img = np.array(image)
-            result = self.mp_face.process(np_img)
-            faces: List[Dict] = []
-            if result.detections:
-                for det in result.detections:
-                    # MediaPipeは相対座標のbbox
-                    bbox = det.location_data.relative_bounding_box
-                    x = max(0, int(bbox.xmin * width))
-                    y = max(0, int(bbox.ymin * height))
-                    w = int(bbox.width * width)
-                    h = int(bbox.height * height)
-                    # 画像範囲にクリップ
-                    w = max(1, min(w, width - x))
-                    h = max(1, min(h, height - y))
-                    faces.append({
-                        'x': x,
-                        'y': y,
-                        'width': w,
-                        'height': h,
-                        'confidence': float(det.score[0]) if det.score else 0.0,
-                    })
-            return faces
+
+            image = Image.open(io.BytesIO(image_bytes))
         except Exception:
             return []
-    
-    def get_face_regions(self, image_bytes: bytes) -> List[Tuple[int, int, int, int]]:
-        """検出された顔の領域を返す"""
-        faces = self.detect_faces_with_mediapipe(image_bytes)
-        
-        # (x, y, width, height) の形式で返す
+        return self.detect_faces_in_image(image, mode, backend)
+
+    @staticmethod
+    def _to_regions(faces: List[Dict]) -> List[Tuple[int, int, int, int]]:
+        """検出結果を (x, y, width, height) の形式に変換"""
         regions = []
         for face in faces:
             regions.append((
@@ -62,3 +361,14 @@ class FaceDetector:
             ))
         
         return regions
+
+    def get_face_regions_from_image(self, image, mode: Optional[str] = None, backend: Optional[str] = None) -> List[Tuple[int, int, int, int]]:
+        """PIL画像から検出された顔の領域を返す"""
+        return self._to_regions(self.detect_faces_in_image(image, mode, backend))
+
+    def get_face_regions(self, image_bytes: bytes, mode: Optional[str] = None, backend: Optional[str] = None) -> List[Tuple[int, int, int, int]]:
+        """検出された顔の領域を返す"""
+        faces = self.detect_faces(image_bytes, mode, backend)
+        
+        # (x, y, width, height) の形式で返す
+        return self._to_regions(faces)
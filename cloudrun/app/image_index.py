@@ -0,0 +1,194 @@
+"""処理済み画像のメタデータ索引（SQLite）"""
+import base64
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from config import Config
+from metrics import metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    created TEXT,
+    created_ts REAL NOT NULL,
+    format TEXT,
+    edit_type TEXT,
+    faces_detected INTEGER,
+    fallback_used INTEGER,
+    updated REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_images_created ON images (created_ts DESC, name DESC);
+CREATE INDEX IF NOT EXISTS idx_images_edit_type ON images (edit_type, created_ts DESC, name DESC);
+CREATE INDEX IF NOT EXISTS idx_images_faces ON images (faces_detected, created_ts DESC);
+CREATE INDEX IF NOT EXISTS idx_images_fallback ON images (fallback_used, created_ts DESC);
+"""
+
+_COLUMNS = ("name", "size", "created", "created_ts", "format", "edit_type", "faces_detected", "fallback_used")
+
+
+class ImageIndex:
+    """アップロード時に書き込み、一覧をページ単位の索引検索で返すクラス"""
+
+    def __init__(self, path: str):
+        """索引の初期化（テーブル・インデックスが無ければ作成）"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            # updated列の無い旧版の索引に列を追加
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(images)")}
+            if "updated" not in columns:
+                self._conn.execute("ALTER TABLE images ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+            self._conn.commit()
+
+    @staticmethod
+    def _timestamp(created: Optional[datetime]) -> Tuple[Optional[str], float]:
+        created = created or datetime.now(timezone.utc)
+        return created.isoformat(), created.timestamp()
+
+    @staticmethod
+    def _encode_cursor(row: sqlite3.Row) -> str:
+        raw = f"{row['created_ts']!r}|{row['name']}".encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[float, str]:
+        try:
+            ts, name = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+            return float(ts), name
+        except Exception as e:
+            raise ValueError(f"不正なcursorです: {e}")
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM images LIMIT 1").fetchone() is None
+
+    _UPSERT_SQL = """
+        INSERT INTO images (name, size, created, created_ts, format, edit_type, faces_detected, fallback_used, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            updated = excluded.updated,
+            size = excluded.size,
+            created = excluded.created,
+            created_ts = excluded.created_ts,
+            format = COALESCE(excluded.format, images.format),
+            edit_type = COALESCE(excluded.edit_type, images.edit_type),
+            faces_detected = COALESCE(excluded.faces_detected, images.faces_detected),
+            fallback_used = COALESCE(excluded.fallback_used, images.fallback_used)
+    """
+
+    def _row(self, name: str, size: Optional[int], created: Optional[datetime] = None,
+             format: Optional[str] = None, edit_type: Optional[str] = None,
+             faces_detected: Optional[int] = None, fallback_used: Optional[bool] = None) -> Tuple:
+        created_iso, created_ts = self._timestamp(created)
+        return (name, size, created_iso, created_ts, format, edit_type,
+                None if faces_detected is None else int(faces_detected),
+                None if fallback_used is None else int(bool(fallback_used)), time.time())
+
+    def upsert(self, name: str, size: Optional[int], created: Optional[datetime] = None,
+               format: Optional[str] = None, edit_type: Optional[str] = None,
+               faces_detected: Optional[int] = None, fallback_used: Optional[bool] = None) -> None:
+        """画像1件を登録・更新（未指定の編集情報は既存値を保持）"""
+        row = self._row(name, size, created, format, edit_type, faces_detected, fallback_used)
+        with self._lock:
+            self._conn.execute(self._UPSERT_SQL, row)
+            self._conn.commit()
+
+    def delete(self, name: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM images WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def query(self, limit: int, cursor: Optional[str] = None, edit_type: Optional[str] = None,
+              min_faces: Optional[int] = None, max_faces: Optional[int] = None,
+              fallback_used: Optional[bool] = None, since: Optional[datetime] = None,
+              until: Optional[datetime] = None) -> Tuple[List[Dict], Optional[str]]:
+        """新しい順に1ページ分を返す (画像リスト, 次ページのcursor)
+
+        cursorは直前ページ末尾の (作成時刻, 名前) によるキーセット方式のため、
+        ページ取得のコストは索引全体の件数ではなくページサイズに比例する。
+        """
+        clauses, params = [], []
+        if edit_type is not None:
+            clauses.append("edit_type = ?")
+            params.append(edit_type)
+        if min_faces is not None:
+            clauses.append("faces_detected >= ?")
+            params.append(int(min_faces))
+        if max_faces is not None:
+            clauses.append("faces_detected <= ?")
+            params.append(int(max_faces))
+        if fallback_used is not None:
+            clauses.append("fallback_used = ?")
+            params.append(int(bool(fallback_used)))
+        if since is not None:
+            clauses.append("created_ts >= ?")
+            params.append(since.timestamp())
+        if until is not None:
+            clauses.append("created_ts < ?")
+            params.append(until.timestamp())
+        if cursor:
+            ts, name = self._decode_cursor(cursor)
+            clauses.append("(created_ts < ? OR (created_ts = ? AND name < ?))")
+            params.extend([ts, ts, name])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = (f"SELECT {', '.join(_COLUMNS)} FROM images {where} "
+               "ORDER BY created_ts DESC, name DESC LIMIT ?")
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        next_cursor = self._encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        images = []
+        for row in rows[:limit]:
+            images.append({
+                "name": row["name"],
+                "size": row["size"],
+                "created": row["created"],
+                "format": row["format"],
+                "edit_type": row["edit_type"],
+                "faces_detected": row["faces_detected"],
+                "fallback_used": None if row["fallback_used"] is None else bool(row["fallback_used"])
+            })
+        return images, next_cursor
+
+    def _upsert_many(self, rows: List[Tuple]) -> int:
+        if rows:
+            with self._lock:
+                self._conn.executemany(self._UPSERT_SQL, rows)
+                self._conn.commit()
+        return len(rows)
+
+    def reconcile(self, entries: Iterable[Dict]) -> Dict:
+        """バケットの一覧（name/size/created/メタデータ）から索引を再構築
+
+        一覧にある行は一覧の値で登録・更新し、走査開始より前から更新されていない行（バケットに無い行）を削除する。
+        走査中にアップロードされた行は一覧に無くても走査開始後に書き込まれているため削除しない。
+        """
+        scan_started = time.time()
+        batch: List[Tuple] = []
+        upserted = 0
+        for entry in entries:
+            batch.append(self._row(
+                entry["name"], entry.get("size"), entry.get("created"), entry.get("format"),
+                entry.get("edit_type"), entry.get("faces_detected"), entry.get("fallback_used")
+            ))
+            if len(batch) >= 500:
+                upserted += self._upsert_many(batch)
+                batch = []
+        upserted += self._upsert_many(batch)
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM images WHERE updated < ?", (scan_started,)).rowcount
+            self._conn.commit()
+        metrics.increment("image_index.reconciled")
+        return {"upserted": upserted, "deleted": deleted}
+
+
+# プロセス共通の画像索引
+image_index = ImageIndex(Config.IMAGE_INDEX_PATH)
@@ -1,54 +1,200 @@
 """画像処理サービス"""
 import io
 import base64
-from typing import Dict, Optional
-from PIL import Image
+import time
+from typing import Dict, Optional, Tuple
+from PIL import Image, features
 from config import Config
+from tracing import traced
+from metrics import metrics
 
 class ImageProcessor:
     """画像処理を管理するクラス"""
     
     @staticmethod
     def decode_base64_image(base64_data: str) -> Image.Image:
-        """Base64エンコードされた画像をデコード"""
+        """Base64エンコードされた画像をデコード（ヘッダのみ読み込み、画素のデコードは遅延）"""
         try:
             image_data = base64.b64decode(base64_data)
-            return Image.open(io.BytesIO(image_data))
         except Exception as e:
             raise Exception(f"Base64画像のデコードに失敗しました: {str(e)}")
-    
+        return ImageProcessor.open_image_bytes(image_data)
+
     @staticmethod
-    def validate_image(image: Image.Image) -> None:
-        """画像の検証"""
-        # 画像サイズの検証
-        img_byte_arr = io.BytesIO()
-        fmt = image.format if image.format else 'PNG'
-        image.save(img_byte_arr, format=fmt)
-        
-        if len(img_byte_arr.getvalue()) > Config.MAX_IMAGE_SIZE:
+    @traced("image.open")
+    def open_image_bytes(image_data: bytes) -> Image.Image:
+        """バイト長とヘッダ（形式・寸法・フレーム数）を検証してから画像を開く"""
+        if len(image_data) > Config.MAX_IMAGE_SIZE:
             raise Exception(f"画像サイズが大きすぎます。最大{Config.MAX_IMAGE_SIZE // (1024*1024)}MBまで")
-        
+        try:
+            # Image.openはヘッダのみを解析し、画素のデコードはload()まで行わない
+            image = Image.open(io.BytesIO(image_data))
+        except Exception as e:
+            raise Exception(f"画像のデコードに失敗しました: {str(e)}")
+        # 画素数上限でデコード時に縮小しても元の寸法を参照できるよう保持
+        image.info['source_size'] = image.size
+        ImageProcessor.validate_image(image)
+        return image
+
+    @staticmethod
+    def source_size(image: Image.Image) -> Tuple[int, int]:
+        """デコード時の縮小前の寸法（元データの座標系）"""
+        return tuple(image.info.get('source_size', image.size))
+
+    @staticmethod
+    @traced("image.validate")
+    def validate_image(image: Image.Image) -> None:
+        """画像の検証（ヘッダ情報のみで判定し、画素のデコード・再エンコードは行わない）"""
         # 画像形式の検証
         if image.format and image.format.lower() not in [fmt[1:] for fmt in Config.ALLOWED_IMAGE_FORMATS]:
             raise Exception(f"サポートされていない画像形式です: {image.format}")
+
+        # フレーム数の検証（アニメーションGIF等）
+        n_frames = getattr(image, 'n_frames', 1)
+        if n_frames > Config.MAX_IMAGE_FRAMES:
+            raise Exception(f"フレーム数が多すぎます。最大{Config.MAX_IMAGE_FRAMES}フレームまで")
+
+        # ピクセル数の検証（上限超過のJPEGはdraftモードでデコード時に縮小して受け付ける）
+        width, height = image.size
+        if width * height <= Config.MAX_IMAGE_PIXELS:
+            return
+        if Config.PIXEL_BUDGET_ACTION == 'downscale' and image.format == 'JPEG' and image.tile:
+            # DCTスケーリングは1/2,1/4,1/8のみのため、上限に収まる最小の縮小率を選ぶ
+            for denom in (2, 4, 8):
+                if -(-width // denom) * -(-height // denom) <= Config.MAX_IMAGE_PIXELS:
+                    image.draft('RGB', (max(1, width // denom), max(1, height // denom)))
+                    break
+            width, height = image.size
+            if width * height <= Config.MAX_IMAGE_PIXELS:
+                return
+        raise Exception(f"画像の画素数が大きすぎます: {width}x{height}（最大{Config.MAX_IMAGE_PIXELS}ピクセル）")
     
     @staticmethod
-    def downscale_if_needed(image: Image.Image) -> Image.Image:
-        """長辺が設定値を超える場合に縮小。"""
+    def _reopen(image: Image.Image) -> Optional[Image.Image]:
+        """未デコードの画像を同じデータから開き直す（開けない場合はNone）"""
+        fp = getattr(image, 'fp', None)
+        if fp is None:
+            return None
+        try:
+            position = fp.tell()
+            fp.seek(0)
+            data = fp.read()
+            fp.seek(position)
+            return Image.open(io.BytesIO(data))
+        except Exception:
+            return None
+
+    @staticmethod
+    @traced("image.downscale")
+    def downscale_if_needed(image: Image.Image, long_side: Optional[int] = None) -> Image.Image:
+        """長辺が設定値を超える場合に縮小。
+
+        未デコードのJPEGはdraftモード（DCTスケーリング）で目標サイズ付近までデコード時に縮小し、
+        残りをreducing_gap付きLANCZOSで一度だけリサイズする。draftは開き直した画像に適用するため、
+        渡した画像（フル解像度のまま保持・保存されるもの）は変更しない。
+        """
         try:
             width, height = image.size
-            long_side = max(width, height)
-            target = Config.RESIZE_LONG_SIDE
-            if long_side <= target:
+            current_long_side = max(width, height)
+            target = long_side or Config.RESIZE_LONG_SIDE
+            if current_long_side <= target:
                 return image
-            scale = target / float(long_side)
-            new_size = (int(width * scale), int(height * scale))
-            # RGB化して高品質リサンプリング
+            scale = target / float(current_long_side)
+            new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            # JPEGはデコード前なら1/2,1/4,1/8のDCTスケーリングで読み込む（目標サイズ以上を保証）
+            if image.format == 'JPEG' and image.tile:
+                draft = ImageProcessor._reopen(image)
+                if draft is not None:
+                    draft.draft('RGB', new_size)
+                    image = draft
+            # RGB化して高品質リサンプリング（reducing_gapで整数縮小を先に行い高速化）
             img_rgb = image.convert('RGB') if image.mode != 'RGB' else image
-            return img_rgb.resize(new_size, Image.Resampling.LANCZOS)
+            if img_rgb.size == new_size:
+                return img_rgb
+            return img_rgb.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
         except Exception:
             return image
     
+    @staticmethod
+    def negotiate_output_format(accept_header: Optional[str] = None, requested: Optional[str] = None,
+                                source_format: Optional[str] = None) -> str:
+        """リクエスト指定 > Acceptヘッダ > 既定設定 の順で出力形式（PIL形式名）を決定"""
+        available = [fmt for fmt in Config.OUTPUT_IMAGE_FORMATS if fmt != 'avif' or features.check('avif')]
+        if requested:
+            requested = requested.lower().replace('jpg', 'jpeg')
+            if requested in available:
+                return requested.upper()
+        if accept_header:
+            accept = accept_header.lower()
+            for fmt in ('avif', 'webp'):
+                if f"image/{fmt}" in accept and fmt in available:
+                    return fmt.upper()
+        if Config.OUTPUT_FORMAT in available:
+            return Config.OUTPUT_FORMAT.upper()
+        return source_format or 'PNG'
+
+    @staticmethod
+    def _encode_once(image: Image.Image, fmt: str, quality: int) -> bytes:
+        """指定形式・品質で1回エンコード"""
+        buf = io.BytesIO()
+        if fmt == 'JPEG':
+            img = image.convert('RGB') if image.mode not in ('RGB', 'L') else image
+            img.save(buf, format='JPEG', quality=quality, optimize=True, progressive=True)
+        elif fmt in ('WEBP', 'AVIF'):
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+            if fmt == 'WEBP':
+                image.save(buf, format='WEBP', quality=quality, method=4)
+            else:
+                image.save(buf, format='AVIF', quality=quality, speed=8)
+        else:
+            image.save(buf, format=fmt)
+        return buf.getvalue()
+
+    @staticmethod
+    @traced("image.encode")
+    def encode_image(image: Image.Image, output_format: Optional[str] = None,
+                     target_bytes: Optional[int] = None) -> Tuple[bytes, str]:
+        """画像をエンコードし (バイト列, 形式) を返す
+
+        target_bytes指定時は非可逆形式の品質を二分探索し、予算内で最も高い品質を選ぶ
+        （下限品質でも収まらない場合は下限品質の結果を返す）。
+        """
+        fmt = (output_format or image.format or 'PNG').upper()
+        started = time.monotonic()
+        quality = Config.JPEG_QUALITY
+        data = ImageProcessor._encode_once(image, fmt, quality)
+        if target_bytes and fmt in ('JPEG', 'WEBP', 'AVIF') and len(data) > target_bytes:
+            lo, hi = Config.TARGET_MIN_QUALITY, quality - 1
+            best = None
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                candidate = ImageProcessor._encode_once(image, fmt, mid)
+                if len(candidate) <= target_bytes:
+                    best = candidate
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+            data = best if best is not None else ImageProcessor._encode_once(image, fmt, Config.TARGET_MIN_QUALITY)
+        metrics.observe(f"encode.{fmt.lower()}.ms", (time.monotonic() - started) * 1000)
+        metrics.observe(f"encode.{fmt.lower()}.bytes", len(data))
+        return data, fmt
+
+    @staticmethod
+    def to_data_url(image_bytes: bytes, fmt: str) -> str:
+        """エンコード済み画像をData URLに変換"""
+        base64_data = base64.b64encode(image_bytes).decode('utf-8')
+        return f"data:image/{fmt.lower()};base64,{base64_data}"
+
+    @staticmethod
+    @traced("image.preview")
+    def create_preview_data_url(image: Image.Image) -> str:
+        """長辺PREVIEW_LONG_SIDEの軽量プレビューをData URLで返す"""
+        preview = ImageProcessor.downscale_if_needed(image, Config.PREVIEW_LONG_SIDE)
+        fmt = ImageProcessor.negotiate_output_format(requested=Config.PREVIEW_FORMAT, source_format='JPEG')
+        preview_bytes, fmt = ImageProcessor.encode_image(preview, fmt)
+        return ImageProcessor.to_data_url(preview_bytes, fmt)
+
     @staticmethod
     def process_image(image: Image.Image) -> Image.Image:
         """画像の基本処理（リサイズ適用）"""
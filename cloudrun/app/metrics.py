@@ -0,0 +1,53 @@
+"""プロセス内メトリクス収集サービス"""
+import threading
+from typing import Dict
+
+
+class Metrics:
+    """カウンタ・ゲージ・計測値をスレッドセーフに保持するクラス"""
+
+    def __init__(self):
+        """メトリクスの初期化"""
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._observations: Dict[str, Dict[str, float]] = {}
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """カウンタを加算"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """ゲージを現在値で上書き"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """計測値（処理時間・サイズ等）を記録し、件数/合計/最大を集計"""
+        with self._lock:
+            stat = self._observations.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+            stat["count"] += 1
+            stat["sum"] += value
+            stat["max"] = max(stat["max"], value)
+
+    def snapshot(self) -> Dict:
+        """現在のメトリクスをJSON化可能な形で返す"""
+        with self._lock:
+            observations = {}
+            for name, stat in self._observations.items():
+                observations[name] = {
+                    "count": stat["count"],
+                    "sum": stat["sum"],
+                    "max": stat["max"],
+                    "avg": stat["sum"] / stat["count"] if stat["count"] else 0.0,
+                }
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "observations": observations,
+            }
+
+
+# プロセス共通のメトリクスインスタンス
+metrics = Metrics()
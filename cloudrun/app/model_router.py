@@ -0,0 +1,113 @@
+"""編集バックエンド（Imagen各バリアント・SDXL・ローカル描画）の適応的ルーティング"""
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+from config import Config
+from metrics import metrics
+
+
+class _BackendStats:
+    """直近ROUTER_WINDOW回の成否と所要時間"""
+
+    def __init__(self, window: int):
+        self.samples = deque(maxlen=window)
+
+    def success_rate(self) -> float:
+        """成功率（事前分布 Beta(1,1) で平滑化し、未計測のバックエンドも試行されるようにする）"""
+        successes = sum(1 for ok, _ in self.samples if ok)
+        return (successes + 1.0) / (len(self.samples) + 2.0)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        latencies = sorted(ms for _, ms in self.samples)
+        index = min(len(latencies) - 1, int(round(q * (len(latencies) - 1))))
+        return latencies[index]
+
+    def snapshot(self) -> Dict:
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        return {
+            "samples": len(self.samples),
+            "success_rate": round(self.success_rate(), 4),
+            "p50_ms": round(p50, 1) if p50 is not None else None,
+            "p95_ms": round(p95, 1) if p95 is not None else None
+        }
+
+
+class ModelRouter:
+    """バックエンドごとの成功率・レイテンシから、試行順と省略するバックエンドを決めるクラス
+
+    1回の試行コストを c（p50レイテンシ + コスト重み×呼び出し単価）、成功確率を p とすると、
+    成功するまで順に試す場合の期待所要時間は c/p の昇順に並べたときに最小になる。
+    """
+
+    def __init__(self):
+        """ルーターの初期化"""
+        self._lock = threading.Lock()
+        self._stats: Dict[str, _BackendStats] = {}
+        self._plans = 0
+
+    def _get(self, backend: str) -> _BackendStats:
+        """バックエンドの統計を返す（ロック保持中に呼ぶ）"""
+        if backend not in self._stats:
+            self._stats[backend] = _BackendStats(Config.ROUTER_WINDOW)
+        return self._stats[backend]
+
+    @staticmethod
+    def _unit_cost(backend: str) -> float:
+        return Config.ROUTER_BACKEND_COSTS.get(backend.split('_', 1)[0], 0.0)
+
+    def record(self, backend: str, success: bool, latency_ms: float) -> None:
+        """1回の試行結果を記録"""
+        with self._lock:
+            self._get(backend).samples.append((bool(success), latency_ms))
+        metrics.increment(f"router.{backend}.{'success' if success else 'failure'}")
+        metrics.observe(f"router.{backend}.ms", latency_ms)
+
+    def record_deadline(self, backend: str) -> None:
+        """リクエストの期限による打ち切り（呼び出し前の拒否を含む）を記録
+
+        バックエンドの成否ではなく呼び出し元の期限によるものなので、成功率・レイテンシには含めない。
+        """
+        metrics.increment(f"router.{backend}.deadline_aborted")
+
+    def plan(self, backends: List[str], remaining_ms: Optional[float] = None) -> Dict:
+        """試行順を決定し {"order", "skipped", "scores"} を返す
+
+        十分な試行数があり成功率が閾値未満のバックエンドは省略する（ROUTER_PROBE_INTERVAL回に
+        1回は回復を確認するため末尾で試行）。残り時間が分かる場合、計測済みのp50が残り時間を超えるものも省略する。
+        """
+        with self._lock:
+            self._plans += 1
+            probe = Config.ROUTER_PROBE_INTERVAL > 0 and self._plans % Config.ROUTER_PROBE_INTERVAL == 0
+            scored, skipped, probes = [], [], []
+            scores = {}
+            for backend in backends:
+                stats = self._get(backend)
+                p = stats.success_rate()
+                latency = stats.percentile(0.5) or Config.ROUTER_DEFAULT_LATENCY_MS
+                score = (latency + Config.ROUTER_COST_WEIGHT_MS * self._unit_cost(backend)) / p
+                scores[backend] = round(score, 1)
+                if remaining_ms is not None and stats.samples and latency > remaining_ms:
+                    skipped.append({"backend": backend, "reason": "deadline"})
+                elif len(stats.samples) >= Config.ROUTER_MIN_SAMPLES and p < Config.ROUTER_SKIP_SUCCESS_RATE:
+                    if probe:
+                        probes.append(backend)
+                    else:
+                        skipped.append({"backend": backend, "reason": "low_success_rate"})
+                else:
+                    scored.append((score, backends.index(backend), backend))
+        order = [backend for _, _, backend in sorted(scored)] + probes
+        for entry in skipped:
+            metrics.increment(f"router.{entry['backend']}.skipped.{entry['reason']}")
+        return {"order": order, "skipped": skipped, "scores": scores}
+
+    def snapshot(self) -> Dict:
+        """バックエンドごとの統計"""
+        with self._lock:
+            return {backend: stats.snapshot() for backend, stats in self._stats.items()}
+
+
+# プロセス共通のルーター
+model_router = ModelRouter()
@@ -0,0 +1,166 @@
+"""AI編集結果の近似重複索引（知覚ハッシュ＋顔配置で連写画像の編集結果を再利用）"""
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+from PIL import Image
+from config import Config
+from metrics import metrics
+
+# 知覚ハッシュのビット数（DCT低周波 8x8）
+HASH_BITS = 64
+_DCT_SIZE = 32
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n).reshape(-1, 1)
+    return np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2 * n))
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """縮小グレースケールのDCT低周波成分を中央値で2値化した64bitのハッシュ"""
+    gray = image.convert('L').resize((_DCT_SIZE, _DCT_SIZE), Image.Resampling.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].flatten()
+    # 直流成分（明るさ）は除いて中央値を求める
+    bits = low > np.median(low[1:])
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+def _normalized_layout(image_size: Tuple[int, int], face_regions: List[Tuple[int, int, int, int]]) -> List[Tuple[float, float, float, float]]:
+    """顔領域を画像サイズで正規化した (中心x, 中心y, 幅, 高さ)"""
+    width, height = image_size
+    return [((x + w / 2) / width, (y + h / 2) / height, w / width, h / height) for (x, y, w, h) in face_regions]
+
+
+class _Entry:
+    """索引に保持する編集結果（顔ごとの編集済みパッチのみを保持し、画像全体は持たない）"""
+
+    def __init__(self, entry_id: int, scope: str, phash: int, edit_type: str, image_size: Tuple[int, int],
+                 face_regions: List[Tuple[int, int, int, int]], patches: List[Tuple[Tuple[int, int, int, int], Image.Image]]):
+        self.id = entry_id
+        self.scope = scope
+        self.phash = phash
+        self.edit_type = edit_type
+        self.image_size = image_size
+        self.face_regions = face_regions
+        self.layout = _normalized_layout(image_size, face_regions)
+        self.patches = patches
+        self.bytes = sum(p.width * p.height * len(p.getbands()) for _, p in patches)
+
+
+class NearDuplicateIndex:
+    """知覚ハッシュのハミング距離と顔配置の一致で、過去の編集結果を引き当てるクラス（件数・バイト上限付きLRU）
+
+    ハッシュをmax_distance+1個の区間に分け、区間ごとの値で索引する（鳩の巣原理により、距離が
+    max_distance以下の候補は少なくとも1区間が完全一致する）ため、全件走査せずに候補を絞り込める。
+    索引はスコープ（アルバム等）ごとに分かれ、別スコープの編集結果（他人の顔パッチ）は引き当てない。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, max_distance: int, layout_tolerance: float):
+        """近似重複索引の初期化"""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_distance = max(0, min(max_distance, HASH_BITS - 1))
+        self.layout_tolerance = layout_tolerance
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._ids = itertools.count(1)
+        segments = self.max_distance + 1
+        bounds = [HASH_BITS * i // segments for i in range(segments + 1)]
+        # (開始ビット, ビットマスク)
+        self._segments = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        # (スコープ, 区間番号, 編集タイプ, 顔数, 区間の値) -> エントリID
+        self._buckets: Dict[Tuple[str, int, str, int, int], Set[int]] = {}
+
+    def _bucket_keys(self, scope: str, phash: int, edit_type: str, faces: int) -> List[Tuple[str, int, str, int, int]]:
+        return [(scope, i, edit_type, faces, (phash >> lo) & mask) for i, (lo, mask) in enumerate(self._segments)]
+
+    def _layout_matches(self, entry: _Entry, image_size: Tuple[int, int],
+                        face_regions: List[Tuple[int, int, int, int]]) -> Optional[List[int]]:
+        """顔の位置・大きさが許容差内なら、新しい顔ごとに対応するエントリ側の顔番号を返す"""
+        width, height = image_size
+        old_width, old_height = entry.image_size
+        if abs(width / height - old_width / old_height) > self.layout_tolerance:
+            return None
+        tol = self.layout_tolerance
+        unmatched = set(range(len(entry.layout)))
+        pairs = []
+        for cx, cy, w, h in _normalized_layout(image_size, face_regions):
+            best = min(unmatched, key=lambda j: (entry.layout[j][0] - cx) ** 2 + (entry.layout[j][1] - cy) ** 2)
+            ox, oy, ow, oh = entry.layout[best]
+            if abs(ox - cx) > tol or abs(oy - cy) > tol or abs(ow - w) > tol or abs(oh - h) > tol:
+                return None
+            unmatched.discard(best)
+            pairs.append(best)
+        return pairs
+
+    def lookup(self, scope: str, image: Image.Image, face_regions: List[Tuple[int, int, int, int]],
+               edit_type: str) -> Optional[Tuple[_Entry, List[int], int]]:
+        """同じスコープ内の近似重複の (エントリ, 顔の対応, ハミング距離) を返す（無ければNone）"""
+        if not face_regions:
+            return None
+        phash = perceptual_hash(image)
+        with self._lock:
+            candidates: Set[int] = set()
+            for key in self._bucket_keys(scope, phash, edit_type, len(face_regions)):
+                candidates |= self._buckets.get(key, set())
+            best = None
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                distance = bin(entry.phash ^ phash).count("1")
+                if distance > self.max_distance or (best is not None and distance >= best[2]):
+                    continue
+                pairs = self._layout_matches(entry, image.size, face_regions)
+                if pairs is not None:
+                    best = (entry, pairs, distance)
+            if best is None:
+                metrics.increment("near_duplicate.miss")
+                return None
+            self._entries.move_to_end(best[0].id)
+        metrics.increment("near_duplicate.hit")
+        metrics.observe("near_duplicate.distance", best[2])
+        return best
+
+    def add(self, scope: str, image: Image.Image, face_regions: List[Tuple[int, int, int, int]], edit_type: str,
+            patches: List[Tuple[Tuple[int, int, int, int], Image.Image]]) -> None:
+        """編集元画像のハッシュと顔ごとの編集済みパッチ (元画像上の矩形, パッチ) をスコープに登録"""
+        if not face_regions:
+            return
+        phash = perceptual_hash(image)
+        with self._lock:
+            entry = _Entry(next(self._ids), scope, phash, edit_type, image.size, list(face_regions), patches)
+            self._entries[entry.id] = entry
+            self._bytes += entry.bytes
+            for key in self._bucket_keys(scope, phash, edit_type, len(face_regions)):
+                self._buckets.setdefault(key, set()).add(entry.id)
+            self._evict()
+
+    def _evict(self) -> None:
+        """件数・バイト上限を超えた分を古い順に削除（ロック保持中に呼ぶ）"""
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.bytes
+            for key in self._bucket_keys(entry.scope, entry.phash, entry.edit_type, len(entry.face_regions)):
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(entry.id)
+                    if not bucket:
+                        del self._buckets[key]
+            metrics.increment("near_duplicate.evicted")
+        metrics.set_gauge("near_duplicate.entries", len(self._entries))
+        metrics.set_gauge("near_duplicate.bytes", self._bytes)
+
+
+# プロセス共通の近似重複索引（NEAR_DUPLICATE_ENABLED=falseなら無効）
+near_duplicate_index = NearDuplicateIndex(
+    Config.NEAR_DUPLICATE_MAX_ENTRIES,
+    Config.NEAR_DUPLICATE_MAX_BYTES,
+    Config.NEAR_DUPLICATE_MAX_DISTANCE,
+    Config.NEAR_DUPLICATE_LAYOUT_TOLERANCE
+) if Config.NEAR_DUPLICATE_ENABLED else None
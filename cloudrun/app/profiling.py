@@ -0,0 +1,201 @@
+"""リクエスト単位のオンデマンドCPU・メモリプロファイリング"""
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import secrets
+import shutil
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+from config import Config
+from metrics import metrics
+
+# cProfileは同時に1つしか有効にできないため、プロファイル対象は同時に1リクエストまで
+_active_lock = threading.Lock()
+
+PROFILE_FILES = {
+    "summary": ("summary.json", "application/json"),
+    "cpu": ("cpu.prof", "application/octet-stream"),
+}
+
+
+def _token_matches(token: Optional[str]) -> bool:
+    return bool(Config.PROFILING_TOKEN) and bool(token) and hmac.compare_digest(token, Config.PROFILING_TOKEN)
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """プロファイル一覧・取得の可否（PROFILING_TOKENとの一致が必要。未設定なら常に拒否）"""
+    return Config.PROFILING_ENABLED and _token_matches(token)
+
+
+class ProfileSession:
+    """1リクエスト分のcProfileとtracemallocの計測"""
+
+    def __init__(self, method: str, path: str, trace_id: str, reason: str):
+        self.profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(4)}"
+        self.method = method
+        self.path = path
+        self.trace_id = trace_id
+        self.reason = reason
+        self._profiler = cProfile.Profile()
+        self._owns_tracemalloc = False
+        self._started = 0.0
+        self._started_wall = 0.0
+        self.duration_ms = 0.0
+        self._snapshot = None
+        self._memory = (0, 0)
+
+    def start(self) -> None:
+        self._started_wall = time.time()
+        self._started = time.monotonic()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(Config.PROFILE_TRACEMALLOC_FRAMES)
+            self._owns_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._profiler.enable()
+
+    def stop(self) -> None:
+        self._profiler.disable()
+        self.duration_ms = (time.monotonic() - self._started) * 1000
+        self._memory = tracemalloc.get_traced_memory()
+        self._snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        _active_lock.release()
+
+    def _top_functions(self, limit: int = 30) -> List[Dict]:
+        stats = pstats.Stats(self._profiler, stream=io.StringIO())
+        rows = []
+        for (filename, line, func), (cc, nc, tt, ct, _) in stats.stats.items():
+            rows.append({
+                "function": f"{os.path.basename(filename)}:{line}({func})",
+                "calls": nc,
+                "self_ms": round(tt * 1000, 3),
+                "cumulative_ms": round(ct * 1000, 3),
+            })
+        rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+        return rows[:limit]
+
+    def _top_allocations(self, limit: int = 20) -> List[Dict]:
+        allocations = []
+        for stat in self._snapshot.statistics('lineno')[:limit]:
+            frame = stat.traceback[0]
+            allocations.append({
+                "location": f"{frame.filename}:{frame.lineno}",
+                "size_kb": round(stat.size / 1024, 1),
+                "count": stat.count,
+            })
+        return allocations
+
+    def save(self, stages: List[Dict]) -> str:
+        """プロファイルを保存し、保存先ディレクトリを返す"""
+        directory = os.path.join(Config.PROFILE_DIR, self.profile_id)
+        os.makedirs(directory, exist_ok=True)
+        self._profiler.dump_stats(os.path.join(directory, PROFILE_FILES["cpu"][0]))
+        current, peak = self._memory
+        summary = {
+            "profile_id": self.profile_id,
+            "trace_id": self.trace_id,
+            "method": self.method,
+            "path": self.path,
+            "reason": self.reason,
+            "started": self._started_wall,
+            "duration_ms": round(self.duration_ms, 1),
+            "memory": {
+                # tracemallocはプロセス全体の割り当てを計測する（同時実行中の他リクエスト分も含む）
+                "peak_bytes": peak,
+                "current_bytes": current,
+                "top_allocations": self._top_allocations(),
+            },
+            "stages": stages,
+            "top_functions": self._top_functions(),
+        }
+        with open(os.path.join(directory, PROFILE_FILES["summary"][0]), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        metrics.increment("profiling.captured")
+        _prune()
+        return directory
+
+
+def maybe_start(method: str, path: str, trace_id: str, token: Optional[str]) -> Optional[ProfileSession]:
+    """特権ヘッダまたはサンプリングに該当し、他にプロファイル中のリクエストが無ければ計測を開始"""
+    if not Config.PROFILING_ENABLED:
+        return None
+    if _token_matches(token):
+        reason = "header"
+    elif Config.PROFILING_SAMPLE_RATE > 0 and random.random() < Config.PROFILING_SAMPLE_RATE:
+        reason = "sampled"
+    else:
+        return None
+    if not _active_lock.acquire(blocking=False):
+        metrics.increment("profiling.skipped_busy")
+        return None
+    session = ProfileSession(method, path, trace_id, reason)
+    try:
+        session.start()
+    except Exception:
+        _active_lock.release()
+        raise
+    return session
+
+
+def stages_from_spans(spans: List[Dict]) -> List[Dict]:
+    """トレースのスパンを段階別時間（開始順）に変換"""
+    ordered = sorted(spans, key=lambda s: s["start"])
+    origin = ordered[0]["start"] if ordered else 0.0
+    return [{
+        "name": s["name"],
+        "span_id": s["span_id"],
+        "parent_id": s["parent_id"],
+        "offset_ms": round((s["start"] - origin) * 1000, 3),
+        "duration_ms": s["duration_ms"],
+        "attributes": s["attributes"],
+    } for s in ordered]
+
+
+def _prune() -> None:
+    """古いプロファイルを削除しPROFILE_MAX_COUNT件以内に保つ"""
+    entries = sorted(list_profile_ids(), reverse=True)
+    for profile_id in entries[Config.PROFILE_MAX_COUNT:]:
+        shutil.rmtree(os.path.join(Config.PROFILE_DIR, profile_id), ignore_errors=True)
+
+
+def list_profile_ids() -> List[str]:
+    if not os.path.isdir(Config.PROFILE_DIR):
+        return []
+    return [name for name in os.listdir(Config.PROFILE_DIR)
+            if os.path.isfile(os.path.join(Config.PROFILE_DIR, name, PROFILE_FILES["summary"][0]))]
+
+
+def list_profiles() -> List[Dict]:
+    """保存済みプロファイルの概要（新しい順）"""
+    profiles = []
+    for profile_id in sorted(list_profile_ids(), reverse=True):
+        with open(os.path.join(Config.PROFILE_DIR, profile_id, PROFILE_FILES["summary"][0]), encoding='utf-8') as f:
+            summary = json.load(f)
+        profiles.append({
+            "profile_id": profile_id,
+            "trace_id": summary.get("trace_id"),
+            "method": summary.get("method"),
+            "path": summary.get("path"),
+            "reason": summary.get("reason"),
+            "started": summary.get("started"),
+            "duration_ms": summary.get("duration_ms"),
+            "peak_bytes": summary.get("memory", {}).get("peak_bytes"),
+        })
+    return profiles
+
+
+def profile_file(profile_id: str, kind: str) -> Optional[str]:
+    """プロファイルのファイルパス（存在しない・不正なIDならNone）"""
+    if kind not in PROFILE_FILES or profile_id not in list_profile_ids():
+        return None
+    return os.path.join(Config.PROFILE_DIR, profile_id, PROFILE_FILES[kind][0])
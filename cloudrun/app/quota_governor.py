@@ -0,0 +1,192 @@
+"""Vertex AI呼び出しのクォータ制御（モデル・リージョンごとのトークンバケット、SQLiteでプロセス間共有）"""
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from google.api_core import exceptions as api_exceptions
+from config import Config
+from deadline import Deadline
+from metrics import metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# クォータ超過（gRPCのRESOURCE_EXHAUSTED、RESTのHTTP 429）の例外
+_QUOTA_ERRORS = (api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests)
+
+
+def is_quota_error(error: Optional[BaseException]) -> bool:
+    """Vertex AIのクォータ超過エラーか（編集処理で包み直した例外は原因の例外をたどって型で判定）"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, _QUOTA_ERRORS):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class QuotaGovernor:
+    """送信前にトークンを取得させ、クォータ超過の呼び出しを送らないようにするクラス
+
+    バケットの残量はSQLiteファイルに置き、同一ホスト上のスレッド・ワーカープロセス間で共有する。
+    トークンの補充は取得時に経過時間から計算するため、補充用のバックグラウンド処理は不要。
+    """
+
+    def __init__(self, path: str):
+        """クォータ制御の初期化（テーブルが無ければ作成）"""
+        self.path = path
+        # SQLiteの接続はスレッドごとに保持
+        self._local = threading.local()
+        # asyncio版のSQLite操作用（BEGIN IMMEDIATEのロック待ちで最大5秒ブロックし得るため）
+        self._executor = ThreadPoolExecutor(max_workers=Config.VERTEX_QUOTA_ASYNC_WORKERS, thread_name_prefix="quota")
+        self._conn().executescript(_SCHEMA)
+        if Config.VERTEX_QUOTA_ENABLED and not Config.VERTEX_QUOTA_PER_MINUTE:
+            print("VERTEX_QUOTA_ENABLED is set but VERTEX_QUOTA_PER_MINUTE is empty; no calls are limited")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(family: str, model: str, region: str) -> str:
+        return f"{family}:{model}@{region}"
+
+    @staticmethod
+    def _limits(key: str) -> Optional[Tuple[float, float]]:
+        """(毎秒の補充数, バケット容量)。制限しない系統はNone"""
+        per_minute = Config.VERTEX_QUOTA_PER_MINUTE.get(key.split(':', 1)[0])
+        if not per_minute:
+            return None
+        return per_minute / 60.0, max(1.0, Config.VERTEX_QUOTA_BURST)
+
+    def _take(self, key: str, rate: float, burst: float) -> float:
+        """トークンを1つ取得し、取得できなければ次のトークンまでの秒数を返す（取得時は0）"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= 1.0:
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / rate
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    @staticmethod
+    def _wait_budget(deadline: Optional[Deadline]) -> float:
+        budget = Config.VERTEX_QUOTA_MAX_WAIT_MS / 1000.0
+        if deadline is not None:
+            budget = min(budget, deadline.remaining() - Config.DEADLINE_RESERVE_MS / 1000.0)
+        return budget
+
+    def _poll(self, key: str, limits: Tuple[float, float], started: float, budget: float) -> Optional[float]:
+        """トークン取得を1回試み、取得できればNone、待てるなら待機秒数、待てないなら-1を返す"""
+        rate, burst = limits
+        try:
+            wait = self._take(key, rate, burst)
+        except sqlite3.Error as e:
+            # 制御自体の障害で編集を止めない
+            print(f"Quota governor unavailable, allowing call: {e}")
+            return None
+        waited = time.monotonic() - started
+        if wait == 0.0:
+            metrics.observe(f"quota.{key}.wait_ms", waited * 1000)
+            return None
+        if waited + wait > budget:
+            metrics.increment(f"quota.{key}.rejected")
+            return -1.0
+        return wait
+
+    def acquire(self, key: str, deadline: Optional[Deadline] = None) -> bool:
+        """トークンを取得できればTrue
+
+        待ち時間がVERTEX_QUOTA_MAX_WAIT_MS（期限がある場合は残り時間）を超える場合は待たずにFalse。
+        """
+        limits = self._limits(key) if Config.VERTEX_QUOTA_ENABLED else None
+        if limits is None:
+            return True
+        budget = self._wait_budget(deadline)
+        started = time.monotonic()
+        while True:
+            wait = self._poll(key, limits, started, budget)
+            if wait is None or wait < 0:
+                return wait is None
+            time.sleep(wait)
+
+    async def acquire_async(self, key: str, deadline: Optional[Deadline] = None) -> bool:
+        """acquireのasyncio版（SQLiteのロック待ちを含むトークン取得はスレッドで実行し、イベントループを止めない）"""
+        limits = self._limits(key) if Config.VERTEX_QUOTA_ENABLED else None
+        if limits is None:
+            return True
+        loop = asyncio.get_running_loop()
+        budget = self._wait_budget(deadline)
+        started = time.monotonic()
+        while True:
+            wait = await loop.run_in_executor(self._executor, self._poll, key, limits, started, budget)
+            if wait is None or wait < 0:
+                return wait is None
+            await asyncio.sleep(wait)
+
+    def penalize(self, key: str) -> None:
+        """429を受けたバケットを空にし、VERTEX_QUOTA_COOLDOWN_SEC秒は全プロセスで送信を止める"""
+        limits = self._limits(key) if Config.VERTEX_QUOTA_ENABLED else None
+        if limits is None:
+            return
+        rate, _ = limits
+        metrics.increment(f"quota.{key}.throttled")
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = MIN(buckets.tokens, excluded.tokens), updated = excluded.updated",
+                (key, -rate * Config.VERTEX_QUOTA_COOLDOWN_SEC, time.time())
+            )
+        except sqlite3.Error as e:
+            print(f"Quota governor penalize failed: {e}")
+
+    async def penalize_async(self, key: str) -> None:
+        """penalizeのasyncio版（SQLiteへの書き込みはスレッドで実行）"""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.penalize, key)
+
+    def snapshot(self) -> Dict:
+        """バケットごとの現在の残量"""
+        now = time.time()
+        result = {}
+        for key, tokens, updated in self._conn().execute("SELECT key, tokens, updated FROM buckets"):
+            limits = self._limits(key)
+            if limits is None:
+                continue
+            rate, burst = limits
+            result[key] = {
+                "tokens": round(min(burst, tokens + max(0.0, now - updated) * rate), 3),
+                "per_minute": rate * 60,
+                "burst": burst
+            }
+        return result
+
+
+# プロセス共通のクォータ制御（同一ホストの他プロセスとはVERTEX_QUOTA_DBで共有）
+quota_governor = QuotaGovernor(Config.VERTEX_QUOTA_DB)
@@ -0,0 +1,78 @@
+"""処理結果（フル解像度画像）の一時保持サービス"""
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from PIL import Image
+from config import Config
+from metrics import metrics
+
+
+class ResultStore:
+    """フル解像度の処理結果をハンドル付きで一時保持するクラス（TTL・バイト上限付きLRU）"""
+
+    def __init__(self, max_bytes: int, ttl_sec: float):
+        """結果ストアの初期化"""
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        # handle -> (画像, メタデータ, 登録時刻, 推定バイト数)
+        self._entries: "OrderedDict[str, Tuple[Image.Image, Dict, float, int]]" = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def _estimate_bytes(image: Image.Image, meta: Dict) -> int:
+        # エンコード済みデータ（アニメーションGIF等）を保持する場合はその分も加算
+        return image.width * image.height * len(image.getbands()) + len(meta.get("encoded", b""))
+
+    def _evict(self, now: float) -> None:
+        """期限切れとバイト上限超過分を古い順に削除（ロック保持中に呼ぶ）"""
+        while self._entries:
+            _, (_, _, created, size) = next(iter(self._entries.items()))
+            if now - created <= self.ttl_sec and self._bytes <= self.max_bytes:
+                break
+            self._entries.popitem(last=False)
+            self._bytes -= size
+            metrics.increment("result_store.evicted")
+        metrics.set_gauge("result_store.bytes", self._bytes)
+        metrics.set_gauge("result_store.entries", len(self._entries))
+
+    def put(self, image: Image.Image, meta: Optional[Dict] = None) -> Optional[str]:
+        """画像を保持し、取得用のハンドルを返す（meta["encoded"]があれば取得時にそのまま返す）
+
+        1件で上限を超える画像は保持できないためNoneを返す。
+        """
+        handle = secrets.token_urlsafe(16)
+        meta = meta or {}
+        size = self._estimate_bytes(image, meta)
+        if size > self.max_bytes:
+            metrics.increment("result_store.oversize")
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._entries[handle] = (image, meta, now, size)
+            self._bytes += size
+            self._evict(now)
+        return handle
+
+    def get(self, handle: str) -> Optional[Tuple[Image.Image, Dict]]:
+        """ハンドルに対応する画像とメタデータを返す（期限切れ・未登録ならNone）"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get(handle)
+            if entry is not None and now - entry[2] > self.ttl_sec:
+                self._entries.pop(handle)
+                self._bytes -= entry[3]
+                entry = None
+            if entry is None:
+                metrics.increment("result_store.miss")
+                return None
+            self._entries.move_to_end(handle)
+            metrics.increment("result_store.hit")
+            return entry[0], entry[1]
+
+
+# プロセス共通の結果ストア
+result_store = ResultStore(Config.RESULT_STORE_MAX_BYTES, Config.RESULT_TTL_SEC)
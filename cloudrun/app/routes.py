@@ -1,12 +1,28 @@
 """APIエンドポイント定義"""
+import hmac
 import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from flask import Blueprint, request, jsonify
-from flask import send_file
+from flask import send_file, g
+from google.api_core import exceptions as gcs_exceptions
 from image_processor import ImageProcessor
 from storage_service import StorageService
 from face_detector import FaceDetector
 from ai_image_editor import AIImageEditor
 from config import Config
+from admission_control import admission, ai_admission, standard_admission
+from metrics import metrics
+from model_router import model_router
+from quota_governor import quota_governor
+from result_store import result_store
+from animation_processor import AnimationProcessor
+from local_anonymizer import LocalAnonymizer
+from deadline import Deadline
+import tracing
+import profiling
 
 # ブループリントを作成
 api = Blueprint('api', __name__)
@@ -21,11 +37,233 @@ def handle_api_error(e):
         "debug_error": str(e)
     })
 
+# 処理期限の起点（アドミッション待ちの時間も期限に含める）とトレースの開始
+@api.before_request
+def mark_request_started():
+    g.request_started = time.monotonic()
+    g.trace_id = request.headers.get('X-Trace-Id') or tracing.new_trace_id()
+    # プロファイル対象のリクエストは段階別時間を残すため、トレーシング無効時もスパンを計測
+    g.profile = profiling.maybe_start(
+        request.method, request.path, g.trace_id, request.headers.get('X-Profile-Token')
+    )
+    g.trace_root = tracing.start_trace(
+        f"{request.method} {request.path}", g.trace_id, force=g.profile is not None
+    )
+    g.trace_root.__enter__()
+
+@api.after_request
+def add_trace_header(response):
+    response.headers['X-Trace-Id'] = g.get('trace_id', '')
+    if g.get('profile') is not None:
+        response.headers['X-Profile-Id'] = g.profile.profile_id
+    return response
+
+@api.teardown_request
+def finish_trace(exc):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.stop()
+    root = g.pop('trace_root', None)
+    if root is not None:
+        root.set("status", "error" if exc is not None else "ok")
+        root.__exit__(type(exc) if exc else None, exc, None)
+    if profile is not None:
+        try:
+            profile.save(profiling.stages_from_spans(root.trace.spans))
+        except Exception as e:
+            print(f"Profile save failed: {e}")
+
 # サービスインスタンス
 image_processor = ImageProcessor()
 storage_service = StorageService()
 face_detector = FaceDetector()
 ai_image_editor = AIImageEditor()
+animation_processor = AnimationProcessor(face_detector, ai_image_editor)
+# 結果ストアのフル解像度をGCSへ保存するワーカー
+_result_share_executor = ThreadPoolExecutor(max_workers=Config.RESULT_SHARE_WORKERS, thread_name_prefix="result-share")
+
+# /mask-faces のedit_typeコード（1=花束, 2=ポストカード, 3=ぼかし, 4=モザイク, 5=塗りつぶし）
+MASK_EDIT_TYPES = {1: "bouquet", 2: "postcard", 3: "blur", 4: "pixelate", 5: "solid"}
+
+def _resolve_mask_edit_type(edit_type_code) -> str:
+    """edit_typeコード（または編集タイプ名）を編集タイプに変換（不明なら花束）"""
+    if isinstance(edit_type_code, str) and edit_type_code in MASK_EDIT_TYPES.values():
+        return edit_type_code
+    return MASK_EDIT_TYPES.get(edit_type_code, "bouquet")
+
+def _select_local_admission():
+    """ローカル匿名化のみのリクエストはAI編集系の枠を使わず通常系で受け付ける"""
+    data = request.get_json(silent=True) or {}
+    edit_type = data.get('edit_type')
+    if request.path.endswith('/mask-faces'):
+        edit_type = _resolve_mask_edit_type(edit_type if edit_type is not None else 1)
+    if edit_type in LocalAnonymizer.MODES:
+        return standard_admission
+    return None
+
+def _output_options(data: dict, accept: str = None):
+    """出力形式（output_format/Acceptヘッダ）と目標バイト数（target_bytes）を決定
+
+    acceptを省略するとFlaskのリクエストのAcceptヘッダを使う（ASGI経路からは明示的に渡す）。
+    """
+    output_format = image_processor.negotiate_output_format(
+        request.headers.get('Accept') if accept is None else accept, data.get('output_format')
+    )
+    target_bytes = data.get('target_bytes')
+    return output_format, int(target_bytes) if target_bytes else None
+
+def _album_id(data: dict):
+    """近似重複の再利用範囲（album_id）。未指定なら再利用しない"""
+    album_id = data.get('album_id')
+    if not isinstance(album_id, str) or not album_id:
+        return None
+    return album_id[:128]
+
+def _publish_result(image, filename: str, data: dict, edit_info: dict = None, accept: str = None) -> dict:
+    """処理結果をレスポンス用に公開
+
+    LAZY_FULL_RESOLUTIONが有効ならフル解像度は結果ストアに保持し、軽量プレビューと
+    取得用URLのみ返す（フル解像度のエンコードは /result/<handle> 取得時に行う）。
+    無効ならCloud StorageへアップロードしてData URLを返し、即時削除する。
+    """
+    output_format, target_bytes = _output_options(data, accept)
+    handle = None
+    if Config.LAZY_FULL_RESOLUTION:
+        handle = result_store.put(image, {
+            "filename": filename,
+            "output_format": output_format,
+            "target_bytes": target_bytes
+        })
+    if handle is not None:
+        _share_result(handle, filename, image=image, output_format=output_format, target_bytes=target_bytes)
+        return {
+            "blob_name": None,
+            "signed_url": None,
+            "data_url": image_processor.create_preview_data_url(image),
+            "download_url": f"/api/result/{handle}"
+        }
+    # 遅延取得が無効、または結果ストアに収まらない場合はアップロード結果をそのまま返す
+    upload_result = storage_service.upload_image(image, filename, filename, output_format, target_bytes, edit_info)
+    # 即時削除（プレビューはdata_urlで保持）。コンテンツアドレス方式のオブジェクトは共有されるため残す
+    if not Config.CONTENT_ADDRESSED_STORAGE:
+        storage_service.delete_blob(upload_result["blob_name"])
+    return upload_result
+
+def _save_shared_result(handle: str, filename: str, image=None, encoded: bytes = None,
+                        output_format: str = None, target_bytes: int = None) -> None:
+    try:
+        if encoded is None:
+            encoded, output_format = image_processor.encode_image(image, output_format, target_bytes)
+        storage_service.save_result(handle, encoded, output_format, filename)
+        metrics.increment("result_store.shared")
+    except Exception as e:
+        print(f"Shared result save failed ({handle}): {e}")
+
+def _share_result(handle: str, filename: str, **kwargs) -> None:
+    """フル解像度を他インスタンスからも取得できるようバックグラウンドでGCSへ保存（応答は待たせない）"""
+    if Config.RESULT_SHARED_STORAGE:
+        image = kwargs.get("image")
+        if image is not None:
+            # 未デコードの画像を複数スレッドから同時にデコードしないよう先に読み込む
+            image.load()
+        _result_share_executor.submit(_save_shared_result, handle, filename, **kwargs)
+
+def _publish_animation(image, edit_type: str, filename: str) -> dict:
+    """複数フレーム画像をフレーム単位でローカル匿名化し、レスポンスを組み立てる"""
+    result = animation_processor.anonymize(image, edit_type)
+    first_frame = result["first_frame"]
+    handle = None
+    if Config.LAZY_FULL_RESOLUTION:
+        handle = result_store.put(first_frame, {
+            "filename": filename,
+            "encoded": result["data"],
+            "output_format": result["format"]
+        })
+    if handle is not None:
+        _share_result(handle, filename, encoded=result["data"], output_format=result["format"])
+        data_url = image_processor.create_preview_data_url(first_frame)
+        download_url = f"/api/result/{handle}"
+    else:
+        data_url = image_processor.to_data_url(result["data"], result["format"])
+        download_url = None
+    return {
+        "status": "success",
+        "image_info": {
+            "format": result["format"],
+            "size": first_frame.size,
+            "width": first_frame.width,
+            "height": first_frame.height,
+            "frames": result["frames"],
+            "keyframes": result["keyframes"],
+            "faces_detected": result["faces_detected"]
+        },
+        "signed_url": None,
+        "blob_name": None,
+        "data_url": data_url,
+        "download_url": download_url,
+        "message": f"{result['frames']}フレームの顔を{edit_type}で隠しました",
+        "faces_detected": result["faces_detected"],
+        "fallback_used": True,
+        "debug_error": "ANIMATION_LOCAL_RENDER"
+    }
+
+def _scale_regions(face_regions, from_size, to_size) -> list:
+    """顔領域をfrom_sizeの座標系からto_sizeの座標系へ変換"""
+    if tuple(from_size) == tuple(to_size):
+        return [tuple(r) for r in face_regions]
+    sx, sy = to_size[0] / float(from_size[0]), to_size[1] / float(from_size[1])
+    return [(int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy)))
+            for (x, y, w, h) in face_regions]
+
+def _store_face_metadata(blob_name: str, generation: int, face_regions, detected_size, original_size, backend: str) -> bool:
+    """検出結果を元画像の座標系でBlobメタデータへ保存（失敗しても処理は続行）"""
+    try:
+        return storage_service.write_face_metadata(
+            blob_name, generation, _scale_regions(face_regions, detected_size, original_size), original_size, backend
+        )
+    except Exception as e:
+        print(f"Face metadata write failed ({blob_name}): {e}")
+        return False
+
+class InvalidIngestImage(Exception):
+    """取り込み対象が画像として処理できない（再試行しても成功しない）"""
+
+def _ingest_blob(blob_name: str, backend: str = None, force: bool = False) -> dict:
+    """Blobの顔検出結果をメタデータへ保存（保存済みで同じ検出バックエンドならダウンロードしない）
+
+    Blobが無い場合はNotFound、画像として開けない・検証に失敗した場合はInvalidIngestImageを送出する。
+    """
+    backend = FaceDetector.resolve_backend(backend)
+    stored, generation = storage_service.read_face_metadata(blob_name)
+    if stored is not None and stored["face_detector"] == backend and not force:
+        return {**stored, "source": "metadata", "stored": True}
+    data = storage_service.download_bytes(blob_name)
+    try:
+        original = image_processor.open_image_bytes(data)
+        # 縮小前の寸法（保存する座標系）を縮小処理より前に取得
+        original_size = image_processor.source_size(original)
+        image_processor.validate_image(original)
+        image = image_processor.process_image(original)
+    except Exception as e:
+        raise InvalidIngestImage(str(e))
+    face_regions = face_detector.get_face_regions_from_image(image, backend=backend)
+    metrics.increment("ingest.detected")
+    return {
+        "face_regions": _scale_regions(face_regions, image.size, original_size),
+        "image_width": original_size[0],
+        "image_height": original_size[1],
+        "face_detector": backend,
+        "source": "detected",
+        "stored": _store_face_metadata(blob_name, generation, face_regions, image.size, original_size, backend)
+    }
+
+def _ingest_error_response(e: Exception):
+    """取り込みの例外をHTTPステータスへ対応付け（Blob無し=404, 画像でない=400, その他=500）"""
+    if isinstance(e, gcs_exceptions.NotFound):
+        return jsonify({"status": "error", "message": str(e)}), 404
+    if isinstance(e, InvalidIngestImage):
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "error", "message": str(e)}), 500
 
 @api.route('/', methods=['GET'])
 def health_check():
@@ -38,7 +276,43 @@ def health_check():
         "region": Config.REGION
     })
 
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """キュー深さ・拒否数などのメトリクスを返す"""
+    return jsonify(metrics.snapshot())
+
+@api.route('/profiles', methods=['GET'])
+def list_profiles():
+    """保存済みプロファイルの一覧（PROFILING_TOKENと一致する X-Profile-Token が必要）"""
+    if not profiling.is_authorized(request.headers.get('X-Profile-Token')):
+        return jsonify({"status": "error", "message": "forbidden"}), 403
+    profiles = profiling.list_profiles()
+    return jsonify({"status": "success", "profiles": profiles, "count": len(profiles)})
+
+@api.route('/profiles/<profile_id>/<kind>', methods=['GET'])
+def download_profile(profile_id, kind):
+    """プロファイルを取得（kind: summary=段階別時間・メモリ・上位関数のJSON, cpu=pstats形式）"""
+    if not profiling.is_authorized(request.headers.get('X-Profile-Token')):
+        return jsonify({"status": "error", "message": "forbidden"}), 403
+    path = profiling.profile_file(profile_id, kind)
+    if path is None:
+        return jsonify({"status": "error", "message": "profile_not_found"}), 404
+    mimetype = profiling.PROFILE_FILES[kind][1]
+    return send_file(path, mimetype=mimetype, as_attachment=kind == "cpu",
+                     download_name=f"{profile_id}.{os.path.basename(path).split('.', 1)[1]}")
+
+@api.route('/router', methods=['GET'])
+def get_router_stats():
+    """編集バックエンドごとの成功率・レイテンシ（ルーティング判断の根拠）を返す"""
+    return jsonify(model_router.snapshot())
+
+@api.route('/quota', methods=['GET'])
+def get_quota():
+    """Vertex AIのモデル・リージョンごとのトークン残量を返す"""
+    return jsonify(quota_governor.snapshot())
+
 @api.route('/process', methods=['POST'])
+@admission(standard_admission)
 def process_image():
     """Base64画像の処理エンドポイント"""
     try:
@@ -62,18 +336,17 @@ def process_image():
         
         # Cloud Storageにアップロード
         filename = data.get('filename', 'image')
-        upload_result = storage_service.upload_image(processed_image, filename, filename)
+        upload_result = _publish_result(processed_image, filename, data)
         response_json = {
             "status": "success",
             "image_info": image_info,
             "signed_url": upload_result.get("signed_url"),
             "blob_name": upload_result["blob_name"],
             "data_url": upload_result.get("data_url"),
+            "download_url": upload_result.get("download_url"),
             "message": "画像が正常に処理され、Cloud Storageに保存されました"
         }
-        # 即時削除（プレビューはdata_urlで保持）
         print("mask-faces result", {"faces": len(face_regions), "fallback_used": False})
-        storage_service.delete_blob(upload_result["blob_name"])
         return jsonify(response_json)
         
     except Exception as e:
@@ -83,6 +356,7 @@ def process_image():
         }), 500
 
 @api.route('/download', methods=['GET'])
+@admission(standard_admission)
 def download_blob():
     """非公開バケットから画像を安全にダウンロードするためのプロキシ"""
     try:
@@ -91,15 +365,48 @@ def download_blob():
             return jsonify({"error": "blob_nameが必要です"}), 400
 
         image = storage_service.download_image(blob_name)
-        img_byte = io.BytesIO()
-        fmt = image.format if image.format else 'PNG'
-        image.save(img_byte, format=fmt)
-        img_byte.seek(0)
-        return send_file(img_byte, mimetype=f'image/{fmt.lower()}')
+        # output_format指定時のみ変換し、未指定なら元の形式で返す
+        requested = request.args.get('output_format')
+        fmt = image_processor.negotiate_output_format(requested=requested) if requested else None
+        image_bytes, fmt = image_processor.encode_image(image, fmt)
+        return send_file(io.BytesIO(image_bytes), mimetype=f'image/{fmt.lower()}')
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api.route('/result/<handle>', methods=['GET'])
+@admission(standard_admission)
+def download_result(handle):
+    """処理結果のフル解像度画像を取得（このタイミングでエンコード）"""
+    try:
+        entry = result_store.get(handle)
+        if entry is None:
+            # 別インスタンスで作成された結果はGCSに保存したもの（作成時の形式）を返す
+            shared = storage_service.load_result(handle) if Config.RESULT_SHARED_STORAGE else None
+            if shared is None:
+                return jsonify({"status": "error", "message": "結果が見つからないか期限切れです"}), 404
+            image_bytes, fmt, filename = shared
+            download_name = f"{filename.rsplit('.', 1)[0]}.{fmt}"
+            return send_file(io.BytesIO(image_bytes), mimetype=f'image/{fmt}',
+                             as_attachment=True, download_name=download_name)
+
+        image, meta = entry
+        if meta.get("encoded") is not None:
+            # アニメーションGIF等はエンコード済みデータをそのまま返す
+            fmt = meta.get("output_format", "GIF")
+            download_name = f"{meta.get('filename', 'image').rsplit('.', 1)[0]}.{fmt.lower()}"
+            return send_file(io.BytesIO(meta["encoded"]), mimetype=f'image/{fmt.lower()}',
+                             as_attachment=True, download_name=download_name)
+        requested = request.args.get('output_format')
+        fmt = image_processor.negotiate_output_format(requested=requested) if requested else meta.get("output_format")
+        image_bytes, fmt = image_processor.encode_image(image, fmt, meta.get("target_bytes"))
+        download_name = f"{meta.get('filename', 'image').rsplit('.', 1)[0]}.{fmt.lower()}"
+        return send_file(io.BytesIO(image_bytes), mimetype=f'image/{fmt.lower()}',
+                         as_attachment=True, download_name=download_name)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @api.route('/process-from-storage', methods=['POST'])
+@admission(standard_admission)
 def process_image_from_storage():
     """Cloud Storageから画像を読み込んで処理するエンドポイント"""
     try:
@@ -124,17 +431,17 @@ def process_image_from_storage():
         # 処理済み画像を新しい名前で保存
         original_filename = data['blob_name'].split('/')[-1]
         processed_filename = f"processed_{original_filename}"
-        upload_result = storage_service.upload_image(processed_image, processed_filename, processed_filename)
+        upload_result = _publish_result(processed_image, processed_filename, data)
         response_json = {
             "status": "success",
             "image_info": image_info,
             "signed_url": upload_result.get("signed_url"),
             "blob_name": upload_result["blob_name"],
             "data_url": upload_result.get("data_url"),
+            "download_url": upload_result.get("download_url"),
             "message": "Cloud Storageから画像を読み込み、処理して保存しました"
         }
         print("ai-edit result", {"faces": len(face_regions), "fallback_used": not bool(face_regions)})
-        storage_service.delete_blob(upload_result["blob_name"])
         return jsonify(response_json)
         
     except Exception as e:
@@ -143,16 +450,40 @@ def process_image_from_storage():
             "message": str(e)
         }), 500
 
+def _parse_bool_arg(name: str):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+def _parse_datetime_arg(name: str):
+    value = request.args.get(name)
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
 @api.route('/images', methods=['GET'])
+@admission(standard_admission)
 def list_images():
-    """保存された画像の一覧を取得"""
+    """保存された画像の一覧を取得（画像索引からページ単位で取得）"""
     try:
-        images = storage_service.list_images()
+        images, next_cursor = storage_service.list_images(
+            limit=request.args.get('limit', type=int),
+            cursor=request.args.get('cursor'),
+            edit_type=request.args.get('edit_type'),
+            min_faces=request.args.get('min_faces', type=int),
+            max_faces=request.args.get('max_faces', type=int),
+            fallback_used=_parse_bool_arg('fallback_used'),
+            since=_parse_datetime_arg('since'),
+            until=_parse_datetime_arg('until')
+        )
         
         return jsonify({
             "status": "success",
             "images": images,
-            "count": len(images)
+            "count": len(images),
+            "next_cursor": next_cursor
         })
         
     except Exception as e:
@@ -161,7 +492,89 @@ def list_images():
             "message": str(e)
         }), 500
 
+@api.route('/images/reconcile', methods=['POST'])
+@admission(standard_admission)
+def reconcile_images():
+    """バケットの内容から画像索引を再構築（IMAGE_INDEX_RECONCILE_TOKENと一致する X-Reconcile-Token が必要）"""
+    token = request.headers.get('X-Reconcile-Token') or ''
+    if not Config.IMAGE_INDEX_RECONCILE_TOKEN or not hmac.compare_digest(token, Config.IMAGE_INDEX_RECONCILE_TOKEN):
+        return jsonify({"status": "error", "message": "forbidden"}), 403
+    try:
+        result = storage_service.reconcile_index()
+        return jsonify({"status": "success", **result})
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+@api.route('/ingest', methods=['POST'])
+@admission(standard_admission)
+def ingest_blob():
+    """Cloud Storageの画像の顔を検出し、顔領域・画像サイズをBlobメタデータへ保存"""
+    try:
+        data = request.get_json()
+        if not data or 'blob_name' not in data:
+            return jsonify({"error": "blob_nameが必要です"}), 400
+        result = _ingest_blob(data['blob_name'], data.get('detector_backend'), bool(data.get('force')))
+        return jsonify({"status": "success", "blob_name": data['blob_name'], **result})
+    except Exception as e:
+        return _ingest_error_response(e)
+
+@api.route('/ingest/notification', methods=['POST'])
+@admission(standard_admission)
+def ingest_notification():
+    """Cloud StorageのPub/Sub通知（push）を受けて新規オブジェクトを取り込む
+
+    Pub/Subのpush形式（message.attributesにeventType/bucketId/objectId）であれば、
+    エミュレータや手元からのPOSTでも同じように動作する。削除済み・画像でない等の再送しても
+    成功しない失敗は2xxで受領し、一時的な失敗のみ5xxを返して再送させる。
+    """
+    if Config.INGEST_PUSH_TOKEN and request.args.get('token') != Config.INGEST_PUSH_TOKEN:
+        return jsonify({"status": "error", "message": "forbidden"}), 403
+    message = (request.get_json(silent=True) or {}).get('message') or {}
+    attributes = message.get('attributes') or {}
+    object_id = attributes.get('objectId', '')
+    # 確定（作成・上書き）のみ対象。メタデータ更新の通知は自身の書き込みでも届くため無視する
+    if attributes.get('eventType') != 'OBJECT_FINALIZE' or attributes.get('bucketId') != Config.BUCKET_NAME:
+        return jsonify({"status": "skipped", "reason": "event"})
+    if (object_id.startswith((Config.PROCESSED_IMAGES_PREFIX, Config.CONTENT_INDEX_PREFIX, Config.RESULTS_PREFIX))
+            or os.path.splitext(object_id)[1].lower() not in Config.ALLOWED_IMAGE_FORMATS):
+        return jsonify({"status": "skipped", "reason": "object"})
+    try:
+        result = _ingest_blob(object_id)
+        return jsonify({"status": "success", "blob_name": object_id, **result})
+    except Exception as e:
+        print(f"Ingest failed ({object_id}): {e}")
+        if _is_permanent_ingest_error(e):
+            metrics.increment("ingest.dropped")
+            return jsonify({"status": "skipped", "reason": "permanent_error", "message": str(e)})
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+def _is_permanent_ingest_error(e: Exception) -> bool:
+    """再送しても成功しない失敗か（Blob無し・画像でない・権限等の4xx。429は一時的な失敗とする）"""
+    if isinstance(e, InvalidIngestImage):
+        return True
+    return isinstance(e, gcs_exceptions.ClientError) and not isinstance(e, gcs_exceptions.TooManyRequests)
+
+@api.route('/faces', methods=['GET'])
+@admission(standard_admission)
+def get_face_regions():
+    """Blobの顔領域を返す（保存済みならメタデータのみ参照し本体をダウンロードしない）"""
+    try:
+        blob_name = request.args.get('blob_name')
+        if not blob_name:
+            return jsonify({"error": "blob_nameが必要です"}), 400
+        result = _ingest_blob(blob_name, request.args.get('detector_backend'))
+        return jsonify({"status": "success", "blob_name": blob_name, **result})
+    except Exception as e:
+        return _ingest_error_response(e)
+
 @api.route('/mask-faces', methods=['POST'])
+@admission(ai_admission, select=_select_local_admission)
 def mask_faces():
     """人物写真の顔を花束で隠すエンドポイント"""
     try:
@@ -176,15 +589,19 @@ def mask_faces():
         
         # 画像を検証
         image_processor.validate_image(image)
+
+        # edit_typeパラメータを取得（1=花束、2=ポストカード、3=ぼかし、4=モザイク、5=塗りつぶし）
+        edit_type = _resolve_mask_edit_type(data.get('edit_type', 1))  # デフォルトは花束
         
-        # 画像をバイト形式に変換（顔検出用）
-        img_byte_arr = io.BytesIO()
-        fmt = image.format if image.format else 'PNG'
-        image.convert('RGB').save(img_byte_arr, format=fmt)
-        image_bytes = img_byte_arr.getvalue()
+        # アニメーションGIFはキーフレーム検出＋ローカル描画でフレーム単位に匿名化
+        if animation_processor.is_animated(image):
+            return jsonify(_publish_animation(image, edit_type, data.get('filename', 'masked_image')))
+
+        # 長辺を設定値まで一度だけ縮小（以降の検出・編集は縮小後の座標系で行う）
+        image = image_processor.process_image(image)
         
-        # 顔を検出
-        face_regions = face_detector.get_face_regions(image_bytes)
+        # 顔を検出（再エンコードせず縮小後の画像をそのまま渡す）
+        face_regions = face_detector.get_face_regions_from_image(image, backend=data.get('detector_backend'))
         
         # 顔が検出されない場合は200で情報返却（UI側のUXを優先）
         if not face_regions:
@@ -197,19 +614,13 @@ def mask_faces():
                 "debug_error": "NO_FACES"
             })
         
-        # edit_typeパラメータを取得（1=花束、2=ポストカード）
-        edit_type_code = data.get('edit_type', 1)  # デフォルトは花束
-        
-        # edit_typeに応じて編集タイプを決定
-        if edit_type_code == 1:
-            edit_type = "bouquet"  # 花束
-        elif edit_type_code == 2:
-            edit_type = "postcard"  # ポストカード
-        else:
-            edit_type = "bouquet"  # デフォルトは花束
-        
         # Vertex AI Imagen APIを使用して画像を編集
-        edit_result = ai_image_editor.edit_image_with_ai(image, face_regions, edit_type)
+        edit_result = ai_image_editor.edit_image_with_ai(
+            image, face_regions, edit_type,
+            local_only=g.admission_downgraded,
+            deadline=Deadline.from_request(data.get('deadline_ms'), g.request_started),
+            album_id=_album_id(data)
+        )
         masked_image = edit_result["image"]
         
         # 画像情報を取得
@@ -219,19 +630,27 @@ def mask_faces():
         
         # Cloud Storageにアップロード
         filename = data.get('filename', 'masked_image')
-        upload_result = storage_service.upload_image(masked_image, filename, filename)
+        upload_result = _publish_result(masked_image, filename, data, {
+            "edit_type": edit_type,
+            "faces_detected": len(face_regions),
+            "fallback_used": edit_result["fallback_used"]
+        })
         response_json = {
             "status": "success",
             "image_info": image_info,
             "signed_url": upload_result.get("signed_url"),
             "blob_name": upload_result["blob_name"],
             "data_url": upload_result.get("data_url"),
+            "download_url": upload_result.get("download_url"),
             "message": f"{len(face_regions)}個の顔を花束で隠しました",
             "faces_detected": len(face_regions),
             "fallback_used": edit_result["fallback_used"],
-            "debug_error": edit_result["error_message"]
+            "debug_error": edit_result["error_message"],
+            "coalesced": edit_result["coalesced"],
+            "deadline": edit_result.get("deadline"),
+            "routing": edit_result.get("routing"),
+            "near_duplicate": edit_result.get("near_duplicate")
         }
-        storage_service.delete_blob(upload_result["blob_name"])
         return jsonify(response_json)
         
     except Exception as e:
@@ -244,6 +663,7 @@ def mask_faces():
         })
 
 @api.route('/mask-faces-from-storage', methods=['POST'])
+@admission(ai_admission)
 def mask_faces_from_storage():
     """Cloud Storageから画像を読み込んで顔を花束で隠すエンドポイント"""
     try:
@@ -253,31 +673,52 @@ def mask_faces_from_storage():
         if not data or 'blob_name' not in data:
             return jsonify({"error": "blob_nameが必要です"}), 400
         
+        # 取り込み時に保存した顔検出結果（Blobメタデータ）
+        backend = FaceDetector.resolve_backend(data.get('detector_backend'))
+        stored, generation = None, None
+        if Config.FACE_METADATA_ENABLED:
+            stored, generation = storage_service.read_face_metadata(data['blob_name'])
+            if stored is not None and stored["face_detector"] != backend:
+                stored = None
+
         # Cloud Storageから画像を読み込み
-        image = storage_service.download_image(data['blob_name'])
+        original = storage_service.download_image(data['blob_name'])
+        # 縮小前の寸法（メタデータへ保存する座標系）
+        original_size = image_processor.source_size(original)
         
         # 画像を検証
-        image_processor.validate_image(image)
-        
-        # 画像をバイト形式に変換（顔検出用）
-        img_byte_arr = io.BytesIO()
-        fmt = image.format if image.format else 'PNG'
-        image.convert('RGB').save(img_byte_arr, format=fmt)
-        image_bytes = img_byte_arr.getvalue()
+        image_processor.validate_image(original)
+
+        # 長辺を設定値まで一度だけ縮小（以降の検出・編集は縮小後の座標系で行う）
+        image = image_processor.process_image(original)
         
-        # 顔を検出
-        face_regions = face_detector.get_face_regions(image_bytes)
+        if stored is not None:
+            # 保存済みの顔領域を縮小後の座標系へ変換し、検出を省略
+            face_regions = _scale_regions(stored["face_regions"], (stored["image_width"], stored["image_height"]), image.size)
+            face_regions_source = "metadata"
+        else:
+            # 顔を検出（再エンコードせず縮小後の画像をそのまま渡す）
+            face_regions = face_detector.get_face_regions_from_image(image, backend=backend)
+            face_regions_source = "detected"
+            if Config.FACE_METADATA_ENABLED and Config.FACE_METADATA_WRITE_BACK:
+                _store_face_metadata(data['blob_name'], generation, face_regions, image.size, original_size, backend)
         
         if not face_regions:
             return jsonify({
                 "status": "error",
                 "message": "顔が検出されませんでした",
                 "faces_detected": 0,
+                "face_regions_source": face_regions_source,
                 "image_info": image_processor.get_image_info(image, data['blob_name'])
             }), 400
         
         # Vertex AI Imagen APIを使用して花束を描画
-        edit_result = ai_image_editor.edit_image_with_ai(image, face_regions, "peace_sign")
+        edit_result = ai_image_editor.edit_image_with_ai(
+            image, face_regions, "peace_sign",
+            local_only=g.admission_downgraded,
+            deadline=Deadline.from_request(data.get('deadline_ms'), g.request_started),
+            album_id=_album_id(data)
+        )
         masked_image = edit_result["image"]
 
         # 画像情報を取得
@@ -288,18 +729,27 @@ def mask_faces_from_storage():
         # 処理済み画像を新しい名前で保存
         original_filename = data['blob_name'].split('/')[-1]
         masked_filename = f"masked_{original_filename}"
-        upload_result = storage_service.upload_image(masked_image, masked_filename, masked_filename)
+        upload_result = _publish_result(masked_image, masked_filename, data, {
+            "edit_type": "peace_sign",
+            "faces_detected": len(face_regions),
+            "fallback_used": edit_result["fallback_used"]
+        })
         response_json = {
             "status": "success",
             "image_info": image_info,
             "signed_url": upload_result.get("signed_url"),
             "blob_name": upload_result["blob_name"],
             "data_url": upload_result.get("data_url"),
+            "download_url": upload_result.get("download_url"),
             "message": f"Cloud Storageから画像を読み込み、{len(face_regions)}個の顔を花束で隠しました",
+            "face_regions_source": face_regions_source,
             "fallback_used": edit_result["fallback_used"],
-            "debug_error": edit_result["error_message"]
+            "debug_error": edit_result["error_message"],
+            "coalesced": edit_result["coalesced"],
+            "deadline": edit_result.get("deadline"),
+            "routing": edit_result.get("routing"),
+            "near_duplicate": edit_result.get("near_duplicate")
         }
-        storage_service.delete_blob(upload_result["blob_name"])
         return jsonify(response_json)
         
     except Exception as e:
@@ -309,6 +759,7 @@ def mask_faces_from_storage():
         }), 500
 
 @api.route('/ai-edit', methods=['POST'])
+@admission(ai_admission, select=_select_local_admission)
 def ai_edit_image():
     """Vertex AI Imagen APIを使用した画像編集エンドポイント"""
     try:
@@ -323,15 +774,19 @@ def ai_edit_image():
         
         # 画像を検証
         image_processor.validate_image(image)
+
+        # 編集タイプを取得（デフォルトはpeace_sign）
+        edit_type = data.get('edit_type', 'peace_sign')
         
-        # 画像をバイト形式に変換（顔検出用）
-        img_byte_arr = io.BytesIO()
-        fmt = image.format if image.format else 'PNG'
-        image.convert('RGB').save(img_byte_arr, format=fmt)
-        image_bytes = img_byte_arr.getvalue()
+        # アニメーションGIFはキーフレーム検出＋ローカル描画でフレーム単位に匿名化
+        if animation_processor.is_animated(image):
+            return jsonify(_publish_animation(image, edit_type, data.get('filename', 'ai_edited_image')))
+
+        # 長辺を設定値まで一度だけ縮小（以降の検出・編集は縮小後の座標系で行う）
+        image = image_processor.process_image(image)
         
-        # 顔を検出
-        face_regions = face_detector.get_face_regions(image_bytes)
+        # 顔を検出（再エンコードせず縮小後の画像をそのまま渡す）
+        face_regions = face_detector.get_face_regions_from_image(image, backend=data.get('detector_backend'))
         
         # 顔が検出されない場合はエラー
         if not face_regions:
@@ -342,11 +797,13 @@ def ai_edit_image():
                 "image_info": image_processor.get_image_info(image)
             }), 400
         
-        # 編集タイプを取得（デフォルトはpeace_sign）
-        edit_type = data.get('edit_type', 'peace_sign')
-        
         # Vertex AI Imagen APIを使用して画像を編集
-        edit_result = ai_image_editor.edit_image_with_ai(image, face_regions, edit_type)
+        edit_result = ai_image_editor.edit_image_with_ai(
+            image, face_regions, edit_type,
+            local_only=g.admission_downgraded,
+            deadline=Deadline.from_request(data.get('deadline_ms'), g.request_started),
+            album_id=_album_id(data)
+        )
         edited_image = edit_result["image"]
 
         # 画像情報を取得
@@ -357,20 +814,28 @@ def ai_edit_image():
         
         # Cloud Storageにアップロード
         filename = data.get('filename', 'ai_edited_image')
-        upload_result = storage_service.upload_image(edited_image, filename, filename)
+        upload_result = _publish_result(edited_image, filename, data, {
+            "edit_type": edit_type,
+            "faces_detected": len(face_regions),
+            "fallback_used": edit_result["fallback_used"]
+        })
         response_json = {
             "status": "success",
             "image_info": image_info,
             "signed_url": upload_result.get("signed_url"),
             "blob_name": upload_result["blob_name"],
             "data_url": upload_result.get("data_url"),
+            "download_url": upload_result.get("download_url"),
             "message": f"{len(face_regions)}個の顔を{edit_type}で編集しました" if face_regions else f"顔未検出のためフォールバックで中央に{edit_type}を描画しました",
             "faces_detected": len(face_regions),
             "fallback_used": edit_result["fallback_used"],
-            "debug_error": edit_result["error_message"]
+            "debug_error": edit_result["error_message"],
+            "coalesced": edit_result["coalesced"],
+            "deadline": edit_result.get("deadline"),
+            "routing": edit_result.get("routing"),
+            "near_duplicate": edit_result.get("near_duplicate")
         }
         print("ai-edit result", {"faces": len(face_regions), "fallback_used": not bool(face_regions)})
-        storage_service.delete_blob(upload_result["blob_name"])
         return jsonify(response_json)
         
     except Exception as e:
@@ -0,0 +1,59 @@
+"""同一キーの同時実行を1回にまとめるシングルフライト制御"""
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+from metrics import metrics
+
+
+class _Call:
+    """実行中の呼び出し（結果・例外を後続の待機者へ共有する）"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、新たに実行せず先行呼び出しの結果を待つクラス"""
+
+    def __init__(self, name: str):
+        """シングルフライト制御の初期化"""
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def do(self, key: str, fn: Callable[[], Any], wait_timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """fnを実行し (結果, 合流したか) を返す。実行中の同一キーがあればその結果を待つ
+
+        wait_timeoutを指定すると、合流した側は最大その秒数だけ待ちTimeoutErrorを送出する。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            metrics.set_gauge(f"single_flight.{self.name}.in_flight", len(self._calls))
+
+        if not leader:
+            metrics.increment(f"single_flight.{self.name}.coalesced")
+            if not call.done.wait(wait_timeout):
+                raise TimeoutError(f"single flight wait timed out: {self.name}")
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            # 完了後はキーを外し、以降の呼び出しは新規実行とする
+            with self._lock:
+                self._calls.pop(key, None)
+                metrics.set_gauge(f"single_flight.{self.name}.in_flight", len(self._calls))
+            call.done.set()
+        return call.result, False
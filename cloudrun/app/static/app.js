@@ -2,31 +2,37 @@
 
 // APIエンドポイントのベースURL（同一オリジンの/api配下）
 const API_BASE = '/api';
+// 近似重複の再利用範囲（このページで続けて処理した写真の間だけ編集結果を再利用する）
+const ALBUM_ID = crypto.randomUUID();
 
 const fileInput = document.getElementById('fileInput');
 const dropzone = document.getElementById('dropzone');
 const inputPreview = document.getElementById('inputPreview');
 const outputPreview = document.getElementById('outputPreview');
+const downloadLink = document.getElementById('downloadLink');
   const maskFacesBtn = document.getElementById('maskFacesBtn');
   const maskFacesPostcardBtn = document.getElementById('maskFacesPostcardBtn');
+  const maskFacesBlurBtn = document.getElementById('maskFacesBlurBtn');
 const aiEditBtn = null; // 統合のため未使用
 // 結果表示要素は削除
 
 let selectedFile = null;
 
   function setBusy(isBusy) {
-    [maskFacesBtn, maskFacesPostcardBtn].forEach((btn) => (btn.disabled = isBusy || !selectedFile));
+    [maskFacesBtn, maskFacesPostcardBtn, maskFacesBlurBtn].forEach((btn) => (btn.disabled = isBusy || !selectedFile));
     if (isBusy) {
       maskFacesBtn.textContent = '処理中...';
       maskFacesPostcardBtn.textContent = '処理中...';
+      maskFacesBlurBtn.textContent = '処理中...';
     } else {
       maskFacesBtn.textContent = '匿名化（花束）';
       maskFacesPostcardBtn.textContent = '匿名化（ポストカード）';
+      maskFacesBlurBtn.textContent = '匿名化（ぼかし）';
     }
   }
 
 function enableActions() {
-  [maskFacesBtn, maskFacesPostcardBtn].forEach((btn) => (btn.disabled = !selectedFile));
+  [maskFacesBtn, maskFacesPostcardBtn, maskFacesBlurBtn].forEach((btn) => (btn.disabled = !selectedFile));
 }
 
 function toBase64(file) {
@@ -85,6 +91,22 @@ async function callApi(path, payload) {
   return await res.json();
 }
 
+function showOutput(data) {
+  // 出力プレビューはData URL（軽量プレビュー）を優先
+  if (data.data_url) {
+    outputPreview.src = data.data_url;
+  } else if (data.signed_url) {
+    outputPreview.src = data.signed_url;
+  }
+  // フル解像度は保存時にのみ取得する
+  if (data.download_url) {
+    downloadLink.href = data.download_url;
+    downloadLink.hidden = false;
+  } else {
+    downloadLink.hidden = true;
+  }
+}
+
 async function handleMaskFaces() {
   if (!selectedFile) return;
   try {
@@ -94,13 +116,9 @@ async function handleMaskFaces() {
       image: base64,
       filename: selectedFile.name || 'uploaded_image',
       edit_type: 1, // 花束
+      album_id: ALBUM_ID,
     });
-    // 出力プレビューはData URLを優先
-    if (data.data_url) {
-      outputPreview.src = data.data_url;
-    } else if (data.signed_url) {
-      outputPreview.src = data.signed_url;
-    }
+    showOutput(data);
   } catch (err) {
     alert(err.message);
   } finally {
@@ -117,13 +135,28 @@ async function handleMaskFacesPostcard() {
       image: base64,
       filename: selectedFile.name || 'uploaded_image',
       edit_type: 2, // ポストカード
+      album_id: ALBUM_ID,
     });
-    // 出力プレビューはData URLを優先
-    if (data.data_url) {
-      outputPreview.src = data.data_url;
-    } else if (data.signed_url) {
-      outputPreview.src = data.signed_url;
-    }
+    showOutput(data);
+  } catch (err) {
+    alert(err.message);
+  } finally {
+    setBusy(false);
+  }
+}
+
+async function handleMaskFacesBlur() {
+  if (!selectedFile) return;
+  try {
+    setBusy(true);
+    const base64 = await toBase64(selectedFile);
+    const data = await callApi('/mask-faces', {
+      image: base64,
+      filename: selectedFile.name || 'uploaded_image',
+      edit_type: 3, // ぼかし（ローカル処理のみ）
+      album_id: ALBUM_ID,
+    });
+    showOutput(data);
   } catch (err) {
     alert(err.message);
   } finally {
@@ -168,6 +201,7 @@ fileInput.addEventListener('change', (e) => {
 
 maskFacesBtn.addEventListener('click', handleMaskFaces);
 maskFacesPostcardBtn.addEventListener('click', handleMaskFacesPostcard);
+maskFacesBlurBtn.addEventListener('click', handleMaskFacesBlur);
 // 背景変更機能は削除済み
 // 統合のためAI編集ボタンは廃止
 
@@ -1,11 +1,20 @@
 """Cloud Storage操作サービス"""
-import io
-import base64
-from datetime import timedelta
-from typing import List, Dict, Optional
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Iterator, List, Dict, Optional, Tuple
 from google.cloud import storage
+from google.api_core import exceptions as gcs_exceptions
 from PIL import Image
 from config import Config
+from tracing import traced
+from image_processor import ImageProcessor
+from metrics import metrics
+from blob_cache import blob_cache
+from image_index import image_index
 
 class StorageService:
     """Cloud Storage操作を管理するクラス"""
@@ -14,76 +23,329 @@ class StorageService:
         """ストレージサービスの初期化"""
         self.client = storage.Client(project=Config.PROJECT_ID)
         self.bucket = self.client.bucket(Config.BUCKET_NAME)
+        # コンテンツアドレス方式: 存在確認済みのオブジェクトと論理名→オブジェクト名の対応
+        # （いずれもCONTENT_INDEX_CACHE_ENTRIES件までのLRU）
+        self._known_objects: "OrderedDict[str, None]" = OrderedDict()
+        self._name_index: "OrderedDict[str, str]" = OrderedDict()
+        self._index_lock = threading.Lock()
     
-    def upload_image(self, image: Image.Image, blob_name: str, filename: str) -> Dict:
-        """画像をCloud Storageにアップロード（非公開）し、署名付きURLとBase64を返す"""
+    @traced("storage.upload")
+    def upload_image(self, image: Image.Image, blob_name: str, filename: str,
+                     output_format: Optional[str] = None, target_bytes: Optional[int] = None,
+                     edit_info: Optional[Dict] = None) -> Dict:
+        """画像をCloud Storageにアップロード（非公開）し、署名付きURLとBase64を返す
+
+        edit_info（edit_type/faces_detected/fallback_used）はBlobのメタデータと画像索引に記録する。
+        """
         try:
-            # 画像をバイト形式で保存
-            img_byte_arr = io.BytesIO()
-            save_format = image.format if image.format else 'PNG'
-            image.save(img_byte_arr, format=save_format)
+            # 画像を指定形式でエンコード（未指定なら元の形式）
+            image_bytes, save_format = ImageProcessor.encode_image(image, output_format, target_bytes)
             
-            # 完全なblob名を生成
+            content_type = f"image/{save_format.lower()}"
+            # 完全なblob名を生成（論理名。コンテンツアドレス方式では索引のキー）
             full_blob_name = f"{Config.PROCESSED_IMAGES_PREFIX}{blob_name}.{save_format.lower()}"
-            blob = self.bucket.blob(full_blob_name)
-            
-            # アップロード（公開しない）
-            blob.upload_from_string(
-                img_byte_arr.getvalue(), 
-                content_type=f"image/{save_format.lower()}"
-            )
+            deduplicated = False
+            if Config.CONTENT_ADDRESSED_STORAGE:
+                # SHA-256をオブジェクト名にし、同一内容は再アップロードしない
+                digest = hashlib.sha256(image_bytes).hexdigest()
+                object_name = f"{Config.CONTENT_OBJECTS_PREFIX}{digest}.{save_format.lower()}"
+                deduplicated = not self._upload_if_absent(object_name, image_bytes, content_type)
+                self._record_name(full_blob_name, object_name)
+                full_blob_name = object_name
+            else:
+                blob = self.bucket.blob(full_blob_name)
+                # 索引の再構築で編集情報を復元できるようBlobメタデータにも残す
+                if edit_info:
+                    blob.metadata = {k: str(v).lower() if isinstance(v, bool) else str(v)
+                                     for k, v in edit_info.items() if v is not None}
+
+                # アップロード（公開しない）
+                blob.upload_from_string(
+                    image_bytes, 
+                    content_type=content_type
+                )
+            image_index.upsert(full_blob_name, len(image_bytes), format=save_format.lower(), **(edit_info or {}))
+
             # 署名付きURLは使わない（権限不要な方式）。代わりにダウンロードAPIを利用
             signed_url = None
 
             # クライアント表示用のData URL（プレビュー用）
-            base64_data = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
-            data_url = f"data:image/{save_format.lower()};base64,{base64_data}"
+            data_url = ImageProcessor.to_data_url(image_bytes, save_format)
 
             return {
                 "blob_name": full_blob_name,
                 "signed_url": signed_url,
-                "size": len(img_byte_arr.getvalue()),
-                "data_url": data_url
+                "size": len(image_bytes),
+                "format": save_format.lower(),
+                "data_url": data_url,
+                "deduplicated": deduplicated
             }
             
         except Exception as e:
             raise Exception(f"画像のアップロードに失敗しました: {str(e)}")
     
+    def _upload_if_absent(self, object_name: str, data: bytes, content_type: str) -> bool:
+        """オブジェクトが無い場合のみアップロードし、アップロードしたかを返す
+
+        存在確認済みのオブジェクトはストレージI/O無しでスキップし、未確認のものは
+        if_generation_match=0 の事前条件付きで書き込む（既存なら412で失敗）。
+        """
+        with self._index_lock:
+            if object_name in self._known_objects:
+                self._known_objects.move_to_end(object_name)
+                metrics.increment("storage.cas.dedup_hit")
+                return False
+        blob = self.bucket.blob(object_name)
+        try:
+            blob.upload_from_string(data, content_type=content_type, if_generation_match=0)
+            uploaded = True
+            metrics.increment("storage.cas.uploaded")
+        except gcs_exceptions.PreconditionFailed:
+            uploaded = False
+            metrics.increment("storage.cas.dedup_hit")
+        with self._index_lock:
+            self._remember(self._known_objects, object_name, None)
+        return uploaded
+
+    @staticmethod
+    def _remember(cache: OrderedDict, key: str, value) -> None:
+        """LRUに登録し、上限を超えた分を古い順に削除（_index_lock保持中に呼ぶ）"""
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > Config.CONTENT_INDEX_CACHE_ENTRIES:
+            cache.popitem(last=False)
+
+    def _forget_object(self, object_name: str) -> None:
+        """存在しなかったオブジェクトを確認済みから外し、次回の同一内容の保存で再アップロードさせる"""
+        with self._index_lock:
+            self._known_objects.pop(object_name, None)
+            for logical_name in [k for k, v in self._name_index.items() if v == object_name]:
+                del self._name_index[logical_name]
+        metrics.increment("storage.cas.missing")
+
+    def _record_name(self, logical_name: str, object_name: str) -> None:
+        """論理名→オブジェクト名の索引を更新（対応が変わらない場合は書き込まない）"""
+        with self._index_lock:
+            if self._name_index.get(logical_name) == object_name:
+                self._name_index.move_to_end(logical_name)
+                return
+            self._remember(self._name_index, logical_name, object_name)
+        index_blob = self.bucket.blob(f"{Config.CONTENT_INDEX_PREFIX}{logical_name}.json")
+        index_blob.upload_from_string(
+            json.dumps({"object": object_name}),
+            content_type="application/json"
+        )
+
+    def resolve_blob_name(self, blob_name: str) -> str:
+        """論理名を実体のオブジェクト名に解決（索引に無ければそのまま返す）"""
+        if not Config.CONTENT_ADDRESSED_STORAGE or blob_name.startswith(Config.CONTENT_OBJECTS_PREFIX):
+            return blob_name
+        with self._index_lock:
+            object_name = self._name_index.get(blob_name)
+            if object_name:
+                self._name_index.move_to_end(blob_name)
+        if object_name:
+            return object_name
+        try:
+            entry = json.loads(self.bucket.blob(f"{Config.CONTENT_INDEX_PREFIX}{blob_name}.json").download_as_bytes())
+        except gcs_exceptions.NotFound:
+            return blob_name
+        with self._index_lock:
+            self._remember(self._name_index, blob_name, entry["object"])
+        return entry["object"]
+
+    @traced("storage.download")
+    def _download_bytes(self, blob_name: str) -> bytes:
+        """キャッシュ経由でBlobを取得
+
+        検証後BLOB_CACHE_VALIDATE_SEC以内のエントリ、およびコンテンツアドレス方式の
+        オブジェクト（内容不変）はGCSへ問い合わせずに返す。それ以外はメタデータのみ
+        取得して世代番号が一致すれば再ダウンロードしない。
+        """
+        if not Config.BLOB_CACHE_ENABLED:
+            return self.bucket.blob(blob_name).download_as_bytes()
+
+        cached = blob_cache.get(blob_name)
+        if cached is not None:
+            data, generation, validated_at = cached
+            immutable = blob_name.startswith(Config.CONTENT_OBJECTS_PREFIX)
+            if immutable or time.monotonic() - validated_at <= Config.BLOB_CACHE_VALIDATE_SEC:
+                metrics.increment("blob_cache.bytes_saved", len(data))
+                return data
+            current = self.bucket.get_blob(blob_name)
+            if current is None:
+                blob_cache.invalidate(blob_name)
+                raise gcs_exceptions.NotFound(f"Blobが存在しません: {blob_name}")
+            if current.generation == generation:
+                blob_cache.mark_validated(blob_name)
+                metrics.increment("blob_cache.revalidated")
+                metrics.increment("blob_cache.bytes_saved", len(data))
+                return data
+            metrics.increment("blob_cache.stale")
+
+        blob = self.bucket.blob(blob_name)
+        data = blob.download_as_bytes()
+        # ダウンロード応答ヘッダから世代番号が設定される
+        blob_cache.put(blob_name, data, blob.generation)
+        return data
+
+    def download_bytes(self, blob_name: str) -> bytes:
+        """Cloud StorageからBlobの内容を取得（論理名も可。ストレージの例外はそのまま送出）"""
+        name = self.resolve_blob_name(blob_name)
+        try:
+            return self._download_bytes(name)
+        except gcs_exceptions.NotFound:
+            if name.startswith(Config.CONTENT_OBJECTS_PREFIX):
+                # 削除済みのオブジェクトを確認済みのまま残すと、同一内容の保存がスキップされ続ける
+                self._forget_object(name)
+            raise
+
     def download_image(self, blob_name: str) -> Image.Image:
-        """Cloud Storageから画像をダウンロード"""
+        """Cloud Storageから画像をダウンロード（論理名も可）"""
         try:
-            blob = self.bucket.blob(blob_name)
-            image_data = blob.download_as_bytes()
-            return Image.open(io.BytesIO(image_data))
+            return ImageProcessor.open_image_bytes(self.download_bytes(blob_name))
             
         except Exception as e:
             raise Exception(f"画像のダウンロードに失敗しました: {str(e)}")
 
+    @traced("storage.save_result")
+    def save_result(self, handle: str, data: bytes, fmt: str, filename: str) -> None:
+        """結果ストアのフル解像度画像を他インスタンスからも取得できるよう保存
+
+        ハンドルを知るリクエスト元のみが取得できるよう、画像索引（/images の一覧）には登録しない。
+        """
+        blob = self.bucket.blob(f"{Config.RESULTS_PREFIX}{handle}")
+        blob.metadata = {"filename": filename, "format": fmt.lower()}
+        blob.upload_from_string(data, content_type=f"image/{fmt.lower()}")
+
+    @traced("storage.load_result")
+    def load_result(self, handle: str) -> Optional[Tuple[bytes, str, str]]:
+        """save_resultで保存した結果を (データ, 形式, ファイル名) で返す（未保存・RESULT_TTL_SEC経過ならNone）"""
+        blob = self.bucket.get_blob(f"{Config.RESULTS_PREFIX}{handle}")
+        if blob is None:
+            return None
+        created = blob.time_created
+        if created is None or (datetime.now(timezone.utc) - created).total_seconds() > Config.RESULT_TTL_SEC:
+            # 期限切れの結果は返さず、ライフサイクルルールを待たずに削除する
+            metrics.increment("result_store.shared_expired")
+            try:
+                blob.delete()
+            except Exception:
+                pass
+            return None
+        try:
+            data = blob.download_as_bytes()
+        except gcs_exceptions.NotFound:
+            return None
+        meta = blob.metadata or {}
+        return data, meta.get("format", "jpeg"), meta.get("filename", "image")
+
+    @traced("storage.read_face_metadata")
+    def read_face_metadata(self, blob_name: str) -> Tuple[Optional[Dict], int]:
+        """取り込み時に保存した顔検出結果をBlobメタデータから取得 (検出結果, 世代番号)
+
+        本体はダウンロードしない。検出後に内容が上書きされた（世代番号が異なる）場合や
+        未検出の場合、検出結果はNoneとする。
+        """
+        name = self.resolve_blob_name(blob_name)
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            raise gcs_exceptions.NotFound(f"Blobが存在しません: {blob_name}")
+        meta = blob.metadata or {}
+        if "face_regions" not in meta or meta.get("faces_generation") != str(blob.generation):
+            metrics.increment("storage.face_metadata.miss")
+            return None, blob.generation
+        try:
+            faces = {
+                "face_regions": [tuple(int(v) for v in r) for r in json.loads(meta["face_regions"])],
+                "image_width": int(meta["image_width"]),
+                "image_height": int(meta["image_height"]),
+                "face_detector": meta.get("face_detector")
+            }
+        except (ValueError, KeyError, TypeError):
+            metrics.increment("storage.face_metadata.invalid")
+            return None, blob.generation
+        metrics.increment("storage.face_metadata.hit")
+        return faces, blob.generation
+
+    @traced("storage.write_face_metadata")
+    def write_face_metadata(self, blob_name: str, generation: int, face_regions: List[Tuple[int, int, int, int]],
+                            image_size: Tuple[int, int], detector: str) -> bool:
+        """顔検出結果（image_sizeの座標系）をBlobメタデータへ追記
+
+        検出した世代のままの場合のみ書き込み、既に上書きされていればFalseを返す。
+        """
+        blob = self.bucket.blob(self.resolve_blob_name(blob_name))
+        blob.metadata = {
+            "face_regions": json.dumps([list(r) for r in face_regions], separators=(',', ':')),
+            "image_width": str(image_size[0]),
+            "image_height": str(image_size[1]),
+            "face_detector": detector,
+            "faces_generation": str(generation)
+        }
+        try:
+            # メタデータのみの更新（既存のキーは残り、世代番号は変わらない）
+            blob.patch(if_generation_match=generation)
+        except gcs_exceptions.PreconditionFailed:
+            metrics.increment("storage.face_metadata.stale")
+            return False
+        metrics.increment("storage.face_metadata.written")
+        return True
+
     def delete_blob(self, blob_name: str) -> None:
         """指定したBlobを削除"""
         try:
             blob = self.bucket.blob(blob_name)
             blob.delete()
+            blob_cache.invalidate(blob_name)
+            image_index.delete(blob_name)
+            with self._index_lock:
+                self._known_objects.pop(blob_name, None)
         except Exception:
             pass
     
-    def list_images(self) -> List[Dict]:
-        """保存された画像の一覧を取得"""
+    @traced("storage.list")
+    def list_images(self, limit: Optional[int] = None, cursor: Optional[str] = None, **filters) -> Tuple[List[Dict], Optional[str]]:
+        """保存された画像の一覧を画像索引から1ページ分取得 (画像リスト, 次ページのcursor)
+
+        filters: edit_type / min_faces / max_faces / fallback_used / since / until
+        """
         try:
-            blobs = self.bucket.list_blobs(prefix=Config.PROCESSED_IMAGES_PREFIX)
-            
-            images = []
-            for blob in blobs:
-                if any(blob.name.endswith(ext) for ext in Config.ALLOWED_IMAGE_FORMATS):
-                    images.append({
-                        "name": blob.name,
-                        "url": blob.public_url,
-                        "size": blob.size,
-                        "created": blob.time_created.isoformat() if blob.time_created else None
-                    })
-            
-            return images
+            limit = min(max(1, limit or Config.IMAGE_LIST_PAGE_SIZE), Config.IMAGE_LIST_MAX_PAGE_SIZE)
+            images, next_cursor = image_index.query(limit, cursor, **filters)
+            for image in images:
+                image["url"] = self.bucket.blob(image["name"]).public_url
+            return images, next_cursor
             
         except Exception as e:
             raise Exception(f"画像一覧の取得に失敗しました: {str(e)}")
-    
\ No newline at end of file
+
+    def _scan_bucket(self) -> Iterator[Dict]:
+        """バケットを走査し、保存画像の索引用エントリを返す（共有結果 results/ は対象外）"""
+        blobs = self.bucket.list_blobs(prefix=Config.PROCESSED_IMAGES_PREFIX)
+        extensions = Config.ALLOWED_IMAGE_FORMATS + [f".{fmt}" for fmt in Config.OUTPUT_IMAGE_FORMATS]
+        for blob in blobs:
+            if not any(blob.name.endswith(ext) for ext in extensions):
+                continue
+            meta = blob.metadata or {}
+            faces = meta.get("faces_detected")
+            fallback = meta.get("fallback_used")
+            yield {
+                "name": blob.name,
+                "size": blob.size,
+                "created": blob.time_created,
+                "format": blob.name.rsplit('.', 1)[-1].lower(),
+                "edit_type": meta.get("edit_type"),
+                "faces_detected": int(faces) if faces and faces.isdigit() else None,
+                "fallback_used": None if fallback is None else fallback == "true"
+            }
+
+    @traced("storage.reconcile_index")
+    def reconcile_index(self) -> Dict:
+        """バケットの内容から画像索引を再構築"""
+        try:
+            result = image_index.reconcile(self._scan_bucket())
+            print(f"Image index reconciled: {result}")
+            return result
+        except Exception as e:
+            raise Exception(f"画像索引の再構築に失敗しました: {str(e)}")
@@ -0,0 +1,177 @@
+"""リクエスト単位の軽量トレーシング（ネストしたスパンと差し替え可能なエクスポーター）"""
+import abc
+import contextvars
+import functools
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from config import Config
+
+
+class SpanExporter(abc.ABC):
+    """完了したトレース（スパンのリスト）の出力先"""
+
+    @abc.abstractmethod
+    def export(self, spans: List[Dict]) -> None:
+        """1トレース分の完了スパンを出力"""
+
+
+class JsonLinesExporter(SpanExporter):
+    """1スパン1行のJSON Linesファイルへ追記するエクスポーター（オフライン分析用）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, spans: List[Dict]) -> None:
+        lines = "".join(json.dumps(span, ensure_ascii=False, default=str) + "\n" for span in spans)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
+
+class StdoutExporter(SpanExporter):
+    """標準出力（Cloud Logging）へ1トレース1行で出力するエクスポーター"""
+
+    def export(self, spans: List[Dict]) -> None:
+        print(json.dumps({"trace": spans}, ensure_ascii=False, default=str))
+
+
+class _Trace:
+    """1リクエスト分の完了スパン"""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Dict] = []
+        self.lock = threading.Lock()
+
+
+class Span:
+    """計測中のスパン（with文で使用）"""
+
+    def __init__(self, trace: _Trace, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self._token = None
+        self._started = 0.0
+        self._start_wall = 0.0
+
+    def set(self, key: str, value: Any) -> None:
+        """属性を追加"""
+        self.attributes[key] = value
+
+    def __enter__(self) -> 'Span':
+        self._start_wall = time.time()
+        self._started = time.monotonic()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        duration_ms = (time.monotonic() - self._started) * 1000
+        _current_span.reset(self._token)
+        record = {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self._start_wall,
+            "duration_ms": round(duration_ms, 3),
+            "attributes": self.attributes,
+        }
+        if exc is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        with self.trace.lock:
+            self.trace.spans.append(record)
+        # ルートスパンの終了でトレース全体を出力
+        if self.parent_id is None and _exporter is not None:
+            try:
+                _exporter.export(self.trace.spans)
+            except Exception as e:
+                print(f"Trace export failed: {e}")
+        return False
+
+
+class _NoopSpan:
+    """トレーシング無効時・トレース外で使う何もしないスパン"""
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP = _NoopSpan()
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+_enabled = Config.TRACING_ENABLED
+_exporter: Optional[SpanExporter] = None
+
+EXPORTERS: Dict[str, Callable[[], SpanExporter]] = {
+    "jsonl": lambda: JsonLinesExporter(Config.TRACE_FILE),
+    "stdout": StdoutExporter,
+}
+
+
+def set_exporter(exporter: Optional[SpanExporter]) -> None:
+    """エクスポーターを差し替え（Noneで出力しない）"""
+    global _exporter
+    _exporter = exporter
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def start_trace(name: str, trace_id: str, force: bool = False, **attributes) -> Any:
+    """ルートスパンを返す（トレーシング無効時は何もしないスパン）
+
+    force=Trueなら無効時も計測する（プロファイリング対象リクエストの段階別時間の取得用）。
+    """
+    if not _enabled and not force:
+        return _NOOP
+    return Span(_Trace(trace_id), name, None, attributes)
+
+
+def span(name: str, **attributes) -> Any:
+    """現在のスパンの子スパンを返す（トレース外では何もしないスパン）"""
+    parent = _current_span.get()
+    if parent is None:
+        return _NOOP
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def traced(name: str):
+    """関数呼び出し全体をスパンで囲むデコレータ"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap_context(fn: Callable) -> Callable:
+    """別スレッドで実行する関数に現在のトレース文脈を引き継ぐ"""
+    if _current_span.get() is None:
+        return fn
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+if _enabled:
+    set_exporter(EXPORTERS[Config.TRACE_EXPORTER]())
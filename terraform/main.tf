@@ -68,6 +68,18 @@ resource "google_storage_bucket" "main" {
     }
   }
 
+  # 共有保存した処理結果（results/）は作成から1日で削除（バージョニングで残る旧世代も含む）
+  lifecycle_rule {
+    condition {
+      age            = 1
+      matches_prefix = ["results/"]
+      with_state     = "ANY"
+    }
+    action {
+      type = "Delete"
+    }
+  }
+
   depends_on = [google_project_service.storage_api]
 }
 